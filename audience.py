@@ -0,0 +1,193 @@
+# audience.py
+# Indice del pubblico comune ai bot in modalità host: un DB a parte con una
+# riga per utente e una maschera di bit dei bot che possono raggiungerlo.
+# Si aggiorna in modo incrementale dalle colonne `rev` dei DB dei bot (le
+# stesse dei backup incrementali) e alimenta i broadcast su unione,
+# intersezione o differenza dei pubblici: un messaggio per persona.
+import os
+import re
+import logging
+import asyncio as aio
+from typing import Iterator, Tuple
+
+from db import Database
+
+log = logging.getLogger("audience")
+
+AUDIENCE_DB       = os.environ.get("AUDIENCE_DB", "./data/audience.db")
+AUDIENCE_SYNC_SEC = int(os.environ.get("AUDIENCE_SYNC_SEC", "300"))    # sync periodica in host (0 = solo prima dei broadcast)
+AUDIENCE_BATCH    = int(os.environ.get("AUDIENCE_BATCH", "1000"))      # righe per pagina keyset in lettura
+
+_SPEC = re.compile(r"^\s*(\w+)\s*(?:([|&-])\s*(\w+))?\s*$")
+
+
+class Target:
+    """Selezione sulla maschera `bots`: almeno uno di `any`, tutti `all`, nessuno di `none`."""
+
+    def __init__(self, spec: str, any_: int = 0, all_: int = 0, none: int = 0):
+        self.spec, self.any, self.all, self.none = spec, any_, all_, none
+
+    @property
+    def where(self) -> str:
+        return "(:any = 0 OR bots & :any != 0) AND bots & :all = :all AND bots & :none = 0"
+
+    @property
+    def params(self) -> dict:
+        return {"any": self.any, "all": self.all, "none": self.none}
+
+
+class AudienceIndex:
+    """`add_source()` per ogni bot (nell'ordine di preferenza per l'invio), poi `init()`.
+
+    Ogni sorgente ha un bit; `reachable` è l'espressione SQL sulla sua tabella
+    users che dice se l'utente è raggiungibile (es. "delivery = 'ok'");
+    `on_drop(user_ids)` la rende falsa nel DB del bot, così un utente escluso
+    da `drop()` resta escluso anche dopo sync e ricostruzioni.
+    Metodi bloccanti: dall'event loop con asyncio.to_thread.
+    """
+
+    def __init__(self, path=AUDIENCE_DB):
+        self.db = Database(path)
+        self.sources = {}   # nome → (bit, Database, reachable)
+        self._on_drop = {}  # nome → callback che segna l'utente nel DB del bot
+
+    def add_source(self, name: str, db: Database, reachable: str = "1", on_drop=None) -> int:
+        bit = 1 << len(self.sources)
+        self.sources[name] = (bit, db, reachable)
+        if on_drop is not None:
+            self._on_drop[name] = on_drop
+        return bit
+
+    def init(self):
+        with self.db.transaction() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS audience (user_id INTEGER PRIMARY KEY, bots INTEGER NOT NULL)")
+            conn.execute("""CREATE TABLE IF NOT EXISTS sources (
+                name TEXT PRIMARY KEY, bit INTEGER NOT NULL, epoch TEXT, gen INTEGER NOT NULL DEFAULT 0, synced TEXT)""")
+            for name, (bit, _, _) in self.sources.items():
+                # bit cambiato (sorgenti riordinate): la sorgente riparte da zero
+                old = conn.execute("SELECT bit FROM sources WHERE name=?", (name,)).fetchone()
+                if old and old[0] != bit:
+                    conn.execute("UPDATE audience SET bots = 0")
+                    conn.execute("UPDATE sources SET gen = 0, epoch = NULL")
+                conn.execute("INSERT INTO sources (name, bit) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET bit=excluded.bit",
+                             (name, bit))
+            conn.execute("DELETE FROM audience WHERE bots = 0")
+
+    # ---------- sync ----------
+    @staticmethod
+    def _source_state(db: Database) -> Tuple[str, int]:
+        """Epoch del file e generazione corrente, letta senza farla avanzare.
+
+        `_backup_gen` appartiene ai backup (che ne ripuliscono i tombstone):
+        qui si legge e basta. Le scritture da ora in poi prendono rev >= gen,
+        quindi la prossima sync rilegge da `rev >= gen`: le righe della
+        generazione aperta passano più volte, ma l'upsert è idempotente.
+        """
+        with db.transaction() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS _audience (id INTEGER PRIMARY KEY CHECK (id = 1), epoch TEXT NOT NULL)")
+            conn.execute("INSERT OR IGNORE INTO _audience VALUES (1, lower(hex(randomblob(8))))")
+            epoch = conn.execute("SELECT epoch FROM _audience WHERE id = 1").fetchone()[0]
+            gen = conn.execute("SELECT gen FROM _backup_gen WHERE id = 1").fetchone()[0]
+        return epoch, gen
+
+    def sync(self) -> dict:
+        """Sync incrementale di tutte le sorgenti; ritorna {nome: righe lette (o 'full')}.
+
+        Le cancellazioni arrivano dai tombstone `_deleted_users`, che un backup
+        completo ripulisce: una cancellazione avvenuta e ripulita tra due sync
+        sfugge all'indice fino alla prossima ricostruzione (restore o riordino
+        delle sorgenti). I bot non cancellano utenti nel funzionamento normale.
+        """
+        return {name: self._sync_one(name) for name in self.sources}
+
+    def _sync_one(self, name: str):
+        bit, src, reachable = self.sources[name]
+        epoch, gen = self._source_state(src)
+        old_epoch, old_gen = self.db.one("SELECT epoch, gen FROM sources WHERE name=?", (name,))
+        # file diverso (restore con scambio) o generazione tornata indietro: ricostruzione
+        full = epoch != old_epoch or gen < old_gen
+        last = 0 if full else old_gen   # rev = 0: righe precedenti al tracciamento
+        self.db.execute("ATTACH DATABASE ? AS s", (src.path,))
+        try:
+            with self.db.transaction() as conn:
+                if full:
+                    conn.execute("UPDATE audience SET bots = bots & ~? WHERE bots & ?", (bit, bit))
+                conn.execute(f"""INSERT INTO audience (user_id, bots)
+                    SELECT user_id, CASE WHEN {reachable} THEN :bit ELSE 0 END FROM s.users
+                    WHERE rev >= :last ORDER BY user_id
+                    ON CONFLICT(user_id) DO UPDATE SET bots = (bots & ~:bit) | excluded.bots""",
+                             {"bit": bit, "last": last})
+                n = conn.execute("SELECT changes()").fetchone()[0]
+                if not full:
+                    conn.execute("""UPDATE audience SET bots = bots & ~:bit WHERE user_id IN
+                        (SELECT key FROM s._deleted_users WHERE rev >= :last)""",
+                                 {"bit": bit, "last": last})
+                conn.execute("DELETE FROM audience WHERE bots = 0")
+                conn.execute("UPDATE sources SET epoch=?, gen=?, synced=datetime('now') WHERE name=?",
+                             (epoch, gen, name))
+        finally:
+            self.db.execute("DETACH DATABASE s")
+        if full:
+            log.info(f"[AUDIENCE] {name}: ricostruito ({n} righe)")
+        return "full" if full else n
+
+    # ---------- target ----------
+    def target(self, spec: str) -> Target:
+        """`a`, `a|b` (unione), `a&b` (intersezione), `a-b` (in a ma non in b)."""
+        m = _SPEC.match(spec or "")
+        if not m:
+            raise ValueError(f"target non valido: {spec!r}")
+        a, op, b = m.groups()
+        for n in (a, b):
+            if n is not None and n not in self.sources:
+                raise ValueError(f"bot sconosciuto: {n} (disponibili: {', '.join(self.sources)})")
+        ba = self.sources[a][0]
+        bb = self.sources[b][0] if b else 0
+        if op is None: return Target(a, any_=ba)
+        if op == "|":  return Target(spec, any_=ba | bb)
+        if op == "&":  return Target(spec, all_=ba | bb)
+        return Target(spec, all_=ba, none=bb)
+
+    def count(self, t: Target) -> int:
+        return self.db.scalar(f"SELECT COUNT(*) FROM audience WHERE {t.where}", t.params, default=0)
+
+    def iter_targets(self, t: Target, after: int = 0, batch: int = AUDIENCE_BATCH) -> Iterator[Tuple[int, str]]:
+        """(user_id, bot che invia) in ordine di user_id, a pagine keyset.
+
+        Il bot che invia è la prima sorgente (ordine di add_source) tra quelle
+        del target che raggiunge l'utente: una persona, un messaggio.
+        """
+        usable = t.any | t.all
+        names = [(bit, name) for name, (bit, _, _) in self.sources.items()]
+        sql = f"SELECT user_id, bots FROM audience WHERE user_id > :after AND {t.where} ORDER BY user_id LIMIT :n"
+        last = after
+        while True:
+            rows = self.db.all(sql, dict(t.params, after=last, n=batch))
+            for uid, bots in rows:
+                yield uid, next(name for bit, name in names if bots & usable & bit)
+            if len(rows) < batch:
+                return
+            last = rows[-1][0]
+
+    def drop(self, name: str, user_ids):
+        """Utenti non più raggiungibili da `name` (es. Forbidden durante un broadcast)."""
+        user_ids = list(user_ids)
+        if name in self._on_drop:
+            self._on_drop[name](user_ids)
+        bit = self.sources[name][0]
+        with self.db.transaction() as conn:
+            conn.executemany("UPDATE audience SET bots = bots & ~? WHERE user_id = ?", ((bit, u) for u in user_ids))
+            conn.execute("DELETE FROM audience WHERE bots = 0")
+
+    def stats(self) -> dict:
+        """{maschera: utenti}; con due bot 1 = solo il primo, 2 = solo il secondo, 3 = entrambi."""
+        return {r[0]: r[1] for r in self.db.all("SELECT bots, COUNT(*) FROM audience GROUP BY bots")}
+
+
+async def audience_sync_job(context):
+    """Job periodico (JobQueue, data=AudienceIndex)."""
+    try:
+        rep = await aio.to_thread(context.job.data.sync)
+        log.info(f"[AUDIENCE] sync {rep}")
+    except Exception as e:
+        log.warning(f"[AUDIENCE] sync fallita: {e}")
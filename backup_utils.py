@@ -1,14 +1,22 @@
 # backup_utils.py
+import io
 import os
+import csv
+import gzip
+import json
 import sqlite3
+import hashlib
+import threading
 import zipfile
-from datetime import datetime
+import tempfile
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from typing import Optional
+from typing import Callable, List, Optional
 
 DB_FILE = os.environ.get("DB_FILE", "./data/users.db")
 BACKUP_DIR = os.environ.get("BACKUP_DIR", "./data/backups")
 ROTATE_KEEP = int(os.environ.get("BACKUP_KEEP", "7"))
+BACKUP_PAGES = int(os.environ.get("BACKUP_PAGES", "1024"))   # pagine per step della backup API
 
 def ensure_dirs():
     Path(DB_FILE).parent.mkdir(parents=True, exist_ok=True)
@@ -17,50 +25,395 @@ def ensure_dirs():
 def timestamp() -> str:
     return datetime.now().strftime("%Y%m%d-%H%M%S")
 
-def sqlite_safe_copy(src: str, dst: str):
+def sqlite_safe_copy(src: str, dst: str, pages: int = 0, progress: Optional[Callable] = None):
+    """Copia coerente via backup API; con `pages` > 0 procede a step (i writer non restano bloccati)."""
     src_conn = sqlite3.connect(src)
     dst_conn = sqlite3.connect(dst)
     with dst_conn:
-        src_conn.backup(dst_conn)
+        src_conn.backup(dst_conn, pages=pages or -1, progress=progress)
     src_conn.close()
     dst_conn.close()
 
+def sha256_file(path, chunk: int = 1 << 20) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(chunk), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def zip_file(src: Path, dst: Path) -> Path:
+    with zipfile.ZipFile(dst, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        zf.write(src, arcname=Path(src).name)
+    return Path(dst)
+
+def snapshot_db(src: str, db_out: Path, zip_out: Optional[Path] = None,
+                progress: Optional[Callable] = None) -> dict:
+    """Snapshot + (zip) + checksum: bloccante, da eseguire in un worker thread.
+
+    `progress(status, remaining, total)` è la callback della backup API sqlite3,
+    chiamata dal thread di lavoro dopo ogni step di BACKUP_PAGES pagine.
+    """
+    db_out = Path(db_out)
+    db_out.parent.mkdir(parents=True, exist_ok=True)
+    sqlite_safe_copy(src, str(db_out), pages=BACKUP_PAGES, progress=progress)
+    info = {"db": db_out, "size": db_out.stat().st_size, "sha256": sha256_file(db_out)}
+    if zip_out:
+        info["zip"] = zip_file(db_out, Path(zip_out))
+    return info
+
 def make_db_backup() -> Path:
     ensure_dirs()
     ts = timestamp()
     raw_path = Path(BACKUP_DIR) / f"users-{ts}.db"
     zip_path = Path(BACKUP_DIR) / f"users-{ts}.zip"
-    sqlite_safe_copy(DB_FILE, str(raw_path))
-    with zipfile.ZipFile(zip_path, "w", compression=zipfile.ZIP_DEFLATED) as zf:
-        zf.write(raw_path, arcname=raw_path.name)
+    snapshot_db(DB_FILE, raw_path, zip_path)
     raw_path.unlink(missing_ok=True)
     rotate_backups()
     return zip_path
 
-def rotate_backups(keep: Optional[int] = None):
+def rotate_backups(keep: Optional[int] = None, pattern: str = "users-*.zip", folder=None):
+    """Tiene i `keep` file più recenti di `pattern` (nomi con timestamp ordinabile)."""
     keep = keep or ROTATE_KEEP
-    files = sorted(Path(BACKUP_DIR).glob("users-*.zip"), reverse=True)
+    files = sorted(Path(folder or BACKUP_DIR).glob(pattern), reverse=True)
     for f in files[keep:]:
         f.unlink(missing_ok=True)
 
-def export_users_csv(csv_path: Optional[Path] = None) -> Path:
+def is_sqlite_db(path, integrity: bool = False, table: Optional[str] = None):
+    """(ok, motivo): header SQLite, query di prova e, a richiesta, quick_check e tabella attesa."""
+    p = Path(path)
+    if not p.exists():
+        return False, "Il file non esiste"
+    try:
+        with open(p, "rb") as f:
+            header = f.read(16)
+        if header != b"SQLite format 3\x00":
+            return False, "Header SQLite mancante"
+        conn = sqlite3.connect(f"file:{p.resolve()}?mode=ro", uri=True)
+        try:
+            conn.execute("SELECT 1")
+            if table and not conn.execute(
+                    "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (table,)).fetchone():
+                return False, f"Tabella '{table}' mancante"
+            if integrity:
+                bad = [r[0] for r in conn.execute("PRAGMA quick_check").fetchall() if r[0] != "ok"]
+                if bad:
+                    return False, f"Integrità: {bad[0]}" + (f" (+{len(bad) - 1})" if len(bad) > 1 else "")
+        except Exception as e:
+            return False, f"Query fallita: {e}"
+        finally:
+            conn.close()
+        return True, "OK"
+    except Exception as e:
+        return False, f"Errore lettura: {e}"
+
+# ---------- export CSV in streaming ----------
+EXPORT_BATCH      = int(os.environ.get("EXPORT_BATCH", "2000"))               # righe per fetchmany
+EXPORT_PART_BYTES = int(os.environ.get("EXPORT_PART_MB", "45")) * 1024 * 1024  # limite documenti bot: 50 MB
+EXPORT_FORMAT     = os.environ.get("EXPORT_FORMAT", "zip")                    # zip (apribile su iOS) | gz
+
+class _CsvPart:
+    """Un file di output (gz o zip con un solo CSV) con conteggio dei byte compressi."""
+
+    def __init__(self, path: Path, fmt: str, header):
+        self.path = path
+        self.rows = 0
+        self._raw = open(path, "wb")
+        if fmt == "gz":
+            self._zf = None
+            self._bin = gzip.GzipFile(filename=path.name[:-3], mode="wb", fileobj=self._raw)
+        else:
+            self._zf = zipfile.ZipFile(self._raw, "w", compression=zipfile.ZIP_DEFLATED)
+            self._bin = self._zf.open(path.name[:-4], "w", force_zip64=True)
+        self._txt = io.TextIOWrapper(self._bin, encoding="utf-8", newline="")
+        self.writer = csv.writer(self._txt)
+        if header:
+            self.writer.writerow(header)
+
+    def size(self) -> int:
+        self._txt.flush()
+        return self._raw.tell()   # compressi già scritti (lo stato dello zlib resta indietro di pochi KB)
+
+    def close(self):
+        self._txt.close()
+        if self._zf is not None:
+            self._zf.close()
+        self._raw.close()
+
+def export_csv(db_file: str, sql: str, out: Path, params=(), header=None, fmt: str = EXPORT_FORMAT,
+               part_bytes: int = EXPORT_PART_BYTES, batch: int = EXPORT_BATCH,
+               progress: Optional[Callable[[int], None]] = None) -> List[dict]:
+    """Esegue `sql` e scrive le righe a lotti in CSV compressi: memoria costante.
+
+    `out` è il nome base senza estensione (es. backup/users_20240101). Se il
+    compresso supera `part_bytes` si apre una nuova parte (con intestazione):
+    a quel punto i file diventano out.part1.csv.gz, out.part2.csv.gz, …
+    Bloccante: da eseguire in un worker thread; `progress(righe)` viene
+    chiamata dopo ogni lotto. Ritorna [{"path", "rows", "size"}] per parte.
+    """
+    ext = ".csv.gz" if fmt == "gz" else ".csv.zip"
+    out = Path(out)
+    out.parent.mkdir(parents=True, exist_ok=True)
+    name = lambda n: out.with_name(f"{out.name}.part{n}{ext}") if n else out.with_name(out.name + ext)
+
+    conn = sqlite3.connect(f"file:{Path(db_file).resolve()}?mode=ro", uri=True)
+    parts, cur_part, total = [], None, 0
+    try:
+        cur = conn.execute(sql, params)
+        header = header or [d[0] for d in cur.description]
+        cur_part = _CsvPart(name(0), fmt, header)
+        while True:
+            rows = cur.fetchmany(batch)
+            if not rows:
+                break
+            cur_part.writer.writerows(rows)
+            cur_part.rows += len(rows)
+            total += len(rows)
+            if progress:
+                progress(total)
+            if cur_part.size() >= part_bytes:
+                cur_part.close()
+                parts.append(cur_part)
+                cur_part = _CsvPart(name(len(parts) + 1), fmt, header)
+        cur_part.close()
+        if cur_part.rows or not parts:
+            parts.append(cur_part)
+        else:
+            cur_part.path.unlink(missing_ok=True)   # parte aperta dopo l'ultimo lotto: vuota
+        cur_part = None
+    finally:
+        conn.close()
+        if cur_part is not None:
+            cur_part.close()
+    if len(parts) > 1:
+        parts[0].path = parts[0].path.rename(name(1))
+    return [{"path": p.path, "rows": p.rows, "size": p.path.stat().st_size} for p in parts]
+
+def export_users_csv(out: Optional[Path] = None, fmt: str = EXPORT_FORMAT,
+                     progress: Optional[Callable[[int], None]] = None) -> List[dict]:
     ensure_dirs()
-    csv_path = csv_path or Path(BACKUP_DIR) / f"users-{timestamp()}.csv"
+    out = out or Path(BACKUP_DIR) / f"users-{timestamp()}"
     conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='users'")
-    if not cur.fetchone():
+    try:
+        found = conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='users'").fetchone()
+    finally:
         conn.close()
+    if not found:
         raise RuntimeError("Tabella 'users' non trovata nel database.")
-    cur.execute("PRAGMA table_info(users)")
-    cols = [row[1] for row in cur.fetchall()]
-    cur.execute("SELECT * FROM users ORDER BY ROWID ASC")
-    rows = cur.fetchall()
-    conn.close()
-    import csv
-    csv_path.parent.mkdir(parents=True, exist_ok=True)
-    with open(csv_path, "w", newline="", encoding="utf-8") as f:
-        w = csv.writer(f)
-        w.writerow(cols)
-        w.writerows(rows)
-    return csv_path
\ No newline at end of file
+    return export_csv(DB_FILE, "SELECT * FROM users ORDER BY ROWID ASC", out, fmt=fmt, progress=progress)
+
+# ---------- backup incrementali: base completa + delta con manifest ----------
+# Ogni insert/update su una tabella tracciata marca la riga con la generazione
+# corrente (colonna `rev`); le cancellazioni lasciano un tombstone. Un backup
+# incrementa la generazione e salva solo le righe marcate dopo il precedente.
+# I delta coprono la tabella tracciata; le altre tabelle (job, cache) vengono
+# ripristinate dalla base.
+BACKUP_FULL_EVERY = int(os.environ.get("BACKUP_FULL_EVERY", "7"))   # giorni tra due basi complete
+BACKUP_KEEP_FULL  = int(os.environ.get("BACKUP_KEEP_FULL", "2"))    # catene base+delta conservate
+MANIFEST_NAME = "manifest.json"
+STAMP_FMT = "%Y%m%d_%H%M%S"
+
+def ensure_change_tracking(conn: sqlite3.Connection, table: str = "users", key: str = "user_id",
+                           data_cols: Optional[List[str]] = None):
+    """Colonna `rev`, tabella generazione, tombstone e trigger (idempotente).
+
+    I trigger vengono ricreati a ogni avvio, così le modifiche qui si applicano
+    anche ai DB esistenti. `_backup_gen.changed_at` = ultima modifica ai dati.
+    `data_cols`: solo l'UPDATE di queste colonne conta come modifica (le
+    colonne di servizio, es. contatori di consegna, non finiscono nei delta);
+    None = qualsiasi colonna.
+    """
+    cols = {r[1] for r in conn.execute(f"PRAGMA table_info('{table}')")}
+    if "rev" not in cols:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN rev INTEGER NOT NULL DEFAULT 0")
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_rev ON {table}(rev)")
+    conn.execute("CREATE TABLE IF NOT EXISTS _backup_gen (id INTEGER PRIMARY KEY CHECK (id = 1), gen INTEGER NOT NULL)")
+    if "changed_at" not in {r[1] for r in conn.execute("PRAGMA table_info('_backup_gen')")}:
+        conn.execute("ALTER TABLE _backup_gen ADD COLUMN changed_at TEXT")
+    conn.execute("INSERT OR IGNORE INTO _backup_gen (id, gen) VALUES (1, 1)")
+    conn.execute(f"CREATE TABLE IF NOT EXISTS _deleted_{table} (key INTEGER PRIMARY KEY, rev INTEGER NOT NULL)")
+    gen = "(SELECT gen FROM _backup_gen WHERE id = 1)"
+    touch = "UPDATE _backup_gen SET changed_at = strftime('%Y-%m-%dT%H:%M:%SZ', 'now') WHERE id = 1;"
+    for trg in ("ins", "upd", "del"):
+        conn.execute(f"DROP TRIGGER IF EXISTS {table}_rev_{trg}")
+    conn.execute(f"""CREATE TRIGGER {table}_rev_ins AFTER INSERT ON {table} BEGIN
+        UPDATE {table} SET rev = {gen} WHERE {key} = NEW.{key};
+        DELETE FROM _deleted_{table} WHERE key = NEW.{key};
+        {touch}
+    END""")
+    # WHEN: non riscatta sulla propria UPDATE di rev né se la riga è già nella generazione corrente
+    of = f" OF {', '.join(data_cols)}" if data_cols else ""
+    conn.execute(f"""CREATE TRIGGER {table}_rev_upd AFTER UPDATE{of} ON {table}
+        WHEN NEW.rev = OLD.rev AND OLD.rev != {gen} BEGIN
+        UPDATE {table} SET rev = {gen} WHERE {key} = NEW.{key};
+        {touch}
+    END""")
+    conn.execute(f"""CREATE TRIGGER {table}_rev_del AFTER DELETE ON {table} BEGIN
+        INSERT OR REPLACE INTO _deleted_{table} VALUES (OLD.{key}, {gen});
+        {touch}
+    END""")
+
+def load_manifest(out_dir) -> dict:
+    p = Path(out_dir) / MANIFEST_NAME
+    if not p.exists():
+        return {"entries": []}
+    with open(p, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def save_manifest(out_dir, manifest: dict):
+    p = Path(out_dir) / MANIFEST_NAME
+    tmp = p.with_suffix(".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp, p)
+
+def force_full_backup(out_dir):
+    """Il prossimo incrementale sarà una base completa (es. dopo un restore che sostituisce il DB)."""
+    if not Path(out_dir).exists():
+        return
+    manifest = load_manifest(out_dir)
+    manifest["force_full"] = True
+    save_manifest(out_dir, manifest)
+
+def _last(entries, kind):
+    for e in reversed(entries):
+        if e["kind"] == kind:
+            return e
+    return None
+
+# un backup alla volta per processo: in modalità host (host.py) i due bot
+# condividono disco e CPU, e i job notturni partono alla stessa ora
+_BACKUP_LOCK = threading.Lock()
+
+def incremental_backup(db_file: str, out_dir, table: str = "users", key: str = "user_id",
+                       progress: Optional[Callable] = None) -> dict:
+    """Backup notturno: base completa ogni BACKUP_FULL_EVERY giorni, altrimenti delta.
+
+    Se la tabella non è cambiata dall'ultimo backup (nessun `rev` o tombstone
+    più recente) registra solo un riferimento ("ref") al backup precedente.
+    Bloccante (worker thread). Ritorna la voce aggiunta al manifest; `path` è
+    il file da inviare (base .db o delta .zip; per "ref" il file precedente).
+    """
+    with _BACKUP_LOCK:
+        return _incremental_backup(db_file, out_dir, table, key, progress)
+
+def _incremental_backup(db_file, out_dir, table, key, progress) -> dict:
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    manifest = load_manifest(out_dir)
+    entries = manifest["entries"]
+    now = datetime.now(timezone.utc)
+    stamp = now.strftime(STAMP_FMT)
+    base = _last(entries, "full")
+    forced = manifest.pop("force_full", False)
+    need_full = (base is None or forced or
+                 now - datetime.strptime(base["stamp"], STAMP_FMT).replace(tzinfo=timezone.utc)
+                 >= timedelta(days=BACKUP_FULL_EVERY))
+    prev_gen = entries[-1]["gen"] if entries else 0
+
+    conn = sqlite3.connect(db_file, timeout=30)
+    try:
+        changed = conn.execute(
+            f"SELECT EXISTS(SELECT 1 FROM {table} WHERE rev > ?) OR EXISTS(SELECT 1 FROM _deleted_{table} WHERE rev > ?)",
+            (prev_gen, prev_gen)).fetchone()[0]
+        if entries and not changed and not forced:
+            # nessuna modifica dall'ultimo backup: solo un riferimento nel manifest
+            prev = entries[-1]
+            entry = {"kind": "ref", "stamp": stamp, "file": prev["file"], "ref": prev["stamp"],
+                     "gen": prev_gen, "rows": 0, "deleted": 0, "size": 0, "sha256": prev["sha256"]}
+            entries.append(entry)
+            save_manifest(out_dir, manifest)
+            return dict(entry, path=out_dir / prev["file"])
+        if need_full:
+            with conn:
+                gen = conn.execute("SELECT gen FROM _backup_gen WHERE id = 1").fetchone()[0]
+                conn.execute("UPDATE _backup_gen SET gen = gen + 1 WHERE id = 1")
+                conn.execute(f"DELETE FROM _deleted_{table} WHERE rev <= ?", (gen,))
+            # le scritture tra il commit e lo snapshot (rev > gen) finiscono anche
+            # nel delta successivo: riapplicarle è idempotente
+            path = out_dir / f"inc_base_{stamp}.db"
+            sqlite_safe_copy(db_file, str(path), pages=BACKUP_PAGES, progress=progress)
+            entry = {"kind": "full", "stamp": stamp, "file": path.name, "gen": gen,
+                     "rows": conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0], "deleted": 0}
+        else:
+            raw = out_dir / f"inc_delta_{stamp}.db"
+            raw.unlink(missing_ok=True)
+            conn.execute("ATTACH DATABASE ? AS d", (str(raw),))
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                gen = conn.execute("SELECT gen FROM _backup_gen WHERE id = 1").fetchone()[0]
+                conn.execute("UPDATE _backup_gen SET gen = gen + 1 WHERE id = 1")
+                conn.execute(f"CREATE TABLE d.{table} AS SELECT * FROM main.{table} WHERE rev > ? AND rev <= ?",
+                             (prev_gen, gen))
+                conn.execute(f"CREATE TABLE d._deleted AS SELECT key FROM main._deleted_{table} WHERE rev > ? AND rev <= ?",
+                             (prev_gen, gen))
+                rows = conn.execute(f"SELECT COUNT(*) FROM d.{table}").fetchone()[0]
+                deleted = conn.execute("SELECT COUNT(*) FROM d._deleted").fetchone()[0]
+            conn.execute("DETACH DATABASE d")
+            path = zip_file(raw, out_dir / f"inc_delta_{stamp}.zip")
+            raw.unlink(missing_ok=True)
+            entry = {"kind": "delta", "stamp": stamp, "file": path.name, "gen": gen,
+                     "base": base["file"], "rows": rows, "deleted": deleted}
+    finally:
+        conn.close()
+
+    entry.update(size=path.stat().st_size, sha256=sha256_file(path))
+    entries.append(entry)
+    _rotate_chains(out_dir, entries)
+    save_manifest(out_dir, manifest)
+    return dict(entry, path=path)
+
+def _rotate_chains(out_dir: Path, entries: list):
+    """Tiene le ultime BACKUP_KEEP_FULL catene (base + suoi delta), elimina il resto."""
+    bases = [i for i, e in enumerate(entries) if e["kind"] == "full"]
+    if len(bases) <= BACKUP_KEEP_FULL:
+        return
+    cut = bases[-BACKUP_KEEP_FULL]
+    for e in entries[:cut]:
+        (out_dir / e["file"]).unlink(missing_ok=True)
+    del entries[:cut]
+
+def rebuild_at(out_dir, dest, target: Optional[str] = None) -> dict:
+    """Ricostruisce in `dest` lo stato al backup più recente con stamp <= `target`.
+
+    `target` nel formato YYYYmmdd_HHMMSS (None = ultimo). Copia la base e
+    applica in ordine i delta successivi (upsert + tombstone).
+    """
+    out_dir, dest = Path(out_dir), Path(dest)
+    entries = [e for e in load_manifest(out_dir)["entries"] if target is None or e["stamp"] <= target]
+    start = max((i for i, e in enumerate(entries) if e["kind"] == "full"), default=None)
+    if start is None:
+        raise RuntimeError("Nessuna base completa disponibile per quella data.")
+    chain = entries[start:]
+    dest.unlink(missing_ok=True)
+    sqlite_safe_copy(str(out_dir / chain[0]["file"]), str(dest))
+
+    conn = sqlite3.connect(dest)
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            for e in chain[1:]:
+                if e["kind"] != "delta":
+                    continue
+                with zipfile.ZipFile(out_dir / e["file"]) as zf:
+                    zf.extractall(tmp)
+                    raw = Path(tmp) / zf.namelist()[0]
+                conn.execute("ATTACH DATABASE ? AS d", (str(raw),))
+                _apply_delta(conn)
+                conn.execute("DETACH DATABASE d")
+                raw.unlink(missing_ok=True)
+    finally:
+        conn.close()
+    return {"path": dest, "stamp": chain[-1]["stamp"], "applied": sum(e["kind"] == "delta" for e in chain)}
+
+def _apply_delta(conn: sqlite3.Connection):
+    tables = [r[0] for r in conn.execute("SELECT name FROM d.sqlite_master WHERE type='table' AND name != '_deleted'")]
+    with conn:
+        for table in tables:
+            key = next(r[1] for r in conn.execute(f"PRAGMA main.table_info('{table}')") if r[5])
+            have = {r[1] for r in conn.execute(f"PRAGMA main.table_info('{table}')")}
+            cols = [(r[1], r[2]) for r in conn.execute(f"PRAGMA d.table_info('{table}')")]
+            for name, typ in cols:   # colonne aggiunte dopo la base
+                if name not in have:
+                    conn.execute(f"ALTER TABLE main.{table} ADD COLUMN {name} {typ}")
+            names = ",".join(n for n, _ in cols)
+            conn.execute(f"INSERT OR REPLACE INTO main.{table} ({names}) SELECT {names} FROM d.{table}")
+            conn.execute(f"DELETE FROM main.{table} WHERE {key} IN (SELECT key FROM d._deleted)")
@@ -0,0 +1,252 @@
+# bench/fakeapi.py
+# Bot API finta per i benchmark: risponde ai metodi usati da bot.py / bot2.py
+# con latenza simulata, RetryAfter (casuale o oltre un rate massimo) e
+# Forbidden per una quota fissa di chat (utenti che hanno bloccato il bot).
+# Gira in un processo a parte (`python -m bench.fakeapi`) così la CPU del
+# server finto non si somma a quella del bot misurato; /_bench/* lo pilota.
+import sys
+import json
+import time
+import random
+import argparse
+import asyncio as aio
+from collections import Counter, deque
+from itertools import count
+from pathlib import Path
+
+from aiohttp import web
+
+SEND_METHODS = {"sendMessage", "sendPhoto", "sendDocument", "copyMessage", "sendChatAction"}
+
+
+class FakeBotAPI:
+    """Server aiohttp su `http://host:port` (usare BOT_API_URL=self.url).
+
+    - latency: secondi di attesa per richiesta (± jitter)
+    - retry_rate: probabilità di 429 sui metodi di invio
+    - rate_cap: invii/s oltre i quali si risponde 429 (0 = nessun limite)
+    - forbidden_every: chat_id multipli di N rispondono 403 (0 = nessuno)
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.03, jitter=0.5, retry_rate=0.0,
+                 retry_after=1, rate_cap=0, forbidden_every=0, seed=1):
+        self.host, self.port = host, port
+        self.latency, self.jitter = latency, jitter
+        self.retry_rate, self.retry_after = retry_rate, retry_after
+        self.rate_cap = rate_cap
+        self.forbidden_every = forbidden_every
+        self.rng = random.Random(seed)
+        self.calls = Counter()        # (metodo, esito) → n
+        self.files = {}               # file_id → path locale (getFile / download)
+        self._sends = deque()         # timestamp degli invii nell'ultimo secondo
+        self._ids = count(1000)
+        self._runner = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self._api)
+        app.router.add_get("/file/bot{token}/{path:.+}", self._file)
+        app.router.add_get("/_bench/stats", self._stats)
+        app.router.add_post("/_bench/config", self._config)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+    def reset(self):
+        self.calls.clear()
+        self._sends.clear()
+
+    def total(self, method=None, outcome=None) -> int:
+        return sum(n for (m, o), n in self.calls.items()
+                   if (method is None or m == method) and (outcome is None or o == outcome))
+
+    # ---------- risposte ----------
+    def _error(self, method, code, desc, **params):
+        self.calls[(method, str(code))] += 1
+        body = {"ok": False, "error_code": code, "description": desc}
+        if params:
+            body["parameters"] = params
+        return web.json_response(body, status=code)
+
+    def _ok(self, method, result):
+        self.calls[(method, "ok")] += 1
+        return web.json_response({"ok": True, "result": result})
+
+    def _message(self, chat_id, **extra):
+        msg = {"message_id": next(self._ids), "date": int(time.time()),
+               "chat": {"id": int(chat_id), "type": "private"}}
+        msg.update(extra)
+        return msg
+
+    async def _params(self, request) -> dict:
+        if request.content_type == "application/json":
+            return await request.json()
+        out = {}
+        if request.content_type.startswith("multipart/"):
+            reader = await request.multipart()
+            async for part in reader:
+                if part.filename:
+                    out[part.name] = {"size": len(await part.read())}
+                else:
+                    out[part.name] = await part.text()
+        else:
+            out = dict(await request.post())
+        for k, v in list(out.items()):
+            if isinstance(v, str) and v[:1] in "[{":
+                try: out[k] = json.loads(v)
+                except ValueError: pass
+        return out
+
+    def _throttled(self) -> bool:
+        if self.retry_rate and self.rng.random() < self.retry_rate:
+            return True
+        if self.rate_cap:
+            now = time.monotonic()
+            while self._sends and now - self._sends[0] > 1:
+                self._sends.popleft()
+            if len(self._sends) >= self.rate_cap:
+                return True
+            self._sends.append(now)
+        return False
+
+    async def _api(self, request):
+        method = request.match_info["method"]
+        p = await self._params(request)
+        if self.latency:
+            await aio.sleep(self.latency * (1 + self.jitter * (2 * self.rng.random() - 1)))
+        chat_id = p.get("chat_id")
+
+        if method in SEND_METHODS:
+            if self._throttled():
+                return self._error(method, 429, f"Too Many Requests: retry after {self.retry_after}",
+                                   retry_after=self.retry_after)
+            if self.forbidden_every and chat_id and int(chat_id) % self.forbidden_every == 0:
+                return self._error(method, 403, "Forbidden: bot was blocked by the user")
+
+        if method == "getMe":
+            return self._ok(method, {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"})
+        if method == "sendMessage":
+            return self._ok(method, self._message(chat_id, text=p.get("text", "")))
+        if method == "sendPhoto":
+            photo = p.get("photo")
+            fid = photo if isinstance(photo, str) and not photo.startswith("http") else f"PH{next(self._ids)}"
+            return self._ok(method, self._message(chat_id, photo=[
+                {"file_id": fid, "file_unique_id": fid, "width": 800, "height": 600}]))
+        if method == "sendDocument":
+            fid = f"DOC{next(self._ids)}"
+            return self._ok(method, self._message(chat_id, document={"file_id": fid, "file_unique_id": fid}))
+        if method == "copyMessage":
+            return self._ok(method, {"message_id": next(self._ids)})
+        if method in ("editMessageText", "editMessageCaption", "editMessageMedia"):
+            return self._ok(method, self._message(chat_id or 0, text=p.get("text", "")))
+        if method == "getFile":
+            fid = p["file_id"]
+            path = self.files.get(fid)
+            if not path:
+                return self._error(method, 400, "Bad Request: invalid file_id")
+            return self._ok(method, {"file_id": fid, "file_unique_id": fid,
+                                     "file_size": Path(path).stat().st_size, "file_path": f"documents/{fid}"})
+        # deleteWebhook, setWebhook, answerCallbackQuery, deleteMessage(s), sendChatAction, …
+        return self._ok(method, True)
+
+    async def _stats(self, request):
+        return web.json_response([[m, o, n] for (m, o), n in self.calls.items()])
+
+    async def _config(self, request):
+        p = await request.json()
+        if p.pop("reset", False):
+            self.reset()
+        self.files.update(p.pop("files", {}))
+        for k, v in p.items():
+            setattr(self, k, v)
+        return web.json_response(True)
+
+    async def _file(self, request):
+        fid = request.match_info["path"].rsplit("/", 1)[-1]
+        path = self.files.get(fid)
+        if not path:
+            raise web.HTTPNotFound()
+        return web.FileResponse(path)
+
+
+class FakeProcess:
+    """FakeBotAPI in un sottoprocesso, con la stessa interfaccia usata dagli scenari."""
+
+    def __init__(self, port=8765, **opts):
+        self.port = port
+        self.opts = opts
+        self.url = f"http://127.0.0.1:{port}"
+        self._proc = None
+        self._session = None
+
+    async def start(self):
+        import aiohttp
+        args = [sys.executable, "-m", "bench.fakeapi", "--port", str(self.port)]
+        for k, v in self.opts.items():
+            args += [f"--{k.replace('_', '-')}", str(v)]
+        self._proc = await aio.create_subprocess_exec(*args)
+        self._session = aiohttp.ClientSession()
+        for _ in range(100):
+            try:
+                async with self._session.get(self.url + "/_bench/stats") as r:
+                    if r.status == 200:
+                        return self
+            except aiohttp.ClientError:
+                pass
+            await aio.sleep(0.1)
+        raise RuntimeError("Bot API finta non partita")
+
+    async def stop(self):
+        if self._session:
+            await self._session.close()
+        if self._proc and self._proc.returncode is None:
+            self._proc.terminate()
+            await self._proc.wait()
+
+    async def configure(self, **kw):
+        async with self._session.post(self.url + "/_bench/config", json=kw) as r:
+            r.raise_for_status()
+
+    async def reset(self):
+        await self.configure(reset=True)
+
+    async def total(self, method=None, outcome=None) -> int:
+        async with self._session.get(self.url + "/_bench/stats") as r:
+            rows = await r.json()
+        return sum(n for m, o, n in rows
+                   if (method is None or m == method) and (outcome is None or o == outcome))
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description="Bot API finta per i benchmark")
+    p.add_argument("--port", type=int, default=8765)
+    p.add_argument("--latency", type=float, default=0.03, help="secondi per richiesta")
+    p.add_argument("--retry-rate", type=float, default=0.0)
+    p.add_argument("--rate-cap", type=int, default=0)
+    p.add_argument("--forbidden-every", type=int, default=0)
+    a = p.parse_args(argv)
+
+    async def serve():
+        await FakeBotAPI(port=a.port, latency=a.latency, retry_rate=a.retry_rate,
+                         rate_cap=a.rate_cap, forbidden_every=a.forbidden_every).start()
+        await aio.Event().wait()
+
+    try:
+        aio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
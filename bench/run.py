@@ -0,0 +1,390 @@
+# bench/run.py
+"""Benchmark di bot.py / bot2.py: la vera Application contro la Bot API finta.
+
+    python -m bench.run                                  # tutti gli scenari
+    python -m bench.run start callbacks --users 20000
+    python -m bench.run broadcast --users 100000 --retry-rate 0.001 --forbidden-every 40
+    python -m bench.run backup --users 100000
+    python -m bench.run mixed --mixed-rate 30 --storm 400
+    python -m bench.run webhook --storm 2000 --bad-every 10
+
+Gli update passano dall'update processor dell'Application e poi da
+`Application.process_update` (stesso percorso di polling/webhook, handler
+inclusi); la latenza misurata è quella dell'intero update, attesa dello slot e
+chiamate alla Bot API comprese. Risultati su stdout e in
+bench_output.txt (--out per cambiarlo).
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import importlib
+import asyncio as aio
+from itertools import count
+from pathlib import Path
+
+ADMIN = 42
+USER_BASE = 10_000_000
+SCENARIOS = ("start", "callbacks", "start2", "spam2", "broadcast", "backup", "mixed", "admin", "webhook")
+
+_upd_ids = count(1)
+
+
+# ---------- update sintetici ----------
+def _user(uid):
+    return {"id": uid, "is_bot": False, "first_name": f"U{uid}", "username": f"u{uid}"}
+
+
+def message(uid, text, reply_to=None, chat=None):
+    msg = {"message_id": next(_upd_ids), "date": int(time.time()), "text": text,
+           "chat": chat or {"id": uid, "type": "private"}, "from": _user(uid)}
+    if text.startswith("/"):
+        msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    if reply_to:
+        msg["reply_to_message"] = reply_to
+    return {"update_id": next(_upd_ids), "message": msg}
+
+
+def callback(uid, data, photo=False):
+    msg = {"message_id": next(_upd_ids), "date": int(time.time()), "chat": {"id": uid, "type": "private"}}
+    if photo:
+        msg["photo"] = [{"file_id": "PH0", "file_unique_id": "PH0", "width": 800, "height": 600}]
+    else:
+        msg["text"] = "…"
+    return {"update_id": next(_upd_ids), "callback_query": {
+        "id": str(next(_upd_ids)), "from": _user(uid), "chat_instance": "bench", "data": data, "message": msg}}
+
+
+# ---------- misure ----------
+def pct(values, q):
+    if not values:
+        return 0.0
+    s = sorted(values)
+    return s[min(len(s) - 1, int(q * len(s)))]
+
+
+class Result:
+    def __init__(self, name, n, wall, lat=None, **extra):
+        self.name, self.n, self.wall, self.lat, self.extra = name, n, wall, lat or [], extra
+
+    def line(self) -> str:
+        out = f"{self.name:<22} n={self.n:<7} {self.wall:7.2f}s {self.n / self.wall if self.wall else 0:9.1f}/s"
+        if self.lat:
+            out += "  p50={:.1f}ms p90={:.1f}ms p99={:.1f}ms max={:.1f}ms".format(
+                *(1000 * pct(self.lat, q) for q in (.5, .9, .99, 1)))
+        if self.extra:
+            out += "  " + " ".join(f"{k}={v}" for k, v in self.extra.items())
+        return out
+
+
+async def drive(app, updates, concurrency):
+    """process_update per ogni update con al massimo `concurrency` in volo; latenze per update."""
+    from telegram import Update
+    sem = aio.Semaphore(concurrency)
+    lat = []
+
+    async def one(data):
+        async with sem:
+            u = Update.de_json(data, app.bot)
+            t0 = time.perf_counter()
+            await app.update_processor.process_update(u, app.process_update(u))
+            lat.append(time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    await aio.gather(*(one(d) for d in updates))
+    return time.perf_counter() - t0, lat
+
+
+async def boot(mod):
+    app = mod.build_app()
+    await app.initialize()
+    await app.post_init(app)
+    await app.start()
+    return app
+
+
+async def halt(app):
+    await app.stop()
+    await app.shutdown()
+    await app.post_shutdown(app)
+
+
+def seed_users(mod, n, cols="user_id, username, first_name, joined"):
+    have = mod.DB.scalar("SELECT COUNT(*) FROM users", default=0)
+    if have < n:
+        rows = ((USER_BASE + i, f"u{i}", f"U{i}", "2024-01-01T00:00:00") for i in range(have, n))
+        mod.DB.executemany(f"INSERT OR IGNORE INTO users ({cols}) VALUES (?, ?, ?, ?)", rows)
+    mod.load_known_users()
+
+
+# ---------- scenari ----------
+async def sc_start(bot, fake, a):
+    """/start da utenti nuovi (registrazione + foto + home) e poi di ritorno."""
+    app = await boot(bot)
+    try:
+        res = []
+        for label, base in (("start new", 50_000_000), ("start returning", 50_000_000)):
+            await fake.reset()
+            wall, lat = await drive(app, [message(base + i, "/start") for i in range(a.storm)], a.concurrency)
+            res.append(Result(label, a.storm, wall, lat, api=await fake.total(), queued=bot.REG.pending))
+        return res
+    finally:
+        await halt(app)
+
+
+async def sc_callbacks(bot, fake, a):
+    """Raffica di bottoni: ogni utente naviga 8 pagine (sotto il burst anti-flood)."""
+    keys = [k for k in bot.PAGES._pages if k != "home"]
+    app = await boot(bot)
+    try:
+        await fake.reset()
+        dropped = bot.FLOOD.dropped
+        ups = [callback(60_000_000 + u, keys[(u + j) % len(keys)], photo=bool(j % 2))
+               for j in range(8) for u in range(a.storm // 8)]
+        wall, lat = await drive(app, ups, a.concurrency)
+        burst = [callback(70_000_000, keys[j % len(keys)]) for j in range(100)]   # un solo utente che martella
+        await drive(app, burst, 1)
+        return [Result("callbacks", len(ups), wall, lat, api=await fake.total(),
+                       flood_dropped=bot.FLOOD.dropped - dropped)]
+    finally:
+        await halt(app)
+
+
+async def sc_start2(bot2, fake, a):
+    app = await boot(bot2)
+    try:
+        await fake.reset()
+        wall, lat = await drive(app, [message(80_000_000 + i, "/start") for i in range(a.storm)], a.concurrency)
+        return [Result("bot2 start", a.storm, wall, lat, api=await fake.total())]
+    finally:
+        await halt(app)
+
+
+async def sc_spam2(bot2, fake, a):
+    """Ondata di messaggi non-admin in un gruppo: cancellazioni anti-share a lotti."""
+    group = {"id": -100123, "type": "supergroup", "title": "bench"}
+    app = await boot(bot2)
+    try:
+        await fake.reset()
+        ups = [message(90_000_000 + i % 50, f"spam {i}", chat=group) for i in range(a.storm)]
+        wall, lat = await drive(app, ups, a.concurrency)
+        while bot2.DELETES.pending:
+            await aio.sleep(0.1)
+        await aio.sleep(bot2.DELETES.window_ms / 1000 + 0.2)
+        return [Result("bot2 spam", a.storm, wall, lat, deleteMessages=await fake.total("deleteMessages"),
+                       deleteMessage=await fake.total("deleteMessage"))]
+    finally:
+        await halt(app)
+
+
+async def sc_broadcast(bot, fake, a):
+    seed_users(bot, a.users)
+    app = await boot(bot)
+    await fake.configure(forbidden_every=a.forbidden_every)   # solo qui: negli altri scenari si risponde a chi ha scritto
+    try:
+        await fake.reset()
+        total = bot.count_reachable()
+        t0 = time.perf_counter()
+        await drive(app, [message(ADMIN, "/broadcast bench")], 1)
+        job = bot.bcast_jobs()[-1]
+        while bot.bcast_job_get(job["id"])["status"] == "running":
+            await aio.sleep(0.2)
+        wall = time.perf_counter() - t0
+        job = bot.bcast_job_get(job["id"])
+        from metrics import API_SECONDS
+        q = {k: f"{1000 * API_SECONDS.quantile(v, 'sendMessage'):.0f}ms" for k, v in (("p50", .5), ("p99", .99))}
+        return [Result(f"broadcast {total}", job["sent"] + job["blocked"] + job["failed"], wall,
+                       sent=job["sent"], blocked=job["blocked"], failed=job["failed"],
+                       http429=await fake.total("sendMessage", "429"), **q)]
+    finally:
+        await fake.configure(forbidden_every=0)
+        await halt(app)
+
+
+async def sc_mixed(bot, fake, a):
+    """Bottoni durante un broadcast, con il bucket globale dello scheduler a --mixed-rate."""
+    from metrics import SCHED_WAIT
+    seed_users(bot, a.users)
+    app = await boot(bot)
+    sched = app.bot.request.scheduler
+    sched.rate = sched.burst = sched.tokens = a.mixed_rate
+    keys = [k for k in bot.PAGES._pages if k != "home"]
+    try:
+        await fake.reset()
+        await drive(app, [message(ADMIN, "/broadcast bench")], 1)
+        await aio.sleep(1)   # il broadcast riempie la corsia bulk
+        ups = [callback(65_000_000 + u, keys[u % len(keys)]) for u in range(a.storm)]
+        wall, lat = await drive(app, ups, a.concurrency)
+        app.bot_data["broadcast_stop"] = True
+        while app.bot_data.get("broadcast_running"):
+            await aio.sleep(0.1)
+        q = {f"{lane}_p95": f"{1000 * SCHED_WAIT.quantile(.95, 'bpfarm', lane):.0f}ms"
+             for lane in ("interactive", "bulk")}
+        return [Result(f"callbacks+bcast @{a.mixed_rate:g}/s", len(ups), wall, lat,
+                       bcast_sent=bot.bcast_jobs()[-1]["sent"], **q)]
+    finally:
+        await halt(app)
+
+
+async def sc_backup(bot, fake, a):
+    from backup_utils import incremental_backup
+    seed_users(bot, a.users)
+    app = await boot(bot)
+    res = []
+    try:
+        await fake.reset()
+        wall, lat = await drive(app, [message(ADMIN, "/backup")], 1)
+        size = bot.Path(bot.DB_FILE).stat().st_size
+        res.append(Result("/backup (db+zip)", 1, wall, lat, db_mb=f"{size / 2**20:.1f}"))
+
+        inc_dir = Path(bot.BACKUP_DIR) / "inc"
+        t0 = time.perf_counter()
+        e = incremental_backup(bot.DB_FILE, inc_dir, "users", "user_id")
+        res.append(Result("incremental full", 1, time.perf_counter() - t0, kind=e["kind"]))
+        bot.DB.execute("UPDATE users SET username = username || '_x' WHERE user_id % 100 = 0")
+        t0 = time.perf_counter()
+        e = incremental_backup(bot.DB_FILE, inc_dir, "users", "user_id")
+        res.append(Result("incremental delta 1%", 1, time.perf_counter() - t0, kind=e["kind"]))
+
+        snap = sorted(Path(bot.BACKUP_DIR).glob("backup_*.db"))[-1]
+        await fake.configure(files={"RESTORE": str(snap)})
+        doc = {"message_id": 1, "date": int(time.time()), "chat": {"id": ADMIN, "type": "private"},
+               "document": {"file_id": "RESTORE", "file_unique_id": "RESTORE", "file_name": snap.name}}
+        wall, lat = await drive(app, [message(ADMIN, "/restore_db", reply_to=doc)], 1)
+        res.append(Result("/restore_db merge", 1, wall, lat, users=bot.count_users()))
+        return res
+    finally:
+        await halt(app)
+
+
+async def sc_admin(bot, fake, a):
+    """/start di ritorno da soli e poi mentre l'admin lancia una raffica di /backup."""
+    seed_users(bot, a.users)
+    app = await boot(bot)
+    res = []
+    try:
+        ups = lambda: [message(USER_BASE + i, "/start") for i in range(a.storm)]
+        await fake.reset()
+        wall, lat = await drive(app, ups(), a.concurrency)
+        res.append(Result("start (solo utenti)", a.storm, wall, lat))
+        admin = aio.gather(*(drive(app, [message(ADMIN, "/backup")], 1) for _ in range(3)))
+        wall, lat = await drive(app, ups(), a.concurrency)
+        t0 = time.perf_counter()
+        await admin
+        res.append(Result("start (+3 /backup)", a.storm, wall, lat, admin_tail=f"{time.perf_counter() - t0:.1f}s"))
+        return res
+    finally:
+        await halt(app)
+
+
+async def sc_webhook(bot, fake, a):
+    """/start spinti via POST al WebhookServer locale, come Telegram; uno ogni
+    --bad-every con secret token sbagliato (deve tornare 403 e non arrivare al bot)."""
+    import aiohttp
+    from collections import Counter
+    from webhook import WebhookServer, SECRET_HEADER
+    secret, path = "bench-secret", "/telegram"
+    app = await boot(bot)
+    server = WebhookServer("127.0.0.1", a.webhook_port)
+    server.add_bot(app, path, secret)
+    await server.start()
+    try:
+        await fake.reset()
+        ups = [(message(55_000_000 + i, "/start"), a.bad_every and i % a.bad_every == 0) for i in range(a.storm)]
+        sem, lat, codes = aio.Semaphore(a.concurrency), [], Counter()
+        url = f"http://127.0.0.1:{a.webhook_port}{path}"
+        async with aiohttp.ClientSession() as s:
+            async def post(data, bad):
+                async with sem:
+                    t0 = time.perf_counter()
+                    async with s.post(url, json=data, headers={SECRET_HEADER: "wrong" if bad else secret}) as r:
+                        codes[r.status] += 1
+                    lat.append(time.perf_counter() - t0)
+            t0 = time.perf_counter()
+            await aio.gather(*(post(d, bad) for d, bad in ups))
+        deadline = time.monotonic() + 60   # gli update accettati vanno processati tutti (una foto per /start)
+        while await fake.total("sendPhoto") < codes[200] and time.monotonic() < deadline:
+            await aio.sleep(0.05)
+        wall = time.perf_counter() - t0
+        bad = sum(1 for _, b in ups if b)
+        return [Result("webhook POST", a.storm, wall, lat, ok=codes[200], forbidden=codes[403],
+                       expected_403=bad, received=server.received, rejected=server.rejected,
+                       sendPhoto=await fake.total("sendPhoto"))]
+    finally:
+        await server.stop()
+        await halt(app)
+
+
+# ---------- main ----------
+def load_bot(name, work: Path, a):
+    """Importa bot.py / bot2.py con DB e backup in una cartella temporanea."""
+    os.environ.update(
+        BOT_TOKEN="1:bench", ADMIN_ID=str(ADMIN), BOT_API_URL=os.environ["BOT_API_URL"],
+        DB_FILE=str(work / name / "users.db"), BACKUP_DIR=str(work / name / "backup"))
+    mod = importlib.import_module(name)
+    mod.init_db()
+    mod.load_known_users()
+    return mod
+
+
+async def main(a):
+    from bench.fakeapi import FakeProcess
+    fake = await FakeProcess(port=a.port, latency=a.latency / 1000, retry_rate=a.retry_rate,
+                             rate_cap=a.rate_cap).start()
+    os.environ["BOT_API_URL"] = fake.url
+    os.environ.setdefault("BCAST_RATE", str(a.bcast_rate))
+    for k in ("SCHED_RATE", "SCHED_CHAT_RATE", "SCHED_GROUP_RATE", "SCHED_CHAT_BURST"):
+        os.environ.setdefault(k, str(a.sched_rate))   # misura il bot, non i limiti Telegram
+    work = Path(tempfile.mkdtemp(prefix="bpfarm-bench-"))
+    results = []
+    try:
+        bot = load_bot("bot", work, a)
+        bot2 = load_bot("bot2", work, a) if {"start2", "spam2"} & set(a.scenarios) else None
+        for name in a.scenarios:
+            mod = bot2 if name.endswith("2") else bot
+            for r in await globals()[f"sc_{name}"](mod, fake, a):
+                print(r.line(), flush=True)
+                results.append(r)
+    finally:
+        await fake.stop()
+        if not a.keep:
+            shutil.rmtree(work, ignore_errors=True)
+    head = (f"# bench {time.strftime('%Y-%m-%d %H:%M:%S')} users={a.users} storm={a.storm} "
+            f"latency={a.latency}ms retry_rate={a.retry_rate} rate_cap={a.rate_cap} "
+            f"forbidden_every={a.forbidden_every} bcast_rate={os.environ['BCAST_RATE']} "
+            f"sched_rate={os.environ['SCHED_RATE']}")
+    with open(a.out, "a", encoding="utf-8") as f:
+        f.write("\n".join([head] + [r.line() for r in results]) + "\n\n")
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    p.add_argument("scenarios", nargs="*", metavar="scenario", help=f"uno o più tra {', '.join(SCENARIOS)}")
+    p.add_argument("--users", type=int, default=10_000, help="utenti sintetici per broadcast/backup")
+    p.add_argument("--storm", type=int, default=2_000, help="update per /start e callback")
+    p.add_argument("--concurrency", type=int, default=200, help="update in volo contemporaneamente")
+    p.add_argument("--latency", type=float, default=30, help="latenza simulata Bot API (ms)")
+    p.add_argument("--retry-rate", type=float, default=0.0, help="probabilità di 429 sugli invii")
+    p.add_argument("--rate-cap", type=int, default=0, help="invii/s oltre cui la Bot API risponde 429")
+    p.add_argument("--forbidden-every", type=int, default=50, help="chat_id multipli di N → 403")
+    p.add_argument("--bcast-rate", type=float, default=1000, help="BCAST_RATE per il broadcast (msg/s)")
+    p.add_argument("--sched-rate", type=float, default=1000, help="limiti dello scheduler in uscita (chiamate/s)")
+    p.add_argument("--mixed-rate", type=float, default=30, help="bucket globale dello scheduler nello scenario mixed")
+    p.add_argument("--port", type=int, default=8765, help="porta della Bot API finta")
+    p.add_argument("--webhook-port", type=int, default=8766, help="porta del WebhookServer nello scenario webhook")
+    p.add_argument("--bad-every", type=int, default=10, help="webhook: un POST ogni N con secret token errato (0 = mai)")
+    p.add_argument("--out", default="bench_output.txt")
+    p.add_argument("--keep", action="store_true", help="non cancellare la cartella di lavoro")
+    a = p.parse_args(argv)
+    a.scenarios = a.scenarios or list(SCENARIOS)
+    bad = set(a.scenarios) - set(SCENARIOS)
+    if bad:
+        p.error(f"scenari sconosciuti: {', '.join(sorted(bad))}")
+    return a
+
+
+if __name__ == "__main__":
+    sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+    aio.run(main(parse_args()))
@@ -6,16 +6,27 @@
 # - Tutto il resto invariato (menu, bottoni, broadcast, ecc.)
 # =====================================================
 
-import os, csv, shutil, logging, sqlite3, asyncio as aio, aiohttp, zipfile
+import os, logging, asyncio as aio, aiohttp
 from pathlib import Path
 from datetime import datetime, timezone, timedelta, date, time as dtime
-from collections import defaultdict
-from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, InputFile
+from itertools import chain
+from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, InputFile, InputMediaPhoto
 from telegram.ext import (
     ApplicationBuilder, CommandHandler, CallbackQueryHandler,
-    MessageHandler, ContextTypes, filters
+    TypeHandler, ApplicationHandlerStop, ContextTypes
 )
-from telegram.error import RetryAfter, Forbidden, BadRequest, NetworkError
+from telegram.error import BadRequest
+from broadcast import run_broadcast, BroadcastStats
+from db import Database, WriteBehind, IdSet
+from media_cache import MediaCache
+from flood import FloodLimiter
+from deletions import DeleteQueue
+from webhook import webhook_enabled, run_webhook, WebhookServer
+from metrics import instrument, summary as metrics_summary, METRICS_PORT
+from scheduler import scheduled_request, bulk, PRIORITY, BULK
+from dispatch import ChatOrderedProcessor
+from pages import PageRegistry, PARSE_MODES
+from backup_utils import is_sqlite_db, snapshot_db, export_csv, EXPORT_FORMAT, ensure_change_tracking, incremental_backup, rebuild_at, STAMP_FMT
 
 VERSION = "3.6.5-secure-full"
 
@@ -45,6 +56,7 @@ DB_FILE     = os.environ.get("DB_FILE", "./data/users.db")
 BACKUP_DIR  = os.environ.get("BACKUP_DIR", "./backup")
 BACKUP_TIME = os.environ.get("BACKUP_TIME", "03:00")
 RENDER_URL  = os.environ.get("RENDER_URL")
+BOT_API_URL = os.environ.get("BOT_API_URL", "https://api.telegram.org")   # Bot API server (self-hosted o finto per i benchmark)
 
 PHOTO_URL   = _txt("PHOTO_URL","https://i.postimg.cc/WbpGbTBH/5-F5-DFE41-C80-D-4-FC2-B4-F6-D105844664B3.jpg")
 CAPTION_MAIN= _txt("CAPTION_MAIN","🏆 *Benvenuto nel bot ufficiale di BPFARM!*\n⚡ Serietà e rispetto sono la nostra identità.\n💪 Qui si cresce con impegno e determinazione.")
@@ -62,46 +74,174 @@ PAGE_INFO_MEETUP   = _txt("PAGE_INFO_MEETUP", "🤝 *Info Meet-Up*\n(Testo non i
 PAGE_INFO_POINT    = _txt("PAGE_INFO_POINT", "📍🇮🇹 *Info Point*\n(Testo non impostato)")
 
 # ---------------- DB ----------------
+DB = Database(DB_FILE)   # connessione persistente WAL (db.py)
+
+MEDIA = MediaCache(DB)   # file_id delle immagini PHOTO_URL / INFO_BANNER_URL
+
 def init_db():
-    Path(DB_FILE).parent.mkdir(parents=True, exist_ok=True)
-    conn = sqlite3.connect(DB_FILE)
-    conn.execute("""CREATE TABLE IF NOT EXISTS users (
-        user_id INTEGER PRIMARY KEY,
-        username TEXT,
-        first_name TEXT,
-        last_name TEXT,
-        joined TEXT
-    )""")
-    try:
+    with DB.transaction() as conn:
+        conn.execute("""CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            joined TEXT
+        )""")
         cols = {r[1] for r in conn.execute("PRAGMA table_info('users')").fetchall()}
         if "joined" not in cols:
             conn.execute("ALTER TABLE users ADD COLUMN joined TEXT;")
-            conn.commit()
-    except Exception:
-        pass
-    conn.commit(); conn.close()
+        # salute destinatari: delivery = ok | blocked | deactivated
+        if "delivery" not in cols:
+            conn.execute("ALTER TABLE users ADD COLUMN delivery TEXT NOT NULL DEFAULT 'ok';")
+        if "last_ok" not in cols:
+            conn.execute("ALTER TABLE users ADD COLUMN last_ok TEXT;")
+        if "fail_count" not in cols:
+            conn.execute("ALTER TABLE users ADD COLUMN fail_count INTEGER NOT NULL DEFAULT 0;")
+        # (delivery, user_id): pagine keyset per stato (broadcast, ritest /esclusi) e conteggi solo da indice
+        conn.execute("DROP INDEX IF EXISTS idx_users_reachable")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_users_delivery ON users(delivery, user_id)")
+        conn.execute("""CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            mode TEXT NOT NULL,
+            text TEXT,
+            from_chat_id INTEGER,
+            message_id INTEGER,
+            status TEXT NOT NULL DEFAULT 'running',
+            cursor INTEGER NOT NULL DEFAULT 0,
+            total INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            panel_chat_id INTEGER,
+            panel_msg_id INTEGER,
+            created TEXT,
+            updated TEXT
+        )""")
+        # target: pubblico multi-bot (audience.py, solo modalità host); NULL = utenti di questo bot
+        if "target" not in {r[1] for r in conn.execute("PRAGMA table_info('broadcast_jobs')").fetchall()}:
+            conn.execute("ALTER TABLE broadcast_jobs ADD COLUMN target TEXT;")
+        # rev + trigger per i backup incrementali; last_ok/fail_count sono contabilità broadcast, non dati
+        ensure_change_tracking(conn, "users", "user_id",
+                               ("username", "first_name", "last_name", "joined", "delivery"))
+    MEDIA.init()
+
+# registrazioni /start: accodate e scritte a lotti (write-behind, db.py)
+# chi torna su /start ci ha sbloccato: rientra tra i raggiungibili
+REG = WriteBehind(DB, """INSERT INTO users
+    (user_id, username, first_name, last_name, joined)
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET delivery='ok', fail_count=0
+    WHERE users.delivery != 'ok'""")
+
+# cancellazioni nei gruppi raccolte per chat e inviate con deleteMessages (deletions.py)
+DELETES = DeleteQueue()
+
+# indice in memoria: utenti noti + non raggiungibili (per il reset su /start)
+KNOWN = IdSet()
+UNREACHABLE = set()
+
+def load_known_users():
+    KNOWN.load(uid for (uid,) in iter_users(cols=("user_id",)))
+    UNREACHABLE.clear()
+    UNREACHABLE.update(r[0] for r in DB.all("SELECT user_id FROM users WHERE delivery != 'ok'"))
+    log.info(f"[DB] indice utenti: {len(KNOWN)} noti, {len(UNREACHABLE)} esclusi")
 
 def add_user(u):
     if not u: return
-    conn = sqlite3.connect(DB_FILE)
-    conn.execute("""INSERT OR IGNORE INTO users 
-        (user_id, username, first_name, last_name, joined)
-        VALUES (?, ?, ?, ?, ?)""",
-        (u.id, u.username, u.first_name, u.last_name,
-         datetime.now(timezone.utc).isoformat()))
-    conn.commit(); conn.close()
+    if u.id in KNOWN and u.id not in UNREACHABLE: return   # utente già noto: zero lavoro DB
+    KNOWN.add(u.id); UNREACHABLE.discard(u.id)
+    REG.put((u.id, u.username, u.first_name, u.last_name,
+             datetime.now(timezone.utc).isoformat()))
 
 def count_users():
-    conn = sqlite3.connect(DB_FILE)
-    n = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
-    conn.close(); return n
-
-def get_all_users():
-    conn = sqlite3.connect(DB_FILE); conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-    cur.execute("SELECT user_id, username, first_name, last_name, joined FROM users ORDER BY joined ASC")
-    out = [dict(r) for r in cur.fetchall()]
-    conn.close(); return out
+    return len(KNOWN)
+
+USER_COLS  = ("user_id", "username", "first_name", "last_name", "joined")
+USER_BATCH = int(os.environ.get("USER_BATCH", "1000"))
+
+def iter_users(after=0, delivery=None, cols=USER_COLS, batch=USER_BATCH):
+    """Scorre gli utenti in ordine di user_id (PK) a pagine keyset di `batch` righe.
+
+    Memoria costante: nessuna lista dell'intera tabella, il primo lotto è
+    disponibile subito. `delivery` filtra sullo stato di salute (indice delivery, user_id).
+    """
+    where = "user_id > ?" if delivery is None else "delivery=? AND user_id > ?"
+    sql = f"SELECT {','.join(cols)} FROM users WHERE {where} ORDER BY user_id ASC LIMIT ?"
+    last = after
+    while True:
+        rows = DB.all(sql, (last, batch) if delivery is None else (delivery, last, batch))
+        if not rows: return
+        yield from rows
+        if len(rows) < batch: return
+        last = rows[-1][0]
+
+def iter_user_ids(after=0, delivery="ok"):
+    """user_id > after in ordine crescente; di default solo i raggiungibili."""
+    for (uid,) in iter_users(after, delivery, cols=("user_id",)):
+        yield uid
+
+def count_reachable():
+    return DB.scalar("SELECT COUNT(*) FROM users WHERE delivery='ok'", default=0)
+
+def health_report():
+    by = {r[0]: r[1] for r in DB.all("SELECT delivery, COUNT(*) FROM users GROUP BY delivery")}
+    flaky = DB.scalar("SELECT COUNT(*) FROM users WHERE delivery='ok' AND fail_count > 0", default=0)
+    return by, flaky
+
+def classify_failure(outcome, err):
+    """Esito broadcast → stato di salute (None = resta raggiungibile)."""
+    msg = str(err or "").lower()
+    if "deactivated" in msg or "chat not found" in msg: return "deactivated"
+    if outcome == "blocked": return "blocked"
+    return None
+
+def record_delivery(results):
+    """results: lista di (user_id, esito, errore) raccolti dal motore broadcast."""
+    if not results: return
+    now = datetime.now(timezone.utc).isoformat()
+    ok, dead, fail = [], [], []
+    for uid, outcome, err in results:
+        if outcome == "sent":
+            ok.append((now, uid))
+        else:
+            state = classify_failure(outcome, err)
+            if state: dead.append((state, uid))
+            else: fail.append((uid,))
+    UNREACHABLE.update(uid for _, uid in dead)
+    with DB.transaction() as conn:
+        conn.executemany("UPDATE users SET last_ok=?, fail_count=0 WHERE user_id=?", ok)
+        conn.executemany("UPDATE users SET delivery=?, fail_count=fail_count+1 WHERE user_id=?", dead)
+        conn.executemany("UPDATE users SET fail_count=fail_count+1 WHERE user_id=?", fail)
+
+# --- job broadcast persistenti (cursor = ultimo user_id confermato)
+BCAST_JOB_FIELDS = ("mode","text","from_chat_id","message_id","status","cursor","total",
+                    "sent","blocked","failed","panel_chat_id","panel_msg_id","target")
+
+def bcast_job_create(**fields):
+    fields = {k: v for k, v in fields.items() if k in BCAST_JOB_FIELDS}
+    now = datetime.now(timezone.utc).isoformat()
+    fields["created"] = fields["updated"] = now
+    cur = DB.execute(
+        f"INSERT INTO broadcast_jobs ({','.join(fields)}) VALUES ({','.join('?' * len(fields))})",
+        tuple(fields.values()))
+    return cur.lastrowid
+
+def bcast_job_update(job_id, **fields):
+    fields = {k: v for k, v in fields.items() if k in BCAST_JOB_FIELDS}
+    fields["updated"] = datetime.now(timezone.utc).isoformat()
+    DB.execute(f"UPDATE broadcast_jobs SET {','.join(k + '=?' for k in fields)} WHERE id=?",
+               (*fields.values(), job_id))
+
+def bcast_job_get(job_id):
+    r = DB.one("SELECT * FROM broadcast_jobs WHERE id=?", (job_id,))
+    return dict(r) if r else None
+
+def bcast_jobs(status=None):
+    if status:
+        rows = DB.all("SELECT * FROM broadcast_jobs WHERE status=? ORDER BY id ASC", (status,))
+    else:
+        rows = DB.all("SELECT * FROM broadcast_jobs ORDER BY id ASC")
+    return [dict(r) for r in rows]
 
 # ---------------- UTILS ----------------
 def is_admin(uid): return ADMIN_ID and uid == ADMIN_ID
@@ -119,30 +259,15 @@ def next_backup_utc():
 def last_backup_file():
     p=Path(BACKUP_DIR)
     if not p.exists(): return None
-    f=sorted(p.glob("*.db"),reverse=True)
-    return f[0] if f else None
-
-def is_sqlite_db(path: str):
-    p = Path(path)
-    if not p.exists():
-        return False, "Il file non esiste"
-    try:
-        with open(p, "rb") as f:
-            header = f.read(16)
-        if header != b"SQLite format 3\x00":
-            return False, "Header SQLite mancante"
-        conn = sqlite3.connect(path)
-        try:
-            conn.execute("SELECT 1")
-            conn.close()
-        except Exception as e:
-            conn.close()
-            return False, f"Query fallita: {e}"
-        return True, "OK"
-    except Exception as e:
-        return False, f"Errore lettura: {e}"
+    f=list(p.glob("backup_*.db"))+list(p.glob("inc_*"))
+    return max(f, key=lambda x: x.stat().st_mtime) if f else None
 
 # ---------------- TEXT SENDER ----------------
+SAFE_LEN = 3800   # unità UTF-16 per parte (limite Telegram 4096)
+
+def _not_modified(e): return "not modified" in str(e).lower()
+def _parse_error(e):  return "parse" in str(e).lower() or "entit" in str(e).lower()
+
 async def _send_one(context, chat_id, text, kb, mode):
     return await context.bot.send_message(
         chat_id,
@@ -153,29 +278,26 @@ async def _send_one(context, chat_id, text, kb, mode):
         protect_content=True
     )
 
-async def _send_long(context, chat_id, text, kb=None):
-    SAFE = 3800
-    parts = [text] if len(text) <= SAFE else []
-    if not parts:
-        cur = ""
-        for p in text.split("\n\n"):
-            if len(cur) + len(p) < SAFE:
-                cur += p + "\n\n"
-            else:
-                parts.append(cur); cur = p + "\n\n"
-        if cur: parts.append(cur)
+async def _with_mode(page, call):
+    """`call(mode)` col parse mode della pagina; se Telegram lo rifiuta si retrocede (e si ricorda)."""
+    mode = page.mode
+    while True:
+        try:
+            return await call(mode)
+        except BadRequest as e:
+            if mode is None or not _parse_error(e): raise
+            mode = PAGES.demote(page.key, mode) if page.key in PAGES else PARSE_MODES[PARSE_MODES.index(mode) + 1]
 
+async def send_page(context, chat_id, page):
+    """Invia le parti precompilate di `page`; la tastiera va sull'ultima."""
     last_msg = None
-    for i, pt in enumerate(parts):
-        last_kb = kb if i == len(parts) - 1 else None
-        for mode in ("Markdown", "HTML", None):
-            try:
-                last_msg = await _send_one(context, chat_id, pt, last_kb, mode)
-                break
-            except Exception as e:
-                log.warning(f"_send_long fallback ({mode}): {e}")
-                continue
-        await aio.sleep(0.05)
+    for i, pt in enumerate(page.parts):
+        last_kb = page.kb if i == len(page.parts) - 1 else None
+        try:
+            last_msg = await _with_mode(page, lambda mode: _send_one(context, chat_id, pt, last_kb, mode))
+        except Exception as e:
+            log.warning(f"send_page {page.key}: {e}")
+        if len(page.parts) > 1: await aio.sleep(0.05)
     return last_msg
 
 # ---------------- KEYBOARDS ----------------
@@ -205,70 +327,128 @@ def kb_info_menu():
         [InlineKeyboardButton("🔙 Back",callback_data="info_root")]
     ])
 
+# ---------------- PAGINE (compilate una volta, chiave = callback_data) ----------------
+PAGES = PageRegistry(SAFE_LEN)
+
+def _file_src(key):
+    v = os.environ.get(key, "")
+    return v[7:] if v.startswith("file://") else None
+
+def build_pages():
+    home, info_root, info_menu = kb_home(), kb_info_root(), kb_info_menu()
+    back_home = kb_back("home")
+    info_title = "ℹ️ *Info — Centro informativo BPFAM*"
+    PAGES.add("home",       PAGE_MAIN,          home,            path=_file_src("PAGE_MAIN"))
+    PAGES.add("menu",       PAGE_MENU,          back_home,       path=_file_src("PAGE_MENU"))
+    PAGES.add("ship",       PAGE_SHIPSPAGNA,    back_home,       path=_file_src("PAGE_SHIPSPAGNA"))
+    PAGES.add("recs",       PAGE_RECENSIONI,    back_home,       path=_file_src("PAGE_RECENSIONI"))
+    PAGES.add("points",     PAGE_POINTATTIVI,   back_home,       path=_file_src("PAGE_POINTATTIVI"))
+    PAGES.add("info_root",  info_title,         info_root,
+              photo=("INFO_BANNER_URL", INFO_BANNER_URL) if INFO_BANNER_URL else None)
+    PAGES.add("contacts",   PAGE_CONTACTS_TEXT, kb_back("info_root"), path=_file_src("PAGE_CONTACTS_TEXT"))
+    PAGES.add("info_menu",  PAGE_INFO_MENU,     info_menu,       path=_file_src("PAGE_INFO_MENU"))
+    PAGES.add("info_del",   PAGE_INFO_DELIVERY, info_menu,       path=_file_src("PAGE_INFO_DELIVERY"))
+    PAGES.add("info_meet",  PAGE_INFO_MEETUP,   info_menu,       path=_file_src("PAGE_INFO_MEETUP"))
+    PAGES.add("info_point", PAGE_INFO_POINT,    info_menu,       path=_file_src("PAGE_INFO_POINT"))
+
+build_pages()
+
 # ---------------- SWITCH PANNELLO ----------------
-async def switch_to_photo(context, chat_id, old_id, url, caption, kb):
+async def switch_to_photo(context, chat_id, old_id, page):
     try: await context.bot.delete_message(chat_id,old_id)
     except: pass
+    key, url = page.photo
     try:
-        sent = await context.bot.send_photo(chat_id,photo=url,
-            caption=caption,parse_mode="Markdown",
-            reply_markup=kb,protect_content=True)
+        sent = await MEDIA.send_photo(key, url, lambda photo: _with_mode(page, lambda mode: context.bot.send_photo(
+            chat_id,photo=photo,caption=page.parts[0],parse_mode=mode,
+            reply_markup=page.kb,protect_content=True)))
         return sent.message_id
     except Exception:
-        await switch_to_text(context,chat_id,old_id,caption,kb)
-        return None
+        sent = await send_page(context,chat_id,page)
+        return getattr(sent, "message_id", None)
 
-async def switch_to_text(context, chat_id, old_id, text, kb):
+async def switch_to_text(context, chat_id, old_id, page):
     try: await context.bot.delete_message(chat_id,old_id)
     except: pass
-    sent = await _send_long(context,chat_id,text,kb)
+    sent = await send_page(context,chat_id,page)
     return getattr(sent, "message_id", None)
 
+# ---------------- EDIT IN PLACE ----------------
+# Navigazione: si modifica il pannello esistente (1 chiamata API); delete+send
+# solo se cambia il tipo di messaggio (testo ↔ foto) o la pagina ha più parti.
+async def show_text(context, msg, page):
+    cid, mid = msg.chat_id, msg.message_id
+    if not msg.photo and len(page.parts) == 1:
+        try:
+            await _with_mode(page, lambda mode: context.bot.edit_message_text(
+                page.parts[0], chat_id=cid, message_id=mid,
+                parse_mode=mode, disable_web_page_preview=True, reply_markup=page.kb))
+            return mid
+        except BadRequest as e:
+            if _not_modified(e): return mid
+        except Exception:
+            pass
+    return await switch_to_text(context, cid, mid, page)
+
+async def show_photo(context, msg, page):
+    cid, mid = msg.chat_id, msg.message_id
+    if msg.photo:
+        key, url = page.photo
+        try:
+            sent = await MEDIA.send_photo(key, url, lambda photo: _with_mode(page, lambda mode: context.bot.edit_message_media(
+                InputMediaPhoto(photo, caption=page.parts[0], parse_mode=mode),
+                chat_id=cid, message_id=mid, reply_markup=page.kb)))
+            return getattr(sent, "message_id", mid)
+        except BadRequest as e:
+            if _not_modified(e): return mid
+        except Exception:
+            pass
+    return await switch_to_photo(context, cid, mid, page)
+
 # ---------------- HANDLERS PUBBLICI ----------------
 async def start(update,context):
     add_user(update.effective_user)
     try:
-        await update.message.reply_photo(photo=PHOTO_URL,caption=CAPTION_MAIN,
-                                         parse_mode="Markdown",protect_content=True)
+        await MEDIA.send_photo("PHOTO_URL", PHOTO_URL, lambda photo: update.message.reply_photo(
+            photo=photo,caption=CAPTION_MAIN,parse_mode="Markdown",protect_content=True))
     except:
         await update.message.reply_text(CAPTION_MAIN,parse_mode="Markdown",protect_content=True)
-    await _send_long(context,update.effective_chat.id,PAGE_MAIN,kb_home())
+    await send_page(context,update.effective_chat.id,PAGES.get("home"))
+
+async def _answer(q):
+    try: await q.answer()
+    except Exception: pass
 
 async def cb_router(update,context):
     q=update.callback_query
     if not q:return
-    await q.answer()
-    c=q.data; cid=q.message.chat_id; mid=q.message.message_id
-    if c=="home":   await switch_to_text(context,cid,mid,PAGE_MAIN,kb_home());return
-    if c=="menu":   await switch_to_text(context,cid,mid,PAGE_MENU,kb_back("home"));return
-    if c=="ship":   await switch_to_text(context,cid,mid,PAGE_SHIPSPAGNA,kb_back("home"));return
-    if c=="recs":   await switch_to_text(context,cid,mid,PAGE_RECENSIONI,kb_back("home"));return
-    if c=="points": await switch_to_text(context,cid,mid,PAGE_POINTATTIVI,kb_back("home"));return
-    if c=="info_root":
-        if INFO_BANNER_URL:
-            await switch_to_photo(context,cid,mid,INFO_BANNER_URL,"ℹ️ *Info — Centro informativo BPFAM*",kb_info_root())
-        else:
-            await switch_to_text(context,cid,mid,"ℹ️ *Info — Centro informativo BPFAM*",kb_info_root())
-        return
-    if c=="contacts":  await switch_to_text(context,cid,mid,PAGE_CONTACTS_TEXT,kb_back("info_root"));return
-    if c=="info_menu": await switch_to_text(context,cid,mid,PAGE_INFO_MENU,kb_info_menu());return
-    if c=="info_del":  await switch_to_text(context,cid,mid,PAGE_INFO_DELIVERY,kb_info_menu());return
-    if c=="info_meet": await switch_to_text(context,cid,mid,PAGE_INFO_MEETUP,kb_info_menu());return
-    if c=="info_point":await switch_to_text(context,cid,mid,PAGE_INFO_POINT,kb_info_menu());return
+    context.application.create_task(_answer(q))   # fuori dal percorso critico
+    page = PAGES.get(q.data)
+    if not page or not q.message: return
+    if page.photo: await show_photo(context,q.message,page)
+    else:          await show_text(context,q.message,page)
 
 # ---------------- ANTI-FLOOD ----------------
-USER_MSG_COUNT = defaultdict(int)
-async def flood_guard(update, context):
-    uid = update.effective_user.id
-    USER_MSG_COUNT[uid] += 1
-    if USER_MSG_COUNT[uid] > 10:  # >10 msg in 10s
-        try:
-            await context.bot.send_message(uid, "⛔ Flood rilevato. Attendi 10 secondi.")
-        except: pass
-        USER_MSG_COUNT[uid] = 0
+FLOOD = FloodLimiter()
+async def _flood_notice(update, context):
+    text = "⛔ Flood rilevato. Rallenta qualche secondo."
+    try:
+        if update.callback_query: await update.callback_query.answer(text)
+        else:
+            with bulk():   # l'avviso non deve rubare slot alle risposte vere
+                await context.bot.send_message(update.effective_user.id, text)
+    except Exception: pass
 
-async def reset_flood(context):
-    USER_MSG_COUNT.clear()
+async def flood_guard(update, context):
+    """Gruppo -1: l'update di chi supera il limite non arriva agli altri handler."""
+    user = update.effective_user
+    if not user or is_admin(user.id): return
+    ok, notify = FLOOD.hit(user.id)
+    if ok: return
+    if notify: context.application.create_task(_flood_notice(update, context))
+    elif update.callback_query:   # risposta muta: il bottone non resta in caricamento
+        context.application.create_task(_answer(update.callback_query))
+    raise ApplicationHandlerStop
 
 # ---------------- ADMIN ----------------
 def admin_only(update):
@@ -279,7 +459,9 @@ async def status_cmd(update,context):
     now=datetime.now(timezone.utc)
     nxt=next_backup_utc(); last=last_backup_file()
     await update.message.reply_text(
-        f"🔎 Stato bot v{VERSION}\nUTC {now:%H:%M}\nUtenti {count_users()}\nUltimo backup {last.name if last else 'nessuno'}\nProssimo {nxt:%H:%M}",
+        f"🔎 Stato bot v{VERSION}\nUTC {now:%H:%M}\nUtenti {count_users()}\n"
+        f"Ultima modifica dati {DB.scalar('SELECT changed_at FROM _backup_gen WHERE id=1') or 'n/d'}\n"
+        f"Ultimo backup {last.name if last else 'nessuno'}\nProssimo {nxt:%H:%M}",
         protect_content=True)
 
 # --- /diag
@@ -287,12 +469,11 @@ async def diag_cmd(update, context):
     if not admin_only(update): return
     ok, why = is_sqlite_db(DB_FILE)
     size = Path(DB_FILE).stat().st_size if Path(DB_FILE).exists() else 0
-    rows = 0
+    rows = 0; journal = "?"
     try:
-        conn = sqlite3.connect(DB_FILE)
-        has = conn.execute("SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name='users'").fetchone()[0]
-        rows = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0] if has else 0
-        conn.close()
+        has = DB.scalar("SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name='users'")
+        rows = DB.scalar("SELECT COUNT(*) FROM users") if has else 0
+        journal = DB.scalar("PRAGMA journal_mode")
     except Exception:
         pass
     txt = (
@@ -303,9 +484,55 @@ async def diag_cmd(update, context):
         f"Valido: {'sì' if ok else 'no'} ({why})\n"
         f"Dimensione: {size} byte\n"
         f"Righe users: {rows}\n"
+        f"Journal: {journal}\n"
+        f"Registrazioni in coda: {REG.pending} (scritte: {REG.flushed})\n"
+        f"Anti-flood: {len(FLOOD)} utenti tracciati, {FLOOD.dropped} update scartati\n"
     )
     await update.message.reply_text(txt, protect_content=True)
 
+async def stats_cmd(update, context):
+    if not admin_only(update): return
+    await update.message.reply_text(metrics_summary("bpfarm"), protect_content=True)
+
+# --- pipeline backup: snapshot (backup API a step) + zip + sha256 in un worker thread
+BACKUP_PROGRESS_SEC = 3
+
+async def make_backup(with_zip=True, panel=None):
+    """Esegue backup_utils.snapshot_db fuori dall'event loop; aggiorna `panel` con l'avanzamento."""
+    Path(BACKUP_DIR).mkdir(parents=True, exist_ok=True)
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%d_%H%M%S")
+    db_out  = Path(BACKUP_DIR)/f"backup_{stamp}.db"
+    zip_out = Path(BACKUP_DIR)/f"backup_{stamp}.zip" if with_zip else None
+    state = {"pct": 0}
+    def progress(status, remaining, total):   # chiamata dal worker thread
+        if total: state["pct"] = 100 * (total - remaining) // total
+    job = aio.ensure_future(aio.to_thread(snapshot_db, DB_FILE, db_out, zip_out, progress))
+    return await _with_panel(job, panel, lambda: f"⏳ Backup in corso… {state['pct']}%" if state["pct"] < 100 else "⏳ Compressione…")
+
+async def _with_panel(job, panel, text):
+    """Attende `job` (future di un worker thread) aggiornando `panel` con text() quando cambia."""
+    shown = None
+    while not job.done():
+        await aio.wait({job}, timeout=BACKUP_PROGRESS_SEC)
+        if panel and not job.done() and text() != shown:
+            shown = text()
+            try: await panel.edit_text(shown)
+            except Exception: pass
+    return job.result()
+
+def rotate_backup_files(days=7):
+    now = datetime.now(timezone.utc)
+    for f in Path(BACKUP_DIR).glob("backup_*.db"):
+        try:
+            ts = datetime.strptime("_".join(f.stem.split("_")[1:]), "%Y%m%d_%H%M%S").replace(tzinfo=timezone.utc)
+            if (now - ts).days > days:
+                f.unlink(missing_ok=True)
+        except:
+            pass
+
+def _backup_done_text(info):
+    return f"✅ Snapshot pronto: {info['db'].name}\n{info['size']} byte — SHA-256 {info['sha256'][:16]}…"
+
 # --- /backup: usa stream espliciti (iOS friendly)
 async def backup_cmd(update, context):
     if not admin_only(update): return
@@ -314,14 +541,11 @@ async def backup_cmd(update, context):
         await update.message.reply_text(f"⚠️ DB non valido: {why}\nControlla Disk/variabili. Backup annullato.")
         return
     try:
-        Path(BACKUP_DIR).mkdir(parents=True, exist_ok=True)
-        stamp = datetime.now(timezone.utc).strftime("%Y%m%d_%H%M%S")
-        db_out  = Path(BACKUP_DIR)/f"backup_{stamp}.db"
-        zip_out = Path(BACKUP_DIR)/f"backup_{stamp}.zip"
-
-        shutil.copy2(DB_FILE, db_out)
-        with zipfile.ZipFile(zip_out, 'w', compression=zipfile.ZIP_DEFLATED) as z:
-            z.write(db_out, arcname=db_out.name)
+        panel = await update.message.reply_text("⏳ Backup in corso…")
+        info = await make_backup(with_zip=True, panel=panel)
+        db_out, zip_out = info["db"], info["zip"]
+        try: await panel.edit_text(_backup_done_text(info))
+        except Exception: pass
 
         # invio .db (stream)
         try:
@@ -356,13 +580,11 @@ async def backup_zip_cmd(update, context):
         await update.message.reply_text(f"⚠️ DB non valido: {why}\nControlla Disk/variabili. Backup annullato.")
         return
     try:
-        Path(BACKUP_DIR).mkdir(parents=True, exist_ok=True)
-        stamp = datetime.now(timezone.utc).strftime("%Y%m%d_%H%M%S")
-        db_out  = Path(BACKUP_DIR)/f"backup_{stamp}.db"
-        zip_out = Path(BACKUP_DIR)/f"backup_{stamp}.zip"
-        shutil.copy2(DB_FILE, db_out)
-        with zipfile.ZipFile(zip_out, 'w', compression=zipfile.ZIP_DEFLATED) as z:
-            z.write(db_out, arcname=db_out.name)
+        panel = await update.message.reply_text("⏳ Backup in corso…")
+        info = await make_backup(with_zip=True, panel=panel)
+        zip_out = info["zip"]
+        try: await panel.edit_text(_backup_done_text(info))
+        except Exception: pass
         with open(zip_out, "rb") as fh:
             await update.message.reply_document(
                 document=InputFile(fh, filename=zip_out.name),
@@ -372,30 +594,28 @@ async def backup_zip_cmd(update, context):
     except Exception as e:
         await update.message.reply_text(f"❌ Errore backup_zip: {e}")
 
-# --- Backup automatico + rotazione 7gg
+# --- Backup automatico incrementale (base ogni BACKUP_FULL_EVERY giorni + delta, manifest.json)
 async def backup_job(context):
+    PRIORITY.set(BULK)   # ogni job gira nel proprio task
     try:
-        Path(BACKUP_DIR).mkdir(parents=True,exist_ok=True)
-        stamp = datetime.now(timezone.utc).strftime("%Y%m%d_%H%M%S")
-        out=Path(BACKUP_DIR)/f"backup_{stamp}.db"
-        shutil.copy2(DB_FILE,out)
-
-        now = datetime.now(timezone.utc)
-        for f in Path(BACKUP_DIR).glob("backup_*.db"):
-            try:
-                ts = datetime.strptime("_".join(f.stem.split("_")[1:]), "%Y%m%d_%H%M%S")
-                if (now - ts).days > 7:
-                    f.unlink(missing_ok=True)
-            except:
-                pass
-
-        if ADMIN_ID:
+        entry = await aio.to_thread(incremental_backup, DB_FILE, BACKUP_DIR, "users", "user_id")
+        out = entry["path"]
+        await aio.to_thread(rotate_backup_files)   # backup manuali oltre 7gg
+        log.info(f"[BACKUP] {entry['kind']} {out.name}: {entry['rows']} righe, {entry['size']} byte")
+
+        if ADMIN_ID and entry["kind"] == "ref":
+            await context.bot.send_message(ADMIN_ID, f"✅ Backup notturno: nessuna modifica dal {entry['ref']} UTC (riferimento a {out.name}).")
+        elif ADMIN_ID:
+            if entry["kind"] == "full":
+                caption = f"✅ Backup completo (base): {out.name}"
+            else:
+                caption = f"✅ Backup incrementale: {out.name}\n+{entry['rows']} righe modificate, {entry['deleted']} rimosse"
             try:
                 with open(out, "rb") as fh:
                     await context.bot.send_document(
                         chat_id=ADMIN_ID,
                         document=InputFile(fh, filename=out.name),
-                        caption=f"✅ Backup completato: {out.name}",
+                        caption=f"{caption}\nSHA-256 {entry['sha256'][:16]}…",
                         protect_content=False
                     )
             except Exception as e:
@@ -407,6 +627,83 @@ async def backup_job(context):
                 await context.bot.send_message(ADMIN_ID, f"❌ Errore backup notturno: {e}")
         except: pass
 
+# --- /backup_rebuild [YYYYmmdd_HHMMSS]: ricostruisce da base + delta
+async def backup_rebuild_cmd(update, context):
+    if not admin_only(update): return
+    target = context.args[0] if context.args else None
+    if target:
+        try: datetime.strptime(target, STAMP_FMT)
+        except ValueError:
+            await update.message.reply_text("Uso: /backup_rebuild [YYYYmmdd_HHMMSS] (UTC)"); return
+    panel = await update.message.reply_text("⏳ Ricostruzione in corso…")
+    dest = Path(BACKUP_DIR)/f"rebuild_{target or 'latest'}.db"
+    try:
+        res = await aio.to_thread(rebuild_at, BACKUP_DIR, dest, target)
+        try: await panel.edit_text(f"✅ Stato al {res['stamp']} (base + {res['applied']} delta)")
+        except Exception: pass
+        with open(dest, "rb") as fh:
+            await update.message.reply_document(
+                document=InputFile(fh, filename=dest.name),
+                caption="Rispondi a questo file con /restore_db per importarlo.",
+                protect_content=False
+            )
+    except Exception as e:
+        await update.message.reply_text(f"❌ Errore ricostruzione: {e}")
+    finally:
+        dest.unlink(missing_ok=True)
+
+# --- merge di un DB importato dentro SQLite: ATTACH + upsert a lotti per user_id
+MERGE_BATCH = int(os.environ.get("MERGE_BATCH", "5000"))
+MERGE_COLS = ("username", "first_name", "last_name")
+
+def merge_import(path, progress=None, batch=MERGE_BATCH):
+    """Unisce imp.users in users a lotti (bloccante: da eseguire con asyncio.to_thread).
+
+    Ogni lotto è una transazione breve: tra un lotto e l'altro il lock del DB
+    torna libero per registrazioni e handler. Conteggi nuovi / aggiornati /
+    invariati calcolati in SQL sullo stesso intervallo prima dell'upsert; le
+    righe invariate non vengono riscritte (niente rev inutili nei backup).
+    `progress(fatte, totale)`; il report include il totale delle righe importate.
+    """
+    now_iso = datetime.now(timezone.utc).isoformat()
+    DB.execute("ATTACH DATABASE ? AS imp", (str(path),))
+    try:
+        cols = {r[1] for r in DB.all("PRAGMA imp.table_info('users')")}
+        if "user_id" not in cols:
+            raise RuntimeError("colonna user_id mancante nel file importato")
+        src = ", ".join(f"i.{c}" if c in cols else "NULL" for c in MERGE_COLS)
+        joined = "COALESCE(i.joined, :now)" if "joined" in cols else ":now"
+        differs = " OR ".join(f"COALESCE(i.{c}, m.{c}) IS NOT m.{c}" for c in MERGE_COLS if c in cols) or "0"
+        changed = " OR ".join(f"COALESCE(excluded.{c}, users.{c}) IS NOT users.{c}" for c in MERGE_COLS) or "0"
+        rng = "i.user_id > :lo AND i.user_id <= :hi"
+        count_sql = f"""SELECT COUNT(*), SUM(m.user_id IS NULL), SUM(m.user_id IS NOT NULL AND ({differs}))
+            FROM imp.users i LEFT JOIN main.users m ON m.user_id = i.user_id WHERE {rng}"""
+        upsert_sql = f"""INSERT INTO main.users (user_id, {", ".join(MERGE_COLS)}, joined)
+            SELECT i.user_id, {src}, {joined} FROM imp.users i WHERE {rng} ORDER BY i.user_id
+            ON CONFLICT(user_id) DO UPDATE SET
+                username   = COALESCE(excluded.username,   users.username),
+                first_name = COALESCE(excluded.first_name, users.first_name),
+                last_name  = COALESCE(excluded.last_name,  users.last_name)
+            WHERE {changed}"""
+        total = DB.scalar("SELECT COUNT(*) FROM imp.users", default=0)
+        rep = {"total": total, "new": 0, "updated": 0, "unchanged": 0}
+        if progress: progress(0, total)
+        lo, done = DB.scalar("SELECT MIN(user_id) - 1 FROM imp.users"), 0
+        while lo is not None:
+            hi = DB.scalar("SELECT user_id FROM imp.users WHERE user_id > ? ORDER BY user_id LIMIT 1 OFFSET ?",
+                           (lo, batch - 1)) or DB.scalar("SELECT MAX(user_id) FROM imp.users")
+            if hi is None or hi <= lo:
+                break
+            with DB.transaction() as conn:
+                n, new, upd = conn.execute(count_sql, {"lo": lo, "hi": hi}).fetchone()
+                conn.execute(upsert_sql, {"lo": lo, "hi": hi, "now": now_iso})
+            rep["new"] += new or 0; rep["updated"] += upd or 0; rep["unchanged"] += n - (new or 0) - (upd or 0)
+            done += n; lo = hi
+            if progress: progress(done, total)
+        return rep
+    finally:
+        DB.execute("DETACH DATABASE imp")
+
 # --- /restore_db: MERGE robusto (ignora estensione, controlla header)
 async def restore_db(update, context):
     if not admin_only(update): return
@@ -422,73 +719,57 @@ async def restore_db(update, context):
     tg_file = await d.get_file()
     await tg_file.download_to_drive(custom_path=str(tmp))
 
-    ok_imp, why_imp = is_sqlite_db(str(tmp))
+    # header e tabella users nel thread; il conteggio lo fa merge_import
+    ok_imp, why_imp = await aio.to_thread(is_sqlite_db, str(tmp), False, "users")
     if not ok_imp:
         await update.message.reply_text(f"❌ Il file caricato non è un DB SQLite valido: {why_imp}")
         tmp.unlink(missing_ok=True)
         return
 
+    panel = await update.message.reply_text("⏳ Merge in corso…", protect_content=True)
+    state = {"done": 0, "total": "?"}
+    def progress(done, total): state.update(done=done, total=total)   # chiamata dal worker thread
     try:
-        main = sqlite3.connect(DB_FILE)
-        imp  = sqlite3.connect(tmp)
-
-        main.execute("""CREATE TABLE IF NOT EXISTS users(
-            user_id INTEGER PRIMARY KEY,
-            username TEXT,
-            first_name TEXT,
-            last_name  TEXT,
-            joined     TEXT
-        )""")
-        main.commit()
-
-        cols_imp = {r[1] for r in imp.execute("PRAGMA table_info('users')").fetchall()}
-        if "joined" in cols_imp:
-            rows = imp.execute("SELECT user_id,username,first_name,last_name,joined FROM users").fetchall()
-        else:
-            rows = [(uid, un, fn, ln, None) for (uid, un, fn, ln) in
-                    imp.execute("SELECT user_id,username,first_name,last_name FROM users").fetchall()]
-
-        before = main.execute("SELECT COUNT(*) FROM users").fetchone()[0]
-        now_iso = datetime.now(timezone.utc).isoformat()
-
-        sql = """
-        INSERT INTO users (user_id, username, first_name, last_name, joined)
-        VALUES (?, ?, ?, ?, ?)
-        ON CONFLICT(user_id) DO UPDATE SET
-            username   = COALESCE(excluded.username, users.username),
-            first_name = COALESCE(excluded.first_name, users.first_name),
-            last_name  = COALESCE(excluded.last_name,  users.last_name)
-        """
-        payload = [(uid, un, fn, ln, jn or now_iso) for (uid, un, fn, ln, jn) in rows]
-        main.executemany(sql, payload)
-        main.commit()
-
-        after = main.execute("SELECT COUNT(*) FROM users").fetchone()[0]
-        await update.message.reply_text(f"✅ Merge completato.\n👥 Totale: {after} (+{after-before})",protect_content=True)
+        job = aio.ensure_future(aio.to_thread(merge_import, tmp, progress))
+        rep = await _with_panel(job, panel, lambda: f"⏳ Merge in corso… {state['done']}/{state['total']}")
+        await aio.to_thread(load_known_users)
+        after = count_users()
+        await panel.edit_text(
+            f"✅ Merge completato.\n👥 Totale: {after} (+{rep['new']})\n"
+            f"Nuovi: {rep['new']} · Aggiornati: {rep['updated']} · Invariati: {rep['unchanged']}")
     except Exception as e:
-        await update.message.reply_text(f"❌ Errore merge DB: {e}",protect_content=True)
+        log.exception(f"[RESTORE] merge fallito: {e}")
+        try: await panel.edit_text(f"❌ Errore merge DB: {e}")
+        except Exception: pass
     finally:
-        try: imp.close()
-        except: pass
-        try: main.close()
-        except: pass
         try: tmp.unlink(missing_ok=True)
         except: pass
 
 # --- /utenti
 async def utenti_cmd(update, context):
+    """Totale + export CSV compresso in streaming (a parti sotto il limite upload). /utenti [zip|gz]"""
     if not admin_only(update): return
-    users = get_all_users()
-    n = len(users)
-    Path(BACKUP_DIR).mkdir(parents=True, exist_ok=True)
-    csv_path = Path(BACKUP_DIR)/f"users_{datetime.now(timezone.utc):%Y%m%d_%H%M%S}.csv"
-    with open(csv_path, "w", newline="", encoding="utf-8") as f:
-        w = csv.writer(f); w.writerow(["user_id","username","first_name","last_name","joined"])
-        for u in users:
-            w.writerow([u["user_id"], u["username"] or "", u["first_name"] or "", u["last_name"] or "", u["joined"] or ""])
-    await update.message.reply_text(f"👥 Utenti totali: {n}", protect_content=True)
-    with open(csv_path, "rb") as fh:
-        await update.message.reply_document(document=InputFile(fh, filename=csv_path.name), protect_content=True)
+    fmt = context.args[0] if context.args and context.args[0] in ("zip", "gz") else EXPORT_FORMAT
+    n = count_users()
+    panel = await update.message.reply_text(f"👥 Utenti totali: {n}\n⏳ Export CSV…", protect_content=True)
+    out = Path(BACKUP_DIR)/f"users_{datetime.now(timezone.utc):%Y%m%d_%H%M%S}"
+    state = {"rows": 0}
+    def progress(rows): state["rows"] = rows                     # chiamata dal worker thread
+    job = aio.ensure_future(aio.to_thread(
+        export_csv, DB_FILE, f"SELECT {', '.join(USER_COLS)} FROM users ORDER BY user_id", out,
+        fmt=fmt, progress=progress))
+    try:
+        parts = await _with_panel(job, panel, lambda: f"👥 Utenti totali: {n}\n⏳ Export CSV… {state['rows']}/{n} righe")
+    except Exception as e:
+        await panel.edit_text(f"❌ Errore export: {e}"); return
+    rows = sum(p["rows"] for p in parts)
+    try: await panel.edit_text(f"👥 Utenti totali: {n}\n✅ Export: {rows} righe in {len(parts)} file")
+    except Exception: pass
+    for i, p in enumerate(parts, 1):
+        caption = f"Parte {i}/{len(parts)} — {p['rows']} righe" if len(parts) > 1 else f"{p['rows']} righe"
+        with open(p["path"], "rb") as fh:
+            await update.message.reply_document(document=InputFile(fh, filename=p["path"].name),
+                                                caption=caption, protect_content=True)
 
 # --- /help
 async def help_cmd(update, context):
@@ -497,89 +778,251 @@ async def help_cmd(update, context):
         f"<b>🛡 Pannello Admin — v{VERSION}</b>\n\n"
         "/status — stato bot / utenti / backup\n"
         "/diag — diagnostica DB/storage\n"
+        "/stats — latenze handler, chiamate API, SQLite\n"
         "/backup — backup immediato (.db + .zip)\n"
         "/backup_zip — solo ZIP (iOS friendly)\n"
         "/restore_db — rispondi al riquadro 'Backup .db: ...'\n"
-        "/utenti — totale e CSV degli utenti\n"
+        "/backup_rebuild [YYYYmmdd_HHMMSS] — ricostruisce da base + delta\n"
+        "/utenti [zip|gz] — totale e CSV compresso degli utenti\n"
+        "/esclusi [retest] — utenti bloccati/disattivati\n"
         "/broadcast <testo> — invia a tutti\n"
         "/broadcast (in reply) — copia contenuto a tutti\n"
-        "/broadcast_stop — interrompe l'invio"
+        "/broadcast_to &lt;target&gt; &lt;testo&gt; — pubblico di più bot (host)\n"
+        "/broadcast_stop — mette in pausa l'invio\n"
+        "/broadcast_resume [id] — riprende un broadcast in pausa"
     )
     await update.message.reply_text(msg, parse_mode="HTML", protect_content=True)
 
-# --- /broadcast
-BCAST_SLEEP = 0.08
+# --- /broadcast (motore concorrente in broadcast.py, job persistiti nel DB)
 BCAST_PROGRESS_EVERY = 200
 
+def _bcast_text(job, head):
+    return (f"{head} (job #{job['id']})\nTotali: {job['total']}\nInviati: {job['sent']}\n"
+            f"Bloccati: {job['blocked']}\nErrori: {job['failed']}")
+
+async def _bcast_panel(bot, job, head):
+    if not job.get("panel_chat_id"): return
+    try:
+        await bot.edit_message_text(_bcast_text(job, head), chat_id=job["panel_chat_id"], message_id=job["panel_msg_id"])
+    except Exception: pass
+
+async def run_bcast_job(application, job):
+    """Esegue (o riprende dal cursor) un job broadcast; un solo job alla volta."""
+    PRIORITY.set(BULK)   # gira nel proprio task: le risposte interattive passano avanti
+    bd = application.bot_data
+    bot = application.bot
+    aud = bd.get("audience") if job.get("target") else None
+    if job.get("target") and aud is None:
+        log.warning(f"[BCAST] job #{job['id']} su '{job['target']}' richiede la modalità host: resta in pausa")
+        bcast_job_update(job["id"], status="paused")
+        return
+    bd["broadcast_stop"] = False
+    bd["broadcast_running"] = job["id"]
+    if job["status"] != "running":
+        bcast_job_update(job["id"], status="running")
+        job["status"] = "running"
+
+    route, lost = {}, []   # target multi-bot: user_id → bot che invia; (bot, user_id) bloccati altrove
+    if aud is not None:
+        peers = bd["peers"]
+        def chat_ids():
+            for uid, via in aud.iter_targets(aud.target(job["target"]), job["cursor"]):
+                route[uid] = via
+                yield uid
+        async def send(chat_id):
+            await peers[route[chat_id]].send_message(chat_id=chat_id, text=job["text"], protect_content=True,
+                                                     disable_web_page_preview=True)
+    elif job["mode"] == "copy":
+        async def send(chat_id):
+            await bot.copy_message(chat_id=chat_id, from_chat_id=job["from_chat_id"],
+                                   message_id=job["message_id"], protect_content=True)
+    else:
+        async def send(chat_id):
+            await bot.send_message(chat_id=chat_id, text=job["text"], protect_content=True, disable_web_page_preview=True)
+
+    results = []
+
+    def on_result(uid, outcome, err):
+        via = route.pop(uid, None)
+        if via is None or bd["peers"][via] is bot: results.append((uid, outcome, err))
+        elif classify_failure(outcome, err): lost.append((via, uid))
+
+    def snapshot(st):
+        job.update(sent=st.sent, blocked=st.blocked, failed=st.failed)
+
+    async def checkpoint(cursor, st):
+        snapshot(st); job["cursor"] = cursor
+        batch = results[:]; del results[:]
+        record_delivery(batch)
+        if lost:
+            for via in {v for v, _ in lost}:
+                aud.drop(via, [u for v, u in lost if v == via])
+            del lost[:]
+        bcast_job_update(job["id"], cursor=cursor, sent=st.sent, blocked=st.blocked, failed=st.failed)
+
+    async def progress(st):
+        snapshot(st)
+        await _bcast_panel(bot, job, "📣 In corso…")
+
+    try:
+        st = await run_broadcast(
+            chat_ids() if aud is not None else iter_user_ids(job["cursor"]), send,
+            stats=BroadcastStats(total=job["total"], sent=job["sent"], blocked=job["blocked"], failed=job["failed"]),
+            should_stop=lambda: bd.get("broadcast_stop", False),
+            on_progress=progress, progress_every=BCAST_PROGRESS_EVERY,
+            on_checkpoint=checkpoint,
+            on_result=on_result,
+        )
+        snapshot(st)
+        if bd.get("broadcast_stop"):
+            bcast_job_update(job["id"], status="paused")
+            await _bcast_panel(bot, job, "⏸️ In pausa — /broadcast_resume per riprendere")
+        else:
+            bcast_job_update(job["id"], status="done")
+            await _bcast_panel(bot, job, "✅ Completato")
+    except Exception as e:
+        log.exception(f"[BCAST] job #{job['id']} errore: {e}")
+    finally:
+        bd["broadcast_running"] = None
+
 async def broadcast_cmd(update, context):
     if not admin_only(update): return
     m = update.effective_message
-    users = get_all_users()
-    total = len(users)
+    app = context.application
+    if app.bot_data.get("broadcast_running"):
+        await m.reply_text("⏳ C'è già un broadcast in corso. Usa /broadcast_stop per metterlo in pausa."); return
+    total = count_reachable()
     if total == 0:
-        await m.reply_text("Nessun utente nel DB."); return
-
-    context.application.bot_data["broadcast_stop"] = False
+        await m.reply_text("Nessun utente raggiungibile nel DB."); return
 
     if m.reply_to_message:
-        mode = "copy"
+        fields = dict(mode="copy", from_chat_id=m.reply_to_message.chat_id, message_id=m.reply_to_message.message_id)
         text_preview = m.reply_to_message.text or m.reply_to_message.caption or "(media)"
     else:
-        mode = "text"
         text_body = " ".join(context.args) if context.args else None
         if not text_body:
             await m.reply_text("Uso: /broadcast <testo> oppure in reply a un contenuto /broadcast"); return
+        fields = dict(mode="text", text=text_body)
         text_preview = (text_body[:120] + "…") if len(text_body) > 120 else text_body
 
-    sent = failed = blocked = 0
-    start_msg = await m.reply_text(f"📣 Broadcast iniziato\nUtenti: {total}\nAnteprima: {text_preview}")
-
-    for i, u in enumerate(users, start=1):
-        if context.application.bot_data.get("broadcast_stop"): break
-        chat_id = u["user_id"]
-        try:
-            if mode == "copy":
-                await m.reply_to_message.copy(chat_id=chat_id, protect_content=True)
-            else:
-                await context.bot.send_message(chat_id=chat_id, text=text_body, protect_content=True, disable_web_page_preview=True)
-            sent += 1
-        except Forbidden:
-            blocked += 1
-        except RetryAfter as e:
-            await aio.sleep(e.retry_after + 1)
-            try:
-                if mode == "copy":
-                    await m.reply_to_message.copy(chat_id=chat_id, protect_content=True)
-                else:
-                    await context.bot.send_message(chat_id=chat_id, text=text_body, protect_content=True, disable_web_page_preview=True)
-                sent += 1
-            except Forbidden:
-                blocked += 1
-            except Exception:
-                failed += 1
-        except (BadRequest, NetworkError, Exception):
-            failed += 1
-
-        if i % BCAST_PROGRESS_EVERY == 0:
-            try:
-                await start_msg.edit_text(f"📣 In corso… {sent}/{total} | Bloccati {blocked} | Errori {failed}")
-            except: pass
-        await aio.sleep(BCAST_SLEEP)
+    panel = await m.reply_text(f"📣 Broadcast iniziato\nUtenti: {total}\nAnteprima: {text_preview}")
+    job_id = bcast_job_create(total=total, panel_chat_id=panel.chat_id, panel_msg_id=panel.message_id, **fields)
+    job = bcast_job_get(job_id)
+    # in background: il bot continua a rispondere durante il broadcast
+    app.create_task(run_bcast_job(app, job))
+
+def _audience_report(aud):
+    """Conteggi per bot e per combinazione (bloccante: sync + COUNT sull'indice)."""
+    aud.sync()
+    names = list(aud.sources)
+    specs = names + ([f"{names[0]}|{names[1]}", f"{names[0]}&{names[1]}",
+                      f"{names[0]}-{names[1]}", f"{names[1]}-{names[0]}"] if len(names) == 2 else [])
+    return "\n".join(f"• {sp}: {aud.count(aud.target(sp))}" for sp in specs)
+
+# --- /broadcast_to <target> <testo>: pubblico dell'indice multi-bot, un messaggio per persona
+async def broadcast_to_cmd(update, context):
+    if not admin_only(update): return
+    m = update.effective_message
+    app = context.application
+    aud = app.bot_data.get("audience")
+    if aud is None:
+        await m.reply_text("Disponibile solo in modalità host (python host.py)."); return
+    if len(context.args) < 2:
+        report = await aio.to_thread(_audience_report, aud)
+        await m.reply_text("Uso: /broadcast_to <target> <testo>\n"
+                           "target: a | a|b (unione) | a&b (intersezione) | a-b (in a, non in b)\n\n"
+                           f"Pubblico raggiungibile:\n{report}", protect_content=True)
+        return
+    if app.bot_data.get("broadcast_running"):
+        await m.reply_text("⏳ C'è già un broadcast in corso. Usa /broadcast_stop per metterlo in pausa."); return
+    try:
+        target = aud.target(context.args[0])
+    except ValueError as e:
+        await m.reply_text(f"⚠️ {e}"); return
+    await aio.to_thread(aud.sync)   # l'indice vede anche le registrazioni degli ultimi minuti
+    total = await aio.to_thread(aud.count, target)
+    if total == 0:
+        await m.reply_text(f"Nessun utente raggiungibile per {target.spec}."); return
 
-    stopped = context.application.bot_data.get("broadcast_stop", False)
-    status = "⏹️ Interrotto" if stopped else "✅ Completato"
-    await start_msg.edit_text(f"{status}\nTotali: {total}\nInviati: {sent}\nBloccati: {blocked}\nErrori: {failed}")
+    text_body = " ".join(context.args[1:])
+    preview = (text_body[:120] + "…") if len(text_body) > 120 else text_body
+    panel = await m.reply_text(f"📣 Broadcast iniziato ({target.spec})\nUtenti: {total}\nAnteprima: {preview}")
+    job_id = bcast_job_create(mode="text", text=text_body, target=target.spec, total=total,
+                              panel_chat_id=panel.chat_id, panel_msg_id=panel.message_id)
+    app.create_task(run_bcast_job(app, bcast_job_get(job_id)))
 
 async def broadcast_stop_cmd(update, context):
     if not admin_only(update): return
+    if not context.application.bot_data.get("broadcast_running"):
+        await update.message.reply_text("Nessun broadcast in corso."); return
     context.application.bot_data["broadcast_stop"] = True
-    await update.message.reply_text("⏹️ Broadcast: verrà interrotto al prossimo step.")
+    await update.message.reply_text("⏸️ Broadcast: in pausa al prossimo step. /broadcast_resume per riprendere.")
 
-# --- Block in gruppi
+async def broadcast_resume_cmd(update, context):
+    if not admin_only(update): return
+    app = context.application
+    if app.bot_data.get("broadcast_running"):
+        await update.message.reply_text("⏳ C'è già un broadcast in corso."); return
+    paused = bcast_jobs("paused")
+    if context.args and context.args[0].isdigit():
+        paused = [j for j in paused if j["id"] == int(context.args[0])]
+    if not paused:
+        await update.message.reply_text("Nessun broadcast in pausa."); return
+    job = paused[-1]
+    await update.message.reply_text(f"▶️ Riprendo job #{job['id']} ({job['sent']+job['blocked']+job['failed']}/{job['total']})")
+    app.create_task(run_bcast_job(app, job))
+
+async def resume_bcast_jobs(application):
+    """Al riavvio riprende il job rimasto 'running' dall'ultimo cursor confermato."""
+    running = bcast_jobs("running")
+    for j in running[:-1]:
+        bcast_job_update(j["id"], status="paused")
+    if running:
+        job = running[-1]
+        log.info(f"[BCAST] riprendo job #{job['id']} da user_id > {job['cursor']}")
+        async def _go(context): context.application.create_task(run_bcast_job(context.application, job))
+        application.job_queue.run_once(_go, 1, name="broadcast_resume")
+
+# --- /esclusi: report utenti bloccati/disattivati + ritest
+async def esclusi_cmd(update, context):
+    if not admin_only(update): return
+    app = context.application
+    by, flaky = health_report()
+    if not (context.args and context.args[0].lower() == "retest"):
+        await update.message.reply_text(
+            f"🩺 Salute destinatari\n"
+            f"Raggiungibili: {by.get('ok', 0)} (con errori recenti: {flaky})\n"
+            f"Bloccati: {by.get('blocked', 0)}\n"
+            f"Disattivati: {by.get('deactivated', 0)}\n\n"
+            f"/esclusi retest — ritesta gli esclusi", protect_content=True)
+        return
+    if app.bot_data.get("broadcast_running"):
+        await update.message.reply_text("⏳ Broadcast in corso: riprova al termine."); return
+    n_excl = by.get("blocked", 0) + by.get("deactivated", 0)
+    if not n_excl:
+        await update.message.reply_text("Nessun utente escluso."); return
+    panel = await update.message.reply_text(f"🔁 Ritest di {n_excl} esclusi…")
+
+    async def run():
+        PRIORITY.set(BULK)
+        back = []
+        def on_result(uid, outcome, err):
+            if outcome == "sent": back.append((uid,))
+        # chat action: l'utente vede "sta scrivendo…" per qualche secondo (nessun messaggio),
+        # e la chiamata fallisce con Forbidden se ci ha bloccato
+        ids = chain(iter_user_ids(0, "blocked"), iter_user_ids(0, "deactivated"))
+        st = await run_broadcast(ids, lambda uid: app.bot.send_chat_action(uid, "typing"),
+                                 stats=BroadcastStats(total=n_excl), on_result=on_result)
+        DB.executemany("UPDATE users SET delivery='ok', fail_count=0 WHERE user_id=?", back)
+        UNREACHABLE.difference_update(uid for (uid,) in back)
+        try: await panel.edit_text(f"✅ Ritest completato\nRecuperati: {st.sent}\nAncora esclusi: {st.blocked + st.failed}")
+        except Exception: pass
+    app.create_task(run())
+
+# --- Block in gruppi (cancellazioni a lotti via DELETES)
 async def block_all(update,context):
     if update.effective_chat.type in ("group","supergroup") and not is_admin(update.effective_user.id):
-        try: await context.bot.delete_message(update.effective_chat.id,update.effective_message.id)
-        except: pass
+        DELETES.put(update.effective_chat.id, update.effective_message.id)
 
 # --- Keep alive
 async def keep_alive_job(context):
@@ -592,30 +1035,34 @@ async def keep_alive_job(context):
     except Exception as e: log.warning(f"Errore keep-alive: {e}")
 
 # ---------------- MAIN ----------------
-def main():
-    if not BOT_TOKEN: raise SystemExit("BOT_TOKEN mancante")
-    init_db()
-    app=ApplicationBuilder().token(BOT_TOKEN).build()
-    try:
-        aio.get_event_loop().run_until_complete(app.bot.delete_webhook(drop_pending_updates=True))
-    except Exception as e:
-        log.warning(f"Webhook reset fallito: {e}")
+def build_app(request=None):
+    """`request`: HTTPXRequest già pronta (host.py la condivide tra i bot)."""
+    app=(ApplicationBuilder().token(BOT_TOKEN).request(request or scheduled_request("bpfarm"))
+         .base_url(f"{BOT_API_URL}/bot").base_file_url(f"{BOT_API_URL}/file/bot")
+         .concurrent_updates(ChatOrderedProcessor(is_admin, "bpfarm")).build())
+
+    # Anti-flood prima di tutto il resto (messaggi, comandi e bottoni)
+    app.add_handler(TypeHandler(Update, flood_guard), group=-1)
 
     # Pubblici
     app.add_handler(CommandHandler("start",start))
     app.add_handler(CallbackQueryHandler(cb_router))
-    app.add_handler(MessageHandler(~filters.COMMAND, flood_guard))
 
     # Admin
     app.add_handler(CommandHandler("status",status_cmd))
     app.add_handler(CommandHandler("diag",diag_cmd))
+    app.add_handler(CommandHandler("stats",stats_cmd))
     app.add_handler(CommandHandler("restore_db",restore_db))
     app.add_handler(CommandHandler("backup", backup_cmd))
     app.add_handler(CommandHandler("backup_zip", backup_zip_cmd))
+    app.add_handler(CommandHandler("backup_rebuild", backup_rebuild_cmd))
     app.add_handler(CommandHandler("utenti", utenti_cmd))
     app.add_handler(CommandHandler("help", help_cmd))
+    app.add_handler(CommandHandler("esclusi", esclusi_cmd))
     app.add_handler(CommandHandler("broadcast", broadcast_cmd))
+    app.add_handler(CommandHandler("broadcast_to", broadcast_to_cmd))
     app.add_handler(CommandHandler("broadcast_stop", broadcast_stop_cmd))
+    app.add_handler(CommandHandler("broadcast_resume", broadcast_resume_cmd))
 
     # Jobs
     hhmm=parse_hhmm(BACKUP_TIME)
@@ -623,10 +1070,45 @@ def main():
     first=datetime.combine(now.date(),hhmm,tzinfo=timezone.utc)
     if first<=now:first+=timedelta(days=1)
     app.job_queue.run_repeating(backup_job,86400,first=first)   # backup ogni 24h
-    app.job_queue.run_repeating(reset_flood,10)                 # reset anti-flood
-    app.job_queue.run_repeating(keep_alive_job,600,first=60)    # keep-alive 10 min
+    if not webhook_enabled():                                   # in webhook il traffico tiene sveglia l'istanza
+        app.job_queue.run_repeating(keep_alive_job,600,first=60)    # keep-alive 10 min
+
+    async def _post_init(application):
+        REG.start()                                             # write-behind registrazioni
+        DELETES.start(application.bot)                          # coda cancellazioni (block_all)
+        await resume_bcast_jobs(application)                    # riprende broadcast interrotti
+        if METRICS_PORT:                                        # /metrics su porta dedicata, anche in webhook
+            srv = application.bot_data["metrics_srv"] = WebhookServer(port=METRICS_PORT, metrics=True)
+            await srv.start()
+
+    async def _post_stop(application):
+        await DELETES.stop()                                    # ultimo lotto, col bot ancora attivo
+
+    async def _post_shutdown(application):
+        await REG.stop()                                        # flush registrazioni in coda
+        srv = application.bot_data.pop("metrics_srv", None)
+        if srv: await srv.stop()
+
+    app.post_init = _post_init
+    app.post_stop = _post_stop
+    app.post_shutdown = _post_shutdown
+    instrument(app, "bpfarm")                                   # latenze per handler (/stats, /metrics)
+    return app
+
+def main():
+    if not BOT_TOKEN: raise SystemExit("BOT_TOKEN mancante")
+    init_db()
+    load_known_users()
+    app=build_app()
 
     log.info(f"🚀 BPFARM BOT avviato — v{VERSION}")
+    if webhook_enabled():
+        run_webhook(app, allowed_updates=Update.ALL_TYPES, drop_pending_updates=True)
+        return
+    try:
+        aio.get_event_loop().run_until_complete(app.bot.delete_webhook(drop_pending_updates=True))
+    except Exception as e:
+        log.warning(f"Webhook reset fallito: {e}")
     app.run_polling(drop_pending_updates=True,allowed_updates=Update.ALL_TYPES)
 
-if __name__=="__main__": main()
\ No newline at end of file
+if __name__=="__main__": main()
@@ -1,18 +1,18 @@
 # =====================================================
 # bot2.py — BPFAM1 BOT (PTB v21+)
-# - Polling stabile (senza conflitti / loop error)
+# - Polling stabile (senza conflitti / loop error) o webhook (WEBHOOK_URL)
 # - Webhook guard
 # - Solo immagine + titolo + pulsanti (no testo extra)
 # - DB utenti + comandi admin
 # - Backup giornaliero con JobQueue
 # - Anti-share: blocco inoltro/salvataggio e blocco invii non-admin
-# - /restore_db: ripristino DB via reply a file .db
+# - /restore_db: ripristino DB via reply a file .db (validazione + scambio atomico)
 # =====================================================
 
 import os
-import sqlite3
+import asyncio
 import logging
-import shutil
+import time
 from datetime import datetime, time as dtime
 from pathlib import Path
 
@@ -31,6 +31,18 @@ from telegram.ext import (
 )
 import telegram.error as tgerr
 
+from db import Database, WriteBehind, IdSet
+from media_cache import MediaCache
+from deletions import DeleteQueue
+from webhook import webhook_enabled, run_webhook, WebhookServer
+from metrics import instrument, summary as metrics_summary, METRICS_PORT
+from scheduler import scheduled_request
+from dispatch import ChatOrderedProcessor
+from backup_utils import (
+    export_csv, sqlite_safe_copy, snapshot_db, ensure_change_tracking, incremental_backup,
+    force_full_backup, is_sqlite_db, rotate_backups, BACKUP_PAGES,
+)
+
 VERSION = "2.5-antishare-restore"
 
 # ---------- LOG ----------
@@ -47,6 +59,8 @@ ADMIN_ID     = int(os.environ.get("ADMIN_ID", "8033084779"))
 DB_FILE      = os.environ.get("DB_FILE", "./data/users_bot2.db")
 BACKUP_DIR   = os.environ.get("BACKUP_DIR", "./backup_bot2")
 BACKUP_TIME  = os.environ.get("BACKUP_TIME", "03:00")   # HH:MM locale
+RESTORE_KEEP = int(os.environ.get("RESTORE_KEEP", "3"))   # copie pre_restore_*.bak conservate
+BOT_API_URL  = os.environ.get("BOT_API_URL", "https://api.telegram.org")   # Bot API server (self-hosted o finto per i benchmark)
 
 WELCOME_PHOTO_URL = os.environ.get(
     "WELCOME_PHOTO_URL",
@@ -60,11 +74,11 @@ BUTTON_TEXT = os.environ.get("BUTTON_TEXT", "Accesso e menù 📋")
 BUTTON_URL  = os.environ.get("BUTTON_URL",  "https://t.me/Bpfarmbot")
 
 # ---------- DB ----------
-def init_db():
-    Path(DB_FILE).parent.mkdir(parents=True, exist_ok=True)
-    conn = sqlite3.connect(DB_FILE)
-    cur = conn.cursor()
-    cur.execute("""
+DB = Database(DB_FILE)   # connessione persistente WAL (db.py)
+MEDIA = MediaCache(DB)   # file_id di WELCOME_PHOTO_URL
+
+def init_schema(conn):
+    conn.execute("""
         CREATE TABLE IF NOT EXISTS users(
             user_id INTEGER PRIMARY KEY,
             username TEXT,
@@ -73,48 +87,78 @@ def init_db():
             joined_utc TEXT
         )
     """)
-    conn.commit()
-    conn.close()
+    # DB ripristinati da altre versioni (es. backup di bot.py: `joined` invece di `joined_utc`)
+    cols = {r[1] for r in conn.execute("PRAGMA table_info('users')").fetchall()}
+    if "user_id" not in cols:
+        raise ValueError("tabella users senza colonna user_id")
+    for c in ("username", "first_name", "last_name", "joined_utc"):
+        if c not in cols:
+            conn.execute(f"ALTER TABLE users ADD COLUMN {c} TEXT;")
+    if "joined_utc" not in cols and "joined" in cols:
+        conn.execute("UPDATE users SET joined_utc = joined")
+    # raggiungibilità: ok | blocked (segnata dai broadcast multi-bot in modalità host)
+    if "delivery" not in cols:
+        conn.execute("ALTER TABLE users ADD COLUMN delivery TEXT NOT NULL DEFAULT 'ok';")
+    ensure_change_tracking(conn, "users", "user_id")   # backup incrementali
+
+def init_db():
+    with DB.transaction() as conn:
+        init_schema(conn)
+    MEDIA.init()
+
+# cancellazioni anti-share raccolte e inviate a lotti (deletions.py)
+DELETES = DeleteQueue()
+
+# registrazioni /start: accodate e scritte a lotti (write-behind, db.py)
+# chi torna su /start ci ha sbloccato: rientra tra i raggiungibili
+REG = WriteBehind(DB, """INSERT INTO users (user_id,username,first_name,last_name,joined_utc) VALUES (?,?,?,?,?)
+    ON CONFLICT(user_id) DO UPDATE SET delivery='ok' WHERE users.delivery != 'ok'""")
+
+# indice in memoria degli utenti noti (+ non raggiungibili): i ritorni su /start non toccano il DB
+KNOWN = IdSet()
+UNREACHABLE = set()
+
+def _user_ids(batch=5000):
+    """user_id in ordine crescente a pagine keyset: ogni pagina sotto il lock del DB, poi lo rilascia."""
+    last = 0
+    while True:
+        rows = DB.all("SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?", (last, batch))
+        yield from (r[0] for r in rows)
+        if len(rows) < batch: return
+        last = rows[-1][0]
+
+def load_known_users():
+    KNOWN.load(_user_ids())
+    UNREACHABLE.clear()
+    UNREACHABLE.update(r[0] for r in DB.all("SELECT user_id FROM users WHERE delivery != 'ok'"))
+    log.info(f"[DB] indice utenti: {len(KNOWN)} noti, {len(UNREACHABLE)} esclusi")
+
+def mark_unreachable(user_ids):
+    """Utenti che hanno bloccato il bot (Forbidden in un broadcast via audience.py)."""
+    user_ids = list(user_ids)
+    UNREACHABLE.update(user_ids)
+    DB.executemany("UPDATE users SET delivery='blocked' WHERE user_id=?", ((u,) for u in user_ids))
 
 def add_user_if_new(u):
     if not u: return
-    conn = sqlite3.connect(DB_FILE)
-    cur  = conn.cursor()
-    cur.execute("SELECT 1 FROM users WHERE user_id=?", (u.id,))
-    ok = cur.fetchone()
-    if not ok:
-        cur.execute(
-            "INSERT INTO users VALUES (?,?,?,?,?)",
-            (u.id, u.username or "", u.first_name or "", u.last_name or "",
-             datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")),
-        )
-        conn.commit()
-    conn.close()
+    if not KNOWN.add(u.id) and u.id not in UNREACHABLE: return
+    UNREACHABLE.discard(u.id)
+    REG.put((u.id, u.username or "", u.first_name or "", u.last_name or "",
+             datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")))
 
 def count_users() -> int:
-    conn = sqlite3.connect(DB_FILE); cur = conn.cursor()
-    cur.execute("SELECT COUNT(*) FROM users")
-    n = int(cur.fetchone()[0]); conn.close()
-    return n
-
-def export_users_csv(path: Path):
-    conn = sqlite3.connect(DB_FILE); cur = conn.cursor()
-    cur.execute("SELECT user_id,username,first_name,last_name,joined_utc FROM users ORDER BY joined_utc DESC")
-    rows = cur.fetchall(); conn.close()
-
-    Path(path).parent.mkdir(parents=True, exist_ok=True)
-    import csv
-    with open(path, "w", newline="", encoding="utf-8") as f:
-        w = csv.writer(f)
-        w.writerow(["user_id","username","first_name","last_name","joined_utc"])
-        w.writerows(rows)
-
-def backup_database() -> Path:
-    Path(BACKUP_DIR).mkdir(parents=True, exist_ok=True)
+    return len(KNOWN)
+
+def export_users(out: Path, progress=None) -> list:
+    """CSV compresso in streaming, a parti sotto il limite upload (bloccante: asyncio.to_thread)."""
+    return export_csv(DB_FILE, "SELECT user_id,username,first_name,last_name,joined_utc FROM users ORDER BY joined_utc DESC",
+                      out, progress=progress)
+
+def backup_database() -> dict:
+    """Snapshot coerente + sha256 (bloccante: chiamare con asyncio.to_thread)."""
     ts = datetime.now().strftime("%Y%m%d-%H%M%S")
     dest = Path(BACKUP_DIR) / f"users_backup_{ts}.sqlite3"
-    shutil.copy2(DB_FILE, dest)
-    return dest
+    return snapshot_db(DB_FILE, dest)
 
 # ---------- HANDLERS PUBBLICI ----------
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -126,12 +170,12 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
     try:
-        await update.effective_message.reply_photo(
-            photo=WELCOME_PHOTO_URL,
+        await MEDIA.send_photo("WELCOME_PHOTO_URL", WELCOME_PHOTO_URL, lambda photo: update.effective_message.reply_photo(
+            photo=photo,                     # file_id in cache dopo il primo invio
             caption=caption,
             reply_markup=keyboard,
             protect_content=True,            # <-- anti-forward/salvataggio
-        )
+        ))
     except tgerr.BadRequest:
         await update.effective_message.reply_text(
             caption,
@@ -141,44 +185,78 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # ---------- ANTI-SHARE / BLOCCO INVII NON-ADMIN ----------
 async def block_non_admin_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Elimina qualsiasi messaggio inviato da non-admin (testo, foto, video, sticker, contatti, ecc.)."""
+    """Elimina qualsiasi messaggio inviato da non-admin (testo, foto, video, sticker, contatti, ecc.).
+
+    Le cancellazioni passano dalla coda DELETES: un'ondata di spam diventa
+    poche chiamate deleteMessages (fino a 100 id ciascuna).
+    """
     user = update.effective_user
     if not user or user.id == ADMIN_ID:
         return
-    chat = update.effective_chat
-    msg  = update.effective_message
-    try:
-        await context.bot.delete_message(chat_id=chat.id, message_id=msg.id)
-    except Exception:
-        pass
+    DELETES.put(update.effective_chat.id, update.effective_message.id)
 
 # ---------- ADMIN ----------
 async def utenti(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID: return
-    await update.effective_message.reply_text(f"👥 Utenti totali: {count_users()}", protect_content=True)
+    await update.effective_message.reply_text(
+        f"👥 Utenti totali: {count_users()}", protect_content=True)
 
 async def export_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID: return
     ts = datetime.now().strftime("%Y%m%d-%H%M")
-    csv_path = Path(BACKUP_DIR) / f"users_export_{ts}.csv"
-    export_users_csv(csv_path)
-    await update.effective_message.reply_document(
-        document=InputFile(csv_path, filename=csv_path.name),
-        caption="Export CSV completato ✅",
-        protect_content=True,
-    )
+    out = Path(BACKUP_DIR) / f"users_export_{ts}"
+    panel = await update.effective_message.reply_text("⏳ Export CSV in corso…", protect_content=True)
+    state = {"rows": 0, "shown": 0}
+
+    def progress(rows):   # dal worker thread
+        state["rows"] = rows
+
+    job = asyncio.ensure_future(asyncio.to_thread(export_users, out, progress))
+    while not job.done():
+        await asyncio.wait({job}, timeout=3)
+        if not job.done() and state["rows"] != state["shown"]:
+            state["shown"] = state["rows"]
+            try:
+                await panel.edit_text(f"⏳ Export CSV in corso… {state['shown']} righe")
+            except tgerr.TelegramError:
+                pass
+    parts = job.result()
+
+    for i, p in enumerate(parts, 1):
+        caption = "Export CSV completato ✅" if len(parts) == 1 else f"Export CSV ✅ parte {i}/{len(parts)}"
+        with open(p["path"], "rb") as fh:
+            await update.effective_message.reply_document(
+                document=InputFile(fh, filename=p["path"].name),
+                caption=f"{caption} — {p['rows']} righe",
+                protect_content=True,
+            )
+    try:
+        await panel.delete()
+    except tgerr.TelegramError:
+        pass
 
 async def backup_now(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID: return
     if not Path(DB_FILE).exists():
         await update.effective_message.reply_text("DB non trovato.", protect_content=True)
         return
-    dest = backup_database()
-    await update.effective_message.reply_document(
-        document=InputFile(open(dest, "rb"), filename=dest.name),
-        caption=f"Backup creato: {dest.name}",
-        protect_content=True,
-    )
+    panel = await update.effective_message.reply_text("⏳ Backup in corso…", protect_content=True)
+    info = await asyncio.to_thread(backup_database)   # fuori dall'event loop
+    dest = info["db"]
+    try:
+        await panel.edit_text(f"✅ Backup pronto ({info['size']} byte)\nSHA-256 {info['sha256'][:16]}…")
+    except tgerr.TelegramError:
+        pass
+    with open(dest, "rb") as fh:
+        await update.effective_message.reply_document(
+            document=InputFile(fh, filename=dest.name),
+            caption=f"Backup creato: {dest.name}",
+            protect_content=True,
+        )
+
+async def stats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID: return
+    await update.effective_message.reply_text(metrics_summary("bpfam1"), protect_content=True)
 
 # ---------- /restore_db ----------
 async def restore_db(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -196,12 +274,6 @@ async def restore_db(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     doc = msg.reply_to_message.document
-    if not (doc.file_name and doc.file_name.endswith(".db")):
-        await update.effective_message.reply_text(
-            "❌ Il file deve avere estensione **.db**",
-            protect_content=True,
-        )
-        return
 
     # Scarica in tmp
     try:
@@ -213,38 +285,65 @@ async def restore_db(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.effective_message.reply_text(f"❌ Errore download file: {e}", protect_content=True)
         return
 
-    # Copia di sicurezza
-    try:
-        safety_copy = Path(BACKUP_DIR) / f"pre_restore_{datetime.now().strftime('%Y%m%d-%H%M%S')}.bak"
-        if Path(DB_FILE).exists():
-            shutil.copy2(DB_FILE, safety_copy)
-    except Exception as e:
-        await update.effective_message.reply_text(f"❌ Errore copia di sicurezza: {e}", protect_content=True)
-        try:
-            if tmp_path.exists(): tmp_path.unlink()
-        except Exception:
-            pass
+    # Validazione: header, quick_check, tabella users
+    ok, why = await asyncio.to_thread(is_sqlite_db, tmp_path, True, "users")
+    if not ok:
+        await update.effective_message.reply_text(f"❌ File non valido: {why}", protect_content=True)
+        tmp_path.unlink(missing_ok=True)
         return
 
-    # Sostituzione DB
+    panel = await update.effective_message.reply_text("⏳ Preparazione del nuovo DB…", protect_content=True)
+    prep = Path(DB_FILE + ".restore")   # stessa cartella del DB: os.replace atomico
     try:
-        Path(DB_FILE).parent.mkdir(parents=True, exist_ok=True)
-        shutil.copy2(tmp_path, DB_FILE)
-        await update.effective_message.reply_text("✅ Database ripristinato. Usa /utenti per verificare.", protect_content=True)
+        await asyncio.to_thread(prepare_restore, tmp_path, prep)
+        # Write barrier: svuota le registrazioni in coda, poi scambio sotto il lock del DB
+        await asyncio.to_thread(REG.flush)
+        t0 = time.perf_counter()
+        await asyncio.to_thread(DB.swap, prep)
+        swap_ms = (time.perf_counter() - t0) * 1000
+        # Cache calde sul nuovo DB
+        MEDIA.init()
+        await asyncio.to_thread(load_known_users)
+        force_full_backup(BACKUP_DIR)   # la catena incrementale riparte da una base
+        await panel.edit_text(
+            f"✅ Database ripristinato ({count_users()} utenti).\n"
+            f"Scambio in {swap_ms:.0f} ms. Usa /utenti per verificare.")
     except Exception as e:
-        await update.effective_message.reply_text(f"❌ Errore ripristino DB: {e}", protect_content=True)
-    finally:
+        log.exception(f"[RESTORE] {e}")
         try:
-            if tmp_path.exists(): tmp_path.unlink()
-        except Exception:
+            await panel.edit_text(f"❌ Errore ripristino DB: {e}\nIl DB attuale non è stato toccato.")
+        except tgerr.TelegramError:
             pass
+    finally:
+        for f in (tmp_path, prep):
+            try:
+                f.unlink(missing_ok=True)
+            except Exception:
+                pass
+
+def prepare_restore(src: Path, prep: Path):
+    """Copia di sicurezza del DB attuale + nuovo DB pronto accanto a quello vivo (bloccante)."""
+    if Path(DB_FILE).exists():
+        safety = Path(BACKUP_DIR) / f"pre_restore_{datetime.now().strftime('%Y%m%d-%H%M%S')}.bak"
+        sqlite_safe_copy(DB_FILE, str(safety), pages=BACKUP_PAGES)
+        rotate_backups(RESTORE_KEEP, "pre_restore_*.bak", BACKUP_DIR)
+    prep.unlink(missing_ok=True)
+    sqlite_safe_copy(str(src), str(prep))
+    # schema e trigger applicati ora, così dopo lo scambio non resta nulla da migrare
+    new = Database(prep)
+    try:
+        with new.transaction() as conn:
+            init_schema(conn)
+        new.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    finally:
+        new.close()
 
 # ---------- JOBS ----------
 async def backup_job(context: ContextTypes.DEFAULT_TYPE):
     try:
         if Path(DB_FILE).exists():
-            dest = backup_database()
-            log.info(f"[JOB BACKUP] creato {dest}")
+            entry = await asyncio.to_thread(incremental_backup, DB_FILE, BACKUP_DIR, "users", "user_id")
+            log.info(f"[JOB BACKUP] {entry['kind']} {entry['path']} righe={entry['rows']} sha256={entry['sha256']}")
         else:
             log.warning("[JOB BACKUP] DB non trovato")
     except Exception as e:
@@ -258,12 +357,20 @@ def parse_backup_time(txt: str) -> dtime:
         return dtime(3, 0)
 
 # ---------- MAIN ----------
-def main():
-    if not BOT_TOKEN:
-        raise RuntimeError("BOT_TOKEN mancante nelle ENV")
-
-    init_db()
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+def build_app(request=None, job_queue=None):
+    """In modalità host (host.py) `request` e `job_queue` arrivano dall'altro bot:
+    un solo pool HTTP e un solo scheduler dei job per processo."""
+    builder = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .request(request or scheduled_request("bpfam1"))
+        .base_url(f"{BOT_API_URL}/bot")
+        .base_file_url(f"{BOT_API_URL}/file/bot")
+        .concurrent_updates(ChatOrderedProcessor(lambda uid: uid == ADMIN_ID, "bpfam1"))
+    )
+    if job_queue is not None:
+        builder = builder.job_queue(None)   # i job girano sulla JobQueue condivisa
+    app = builder.build()
 
     # Comandi pubblici / admin
     app.add_handler(CommandHandler("start", start))
@@ -271,27 +378,62 @@ def main():
     app.add_handler(CommandHandler("export", export_cmd))
     app.add_handler(CommandHandler("backup_db", backup_now))
     app.add_handler(CommandHandler("restore_db", restore_db))   # <-- nuovo
+    app.add_handler(CommandHandler("stats", stats_cmd))
 
     # Anti-share: blocca TUTTO ciò che non è comando dai non-admin
     app.add_handler(MessageHandler(~filters.COMMAND, block_non_admin_messages))
 
     async def _post_init(application):
-        # Webhook guard
-        try:
-            await application.bot.delete_webhook(drop_pending_updates=True)
-            log.info("[GUARD] webhook rimosso + pending updates droppati")
-        except Exception as e:
-            log.warning(f"[GUARD] delete_webhook fallito: {e}")
+        # Webhook guard (solo in polling: in modalità webhook lo registra serve())
+        if not webhook_enabled():
+            try:
+                await application.bot.delete_webhook(drop_pending_updates=True)
+                log.info("[GUARD] webhook rimosso + pending updates droppati")
+            except Exception as e:
+                log.warning(f"[GUARD] delete_webhook fallito: {e}")
 
         # Job backup giornaliero
         bt = parse_backup_time(BACKUP_TIME)
-        application.job_queue.run_daily(backup_job, time=bt, name="daily_backup")
+        jobs = job_queue if job_queue is not None else application.job_queue
+        jobs.run_daily(backup_job, time=bt, name="daily_backup")
         log.info(f"[JOB] backup giornaliero schedulato alle {bt.strftime('%H:%M')}")
 
+        REG.start()   # write-behind registrazioni
+        DELETES.start(application.bot)   # coda cancellazioni anti-share
+
+        # /metrics: su porta dedicata, mai su quella pubblica del webhook
+        if METRICS_PORT:
+            srv = application.bot_data["metrics_srv"] = WebhookServer(port=METRICS_PORT, metrics=True)
+            await srv.start()
+
+    async def _post_stop(application):
+        await DELETES.stop()   # ultimo lotto, col bot ancora attivo
+
+    async def _post_shutdown(application):
+        await REG.stop()   # flush registrazioni in coda
+        srv = application.bot_data.pop("metrics_srv", None)
+        if srv:
+            await srv.stop()
+
     app.post_init = _post_init
+    app.post_stop = _post_stop
+    app.post_shutdown = _post_shutdown
+    instrument(app, "bpfam1")   # latenze per handler (/stats, /metrics)
+    return app
+
+def main():
+    if not BOT_TOKEN:
+        raise RuntimeError("BOT_TOKEN mancante nelle ENV")
+
+    init_db()
+    load_known_users()
+    app = build_app()
 
     log.info(f"🚀 Avvio BPFAM1 BOT v{VERSION}")
-    app.run_polling(drop_pending_updates=True, allowed_updates=Update.ALL_TYPES)
+    if webhook_enabled():
+        run_webhook(app, allowed_updates=Update.ALL_TYPES, drop_pending_updates=True)
+    else:
+        app.run_polling(drop_pending_updates=True, allowed_updates=Update.ALL_TYPES)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
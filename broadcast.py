@@ -0,0 +1,187 @@
+# broadcast.py
+# Motore broadcast: pool limitato di sender concorrenti sotto un token bucket
+# globale (vicino al limite Telegram per bot), con rate adattivo su RetryAfter.
+import os
+import time
+import logging
+import asyncio as aio
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Iterable, Optional
+
+from telegram.error import RetryAfter, Forbidden
+
+from metrics import BCAST_MESSAGES, BCAST_RATE as RATE_GAUGE
+
+log = logging.getLogger("bpfarm-bot")
+
+BCAST_RATE    = float(os.environ.get("BCAST_RATE", "25"))   # msg/s globali (Telegram ~30/s per bot)
+BCAST_WORKERS = int(os.environ.get("BCAST_WORKERS", "16"))  # sender concorrenti
+BCAST_RETRIES = int(os.environ.get("BCAST_RETRIES", "3"))   # tentativi extra dopo RetryAfter
+
+
+class TokenBucket:
+    """Token bucket asincrono con pausa globale e recupero AIMD del rate."""
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.burst = float(burst or max(1.0, rate))
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = aio.Lock()
+
+    def _refill(self, now: float):
+        if now > self.last:
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await aio.sleep(self.paused_until - now)
+                    continue
+                self._refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await aio.sleep((1 - self.tokens) / self.rate)
+
+    def penalize(self, retry_after: float):
+        """RetryAfter: ferma tutti i sender per `retry_after` e dimezza il rate."""
+        self.paused_until = max(self.paused_until, time.monotonic() + float(retry_after))
+        self.rate = max(1.0, self.rate / 2)
+        self.tokens = 0.0
+        self.last = self.paused_until
+        log.warning(f"[BCAST] RetryAfter {retry_after}s → rate {self.rate:.1f} msg/s")
+
+    def reward(self):
+        """Invio riuscito: risale di 1% del massimo verso il rate configurato."""
+        if self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 100)
+
+
+@dataclass
+class BroadcastStats:
+    total: int = 0
+    sent: int = 0
+    blocked: int = 0
+    failed: int = 0
+
+    @property
+    def done(self) -> int:
+        return self.sent + self.blocked + self.failed
+
+
+async def run_broadcast(
+    chat_ids: Iterable[int],
+    send: Callable[[int], Awaitable[object]],
+    *,
+    stats: Optional[BroadcastStats] = None,
+    bucket: Optional[TokenBucket] = None,
+    workers: int = BCAST_WORKERS,
+    should_stop: Callable[[], bool] = lambda: False,
+    on_progress: Optional[Callable[[BroadcastStats], Awaitable[None]]] = None,
+    progress_every: int = 200,
+    on_checkpoint: Optional[Callable[[int, BroadcastStats], Awaitable[None]]] = None,
+    checkpoint_every: int = 50,
+    on_result: Optional[Callable[[int, str, Optional[Exception]], None]] = None,
+) -> BroadcastStats:
+    """Esegue `send(chat_id)` per ogni destinatario con `workers` sender concorrenti.
+
+    Conteggi come il vecchio loop: Forbidden → bloccati, RetryAfter oltre
+    BCAST_RETRIES o qualsiasi altro errore → errori.
+
+    `chat_ids` deve essere in ordine crescente se si usa `on_checkpoint`: il
+    cursore passato è l'ultimo chat_id tale che lui e tutti i precedenti sono
+    stati gestiti (i destinatari saltati dopo uno stop non lo fanno avanzare).
+
+    `on_result(chat_id, esito, errore)` riceve l'esito di ogni destinatario
+    ("sent" | "blocked" | "failed") per aggiornare lo stato di salute utenti.
+    """
+    stats = stats or BroadcastStats()
+    bucket = bucket or TokenBucket(BCAST_RATE)
+    RATE_GAUGE.set(bucket.rate)
+    queue: aio.Queue = aio.Queue(maxsize=workers * 4)
+    pending: dict = {}          # chat_id → gestito? (ordine di inserimento)
+    cursor = None
+    since_ckpt = 0
+
+    def confirm(chat_id):
+        nonlocal cursor, since_ckpt
+        pending[chat_id] = True
+        while pending:
+            head = next(iter(pending))
+            if not pending[head]:
+                break
+            del pending[head]
+            cursor = head
+        since_ckpt += 1
+
+    async def checkpoint(force=False):
+        nonlocal since_ckpt
+        if not on_checkpoint or cursor is None or not (force or since_ckpt >= checkpoint_every):
+            return
+        since_ckpt = 0
+        try: await on_checkpoint(cursor, stats)
+        except Exception as e: log.warning(f"[BCAST] checkpoint fallito: {e}")
+
+    def result(chat_id, outcome, err=None):
+        setattr(stats, outcome, getattr(stats, outcome) + 1)
+        BCAST_MESSAGES.inc(outcome)
+        if on_result:
+            on_result(chat_id, outcome, err)
+
+    async def deliver(chat_id):
+        err = None
+        for _ in range(BCAST_RETRIES + 1):
+            await bucket.acquire()
+            try:
+                await send(chat_id)
+                bucket.reward()
+                RATE_GAUGE.set(bucket.rate)
+                return result(chat_id, "sent")
+            except RetryAfter as e:
+                bucket.penalize(e.retry_after)
+                RATE_GAUGE.set(bucket.rate)
+                err = e
+            except Forbidden as e:
+                return result(chat_id, "blocked", e)
+            except Exception as e:
+                return result(chat_id, "failed", e)
+        result(chat_id, "failed", err)
+
+    async def worker():
+        while True:
+            chat_id = await queue.get()
+            try:
+                if chat_id is None:
+                    return
+                if should_stop():
+                    continue
+                await deliver(chat_id)
+                confirm(chat_id)
+                await checkpoint()
+                if on_progress and stats.done % progress_every == 0:
+                    try: await on_progress(stats)
+                    except Exception: pass
+            finally:
+                queue.task_done()
+
+    tasks = [aio.create_task(worker()) for _ in range(max(1, workers))]
+    try:
+        for chat_id in chat_ids:
+            if should_stop():
+                break
+            pending[chat_id] = False
+            await queue.put(chat_id)
+        for _ in tasks:
+            await queue.put(None)
+        await aio.gather(*tasks)
+        await checkpoint(force=True)
+    finally:
+        for t in tasks:
+            t.cancel()
+    return stats
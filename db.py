@@ -0,0 +1,271 @@
+# db.py
+# Accesso SQLite condiviso da bot.py e bot2.py: una connessione persistente
+# per file DB, in WAL, con busy timeout e cache degli statement preparati.
+import os
+import sqlite3
+import asyncio as aio
+import logging
+import threading
+from array import array
+from bisect import bisect_left
+from heapq import merge
+from contextlib import contextmanager
+from pathlib import Path
+
+from metrics import DB_SECONDS
+
+log = logging.getLogger("db")
+
+DB_BUSY_MS     = int(os.environ.get("DB_BUSY_MS", "5000"))        # attesa su lock prima di SQLITE_BUSY
+DB_SYNCHRONOUS = os.environ.get("DB_SYNCHRONOUS", "NORMAL")       # NORMAL è sicuro in WAL
+DB_STMT_CACHE  = int(os.environ.get("DB_STMT_CACHE", "256"))      # statement preparati in cache
+
+
+class Database:
+    """Connessione SQLite persistente e thread-safe (un lock per connessione).
+
+    La connessione è in autocommit: ogni `execute` è una transazione a sé,
+    `transaction()` raggruppa più statement in un unico commit. Le righe sono
+    `sqlite3.Row` (indicizzabili come tuple, convertibili in dict).
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.name = Path(self.path).stem   # etichetta nelle metriche
+        self._lock = threading.RLock()
+        self._conn = None
+
+    def _open(self) -> sqlite3.Connection:
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(
+            self.path,
+            timeout=DB_BUSY_MS / 1000,
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=DB_STMT_CACHE,
+        )
+        conn.row_factory = sqlite3.Row
+        mode = conn.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+        conn.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+        conn.execute(f"PRAGMA busy_timeout={DB_BUSY_MS}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        log.info(f"[DB] aperto {self.path} (journal={mode}, synchronous={DB_SYNCHRONOUS})")
+        return conn
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            with self._lock:
+                if self._conn is None:
+                    self._conn = self._open()
+        return self._conn
+
+    def execute(self, sql, params=()) -> sqlite3.Cursor:
+        with DB_SECONDS.time(self.name, "execute"), self._lock:
+            return self.conn.execute(sql, params)
+
+    def executemany(self, sql, seq):
+        """Tutte le righe in un'unica transazione."""
+        with DB_SECONDS.time(self.name, "executemany"), self.transaction() as conn:
+            return conn.executemany(sql, seq)
+
+    def one(self, sql, params=()):
+        with DB_SECONDS.time(self.name, "query"), self._lock:
+            return self.conn.execute(sql, params).fetchone()
+
+    def scalar(self, sql, params=(), default=None):
+        r = self.one(sql, params)
+        return r[0] if r is not None else default
+
+    def all(self, sql, params=()):
+        with DB_SECONDS.time(self.name, "query"), self._lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    @contextmanager
+    def transaction(self):
+        """BEGIN IMMEDIATE … COMMIT (ROLLBACK su eccezione), sotto il lock."""
+        with DB_SECONDS.time(self.name, "transaction"), self._lock:
+            conn = self.conn
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                try: self._conn.close()
+                finally: self._conn = None
+
+    def swap(self, new_path):
+        """Rimpiazza il file del DB con `new_path` (stessa cartella) con os.replace.
+
+        Sotto il lock: le scritture in volo finiscono prima, le nuove aspettano
+        la riapertura. Il WAL viene svuotato e chiuso prima dello scambio, e gli
+        eventuali -wal/-shm rimasti vengono rimossi: non appartengono al nuovo file.
+        """
+        with DB_SECONDS.time(self.name, "swap"), self._lock:
+            if self._conn is not None:
+                try: self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+                except sqlite3.Error as e: log.warning(f"[DB] checkpoint prima dello swap fallito: {e}")
+            self.close()
+            os.replace(new_path, self.path)
+            for ext in ("-wal", "-shm"):
+                try: os.remove(self.path + ext)
+                except FileNotFoundError: pass
+            self._conn = self._open()
+
+
+class IdSet:
+    """Insieme compatto di user_id: array('q') ordinato (8 byte/id) + set dei nuovi.
+
+    Il set dei nuovi viene fuso nell'array quando supera 1/8 della base, così
+    il costo di compattazione resta ammortizzato e la memoria ~8 byte per id.
+    """
+
+    def __init__(self):
+        self._base = array("q")
+        self._new = set()
+
+    def load(self, sorted_ids):
+        """Ricarica da un iterabile di id in ordine crescente (es. ORDER BY user_id)."""
+        self._base = array("q", sorted_ids)
+        self._new = set()
+
+    def __contains__(self, uid) -> bool:
+        if uid in self._new:
+            return True
+        i = bisect_left(self._base, uid)
+        return i < len(self._base) and self._base[i] == uid
+
+    def __len__(self) -> int:
+        return len(self._base) + len(self._new)
+
+    def add(self, uid) -> bool:
+        """True se l'id è nuovo."""
+        if uid in self:
+            return False
+        self._new.add(uid)
+        if len(self._new) > max(4096, len(self._base) // 8):
+            self._base = array("q", merge(self._base, sorted(self._new)))
+            self._new = set()
+        return True
+
+
+REG_FLUSH_MS   = int(os.environ.get("REG_FLUSH_MS", "250"))       # intervallo massimo tra due flush
+REG_FLUSH_ROWS = int(os.environ.get("REG_FLUSH_ROWS", "500"))     # flush anticipato oltre N righe
+REG_RETRIES    = int(os.environ.get("REG_RETRIES", "3"))          # tentativi di un lotto prima di passare riga per riga
+
+
+class WriteBehind:
+    """Coda in memoria di righe per uno statement, scritte a lotti in background.
+
+    `put()` non tocca il DB: un task asyncio svuota la coda ogni `flush_ms`
+    (o appena supera `max_rows`) con un unico executemany in transazione,
+    eseguito in un thread per non fermare l'event loop. `stop()` svuota
+    quanto resta allo spegnimento.
+
+    Un lotto che fallisce torna in testa alla coda per `retries` giri (errori
+    transitori, es. DB occupato); poi viene scritto riga per riga e le righe
+    che falliscono ancora sono scartate e loggate: una riga difettosa non
+    blocca le successive e la coda non cresce senza limite.
+    """
+
+    def __init__(self, db: Database, sql: str, flush_ms: int = REG_FLUSH_MS, max_rows: int = REG_FLUSH_ROWS,
+                 retries: int = REG_RETRIES):
+        self.db = db
+        self.sql = sql
+        self.flush_ms = flush_ms
+        self.max_rows = max_rows
+        self.retries = retries
+        self.flushed = 0
+        self.dropped = 0
+        self._failures = 0   # fallimenti consecutivi del lotto in testa
+        self._rows = []
+        self._wake = None
+        self._task = None
+
+    @property
+    def pending(self) -> int:
+        return len(self._rows)
+
+    def put(self, row):
+        self._rows.append(row)
+        if self._wake is not None and len(self._rows) >= self.max_rows:
+            self._wake.set()
+
+    def _take(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    def _write(self, rows, retry: bool = True):
+        try:
+            self.db.executemany(self.sql, rows)
+        except Exception:
+            self._failures += 1
+            if retry and self._failures < self.retries:
+                self._rows[:0] = rows   # ritenta al prossimo giro senza perdere righe
+                raise
+            self._failures = 0
+            self._write_rows(rows)
+            return
+        self._failures = 0
+        self.flushed += len(rows)
+
+    def _write_rows(self, rows):
+        """Ultimo tentativo riga per riga (una transazione): scarta solo le righe che falliscono."""
+        bad = 0
+        try:
+            with self.db.transaction() as conn:
+                for row in rows:
+                    try:
+                        conn.execute(self.sql, row)
+                    except sqlite3.Error as e:
+                        bad += 1
+                        log.error(f"[DB] write-behind: riga scartata {row!r}: {e}")
+        except Exception as e:
+            log.error(f"[DB] write-behind: lotto di {len(rows)} righe scartato: {e}")
+            self.dropped += len(rows)
+            return
+        self.flushed += len(rows) - bad
+        self.dropped += bad
+
+    def flush(self) -> int:
+        """Flush sincrono (spegnimento, restore, test): senza altri giri, riga per riga se serve."""
+        rows = self._take()
+        if rows:
+            self._write(rows, retry=False)
+        return len(rows)
+
+    async def _run(self):
+        while True:
+            try:
+                await aio.wait_for(self._wake.wait(), self.flush_ms / 1000)
+            except aio.TimeoutError:
+                pass
+            self._wake.clear()
+            rows = self._take()
+            if not rows:
+                continue
+            try:
+                await aio.to_thread(self._write, rows)
+            except Exception as e:
+                log.warning(f"[DB] write-behind: flush di {len(rows)} righe fallito: {e}")
+
+    def start(self):
+        if self._task is None:
+            self._wake = aio.Event()
+            self._task = aio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try: await self._task
+            except BaseException: pass
+            self._task = None
+        n = self.flush()
+        if n:
+            log.info(f"[DB] write-behind: {n} righe scritte allo spegnimento")
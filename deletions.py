@@ -0,0 +1,113 @@
+# deletions.py
+# Coda di cancellazioni: i message_id da eliminare vengono raccolti per chat
+# per una breve finestra e rimossi con deleteMessages (fino a 100 per
+# chiamata), dentro un token bucket dedicato. Un'ondata di spam costa così
+# una chiamata ogni ~100 messaggi invece di una per messaggio.
+import os
+import logging
+import asyncio as aio
+from collections import OrderedDict
+
+from telegram.error import RetryAfter, TelegramError
+
+from broadcast import TokenBucket
+from metrics import DELETIONS
+from scheduler import PRIORITY, BULK
+
+log = logging.getLogger("deletions")
+
+DELETE_WINDOW_MS   = int(os.environ.get("DELETE_WINDOW_MS", "500"))      # raccolta prima dell'invio
+DELETE_RATE        = float(os.environ.get("DELETE_RATE", "5"))           # chiamate deleteMessages/s
+DELETE_MAX_PENDING = int(os.environ.get("DELETE_MAX_PENDING", "20000"))  # oltre: le nuove si scartano
+DELETE_BATCH       = 100                                                 # limite Bot API per chiamata
+
+
+class DeleteQueue:
+    """`put(chat_id, message_id)` non chiama la Bot API: un task svuota la coda a lotti.
+
+    Stesso ciclo di vita di db.WriteBehind: `start(bot)` nel post_init,
+    `stop()` allo spegnimento (tenta un ultimo giro con quanto resta).
+    """
+
+    def __init__(self, window_ms: int = DELETE_WINDOW_MS, rate: float = DELETE_RATE,
+                 max_pending: int = DELETE_MAX_PENDING):
+        self.window_ms = window_ms
+        self.max_pending = max_pending
+        self.bucket = TokenBucket(rate)
+        self.pending = 0
+        self._chats = OrderedDict()   # chat_id → [message_id, …] in ordine di arrivo
+        self._bot = None
+        self._wake = None
+        self._task = None
+
+    def put(self, chat_id: int, message_id: int) -> bool:
+        if self.pending >= self.max_pending:
+            DELETIONS.inc("dropped")
+            return False
+        self._chats.setdefault(chat_id, []).append(message_id)
+        self.pending += 1
+        DELETIONS.inc("queued")
+        if self._wake is not None:
+            self._wake.set()
+        return True
+
+    def _take(self):
+        """Un lotto (≤ DELETE_BATCH) dalla chat più vecchia in coda."""
+        chat_id, ids = next(iter(self._chats.items()))
+        batch, rest = ids[:DELETE_BATCH], ids[DELETE_BATCH:]
+        if rest:
+            self._chats[chat_id] = rest
+            self._chats.move_to_end(chat_id)   # le altre chat non restano indietro
+        else:
+            del self._chats[chat_id]
+        self.pending -= len(batch)
+        return chat_id, batch
+
+    async def _delete(self, chat_id, ids):
+        while True:
+            await self.bucket.acquire()
+            try:
+                await self._bot.delete_messages(chat_id, ids)
+                self.bucket.reward()
+                DELETIONS.inc("deleted", n=len(ids))
+                return
+            except RetryAfter as e:
+                self.bucket.penalize(e.retry_after)
+            except TelegramError as e:
+                DELETIONS.inc("failed", n=len(ids))
+                log.warning(f"[DEL] chat {chat_id}: {len(ids)} messaggi non eliminati: {e}")
+                return
+
+    async def _drain(self):
+        while self._chats:
+            await self._delete(*self._take())
+
+    async def _run(self):
+        PRIORITY.set(BULK)   # pulizia: cede il passo alle risposte interattive
+        while True:
+            await self._wake.wait()
+            await aio.sleep(self.window_ms / 1000)   # raccoglie gli altri messaggi dell'ondata
+            self._wake.clear()
+            try:
+                await self._drain()
+            except Exception as e:
+                log.warning(f"[DEL] errore coda cancellazioni: {e}")
+
+    def start(self, bot):
+        self._bot = bot
+        if self._task is None:
+            self._wake = aio.Event()
+            if self._chats:
+                self._wake.set()
+            self._task = aio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try: await self._task
+            except BaseException: pass
+            self._task = None
+        if self._chats and self._bot is not None:
+            try: await aio.wait_for(self._drain(), 5)
+            except Exception as e:
+                log.warning(f"[DEL] svuotamento finale fallito ({sum(map(len, self._chats.values()))} in coda): {e!r}")
@@ -0,0 +1,89 @@
+# dispatch.py
+# Update processor concorrente: gli update di chat diverse girano in parallelo
+# (fino a UPDATE_CONCURRENCY), quelli della stessa chat restano in ordine di
+# arrivo. Gli update degli admin (restore, backup, export, broadcast…) hanno
+# una corsia a parte, così un'operazione lunga non occupa gli slot degli utenti.
+import os
+import asyncio as aio
+from typing import Callable, Optional
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from metrics import UPDATES_WAITING
+
+UPDATE_CONCURRENCY       = int(os.environ.get("UPDATE_CONCURRENCY", "32"))       # update utente in parallelo
+UPDATE_ADMIN_CONCURRENCY = int(os.environ.get("UPDATE_ADMIN_CONCURRENCY", "2"))  # update admin in parallelo
+UPDATE_MAX_INFLIGHT      = int(os.environ.get("UPDATE_MAX_INFLIGHT", "4096"))    # update accettati (in corso + in attesa)
+
+
+def _chat_key(update) -> Optional[int]:
+    if isinstance(update, Update):
+        if update.effective_chat:
+            return update.effective_chat.id
+        if update.effective_user:
+            return update.effective_user.id
+    return None
+
+
+class ChatOrderedProcessor(BaseUpdateProcessor):
+    """Ordine per chat + due corsie (utenti / admin) con slot separati.
+
+    Il semaforo della classe base limita solo quanti update sono accettati
+    (UPDATE_MAX_INFLIGHT); il parallelismo vero lo decidono le corsie, e lo
+    slot si prende solo dopo il proprio turno nella chat: una chat con cento
+    update in coda non blocca gli slot delle altre.
+    """
+
+    def __init__(self, is_admin: Callable[[int], bool] = lambda uid: False, name: str = "bot",
+                 concurrency: int = UPDATE_CONCURRENCY, admin_concurrency: int = UPDATE_ADMIN_CONCURRENCY,
+                 max_inflight: int = UPDATE_MAX_INFLIGHT):
+        super().__init__(max(max_inflight, concurrency + admin_concurrency, 2))
+        self.is_admin = is_admin
+        self.name = name
+        self.concurrency, self.admin_concurrency = concurrency, admin_concurrency
+        self._lanes = None
+        self._chats = {}   # chat_id → [Lock, update in attesa o in corso]
+
+    def _lane(self, update) -> str:
+        user = update.effective_user if isinstance(update, Update) else None
+        return "admin" if user and self.is_admin(user.id) else "users"
+
+    async def do_process_update(self, update, coroutine):
+        lane = self._lane(update)
+        key = _chat_key(update)
+        entry = None
+        if key is not None:
+            entry = self._chats.get(key)
+            if entry is None:
+                entry = self._chats[key] = [aio.Lock(), 0]
+            entry[1] += 1
+        try:
+            if entry is not None:
+                await entry[0].acquire()   # Lock FIFO: stesso ordine di arrivo
+            try:
+                UPDATES_WAITING.inc(self.name, lane)
+                try:
+                    await self._lanes[lane].acquire()
+                finally:
+                    UPDATES_WAITING.inc(self.name, lane, n=-1)
+                try:
+                    await coroutine
+                finally:
+                    self._lanes[lane].release()
+            finally:
+                if entry is not None:
+                    entry[0].release()
+        finally:
+            if entry is not None:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._chats[key]
+            coroutine.close()   # mai attesa se cancellata prima del turno: niente warning
+
+    async def initialize(self):
+        self._lanes = {"users": aio.Semaphore(self.concurrency),
+                       "admin": aio.Semaphore(self.admin_concurrency)}
+
+    async def shutdown(self):
+        self._chats.clear()
@@ -0,0 +1,53 @@
+# flood.py
+# Limitatore anti-flood per utente: token bucket (capacità `burst`, ricarica
+# `rate` token/s) tenuto in un LRU di dimensione massima, così la memoria non
+# cresce con il numero di mittenti.
+import os
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+FLOOD_BURST      = float(os.environ.get("FLOOD_BURST", "10"))       # update consecutivi ammessi
+FLOOD_RATE       = float(os.environ.get("FLOOD_RATE", "1"))         # update/s recuperati
+FLOOD_MAX_USERS  = int(os.environ.get("FLOOD_MAX_USERS", "50000"))  # bucket tenuti in memoria
+FLOOD_NOTICE_SEC = float(os.environ.get("FLOOD_NOTICE_SEC", "30"))  # al massimo un avviso ogni N s
+
+
+class FloodLimiter:
+    """`hit(uid)` → (ammesso, avvisare): l'avviso scatta una volta per cooldown.
+
+    Un utente sparito dall'LRU riparte col bucket pieno: è lo stesso stato che
+    avrebbe dopo burst/rate secondi di silenzio, quindi l'eviction è innocua.
+    """
+
+    def __init__(self, burst: float = FLOOD_BURST, rate: float = FLOOD_RATE,
+                 max_users: int = FLOOD_MAX_USERS, notice_every: float = FLOOD_NOTICE_SEC):
+        self.burst = burst
+        self.rate = rate
+        self.max_users = max_users
+        self.notice_every = notice_every
+        self.dropped = 0
+        self._buckets = OrderedDict()   # uid → [tokens, ultimo aggiornamento, ultimo avviso]
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def hit(self, uid: int, now: Optional[float] = None) -> Tuple[bool, bool]:
+        now = time.monotonic() if now is None else now
+        b = self._buckets.get(uid)
+        if b is None:
+            b = self._buckets[uid] = [self.burst, now, float("-inf")]
+            if len(self._buckets) > self.max_users:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(uid)
+            b[0] = min(self.burst, b[0] + (now - b[1]) * self.rate)
+            b[1] = now
+        if b[0] >= 1:
+            b[0] -= 1
+            return True, False
+        self.dropped += 1
+        if now - b[2] >= self.notice_every:
+            b[2] = now
+            return False, True
+        return False, False
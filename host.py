@@ -0,0 +1,148 @@
+# host.py
+# Modalità host: bot.py (BPFARM) e bot2.py (BPFAM1) nello stesso processo e
+# nello stesso event loop. Ogni bot tiene token, handler e DB propri; in comune
+# restano il layer DB (db.py), il pool HTTP verso la Bot API, la JobQueue, la
+# pipeline di backup (backup_utils.py, un backup alla volta) e un solo server
+# HTTP per i webhook (più uno per /metrics su METRICS_PORT). L'indice del pubblico comune (audience.py)
+# abilita su bot.py /broadcast_to, con invii ripartiti tra i due bot.
+#
+# Configurazione: le ENV di sempre valgono per bot.py; per bot2.py le stesse
+# chiavi col prefisso BOT2_ (BOT2_BOT_TOKEN, BOT2_DB_FILE, BOT2_ADMIN_ID, …)
+# hanno la precedenza. Le chiavi in ISOLATED non passano da un bot all'altro:
+# senza BOT2_* bot2.py usa i propri default.
+#
+#     python host.py            (su Render: `worker: python host.py` nel Procfile)
+import os
+import signal
+import logging
+import importlib
+import asyncio as aio
+from contextlib import contextmanager
+
+from telegram import Update
+
+from webhook import webhook_enabled, webhook_secret, serve, WebhookServer, WEBHOOK_PATH
+from metrics import METRICS_PORT
+from audience import AudienceIndex, audience_sync_job, AUDIENCE_SYNC_SEC
+
+log = logging.getLogger("host")
+
+BOT2_PREFIX       = "BOT2_"
+BOT2_WEBHOOK_PATH = os.environ.get("BOT2_WEBHOOK_PATH", "/telegram2")   # route del secondo bot sullo stesso server
+ISOLATED = ("BOT_TOKEN", "DB_FILE", "BACKUP_DIR", "BACKUP_TIME", "WEBHOOK_SECRET")
+
+
+@contextmanager
+def env_overlay(prefix: str, isolated=ISOLATED):
+    """Durante il blocco os.environ vede PREFIX_X come X (le chiavi `isolated` solo così)."""
+    saved = dict(os.environ)
+    for k in isolated:
+        os.environ.pop(k, None)
+    for k, v in saved.items():
+        if k.startswith(prefix):
+            os.environ[k[len(prefix):]] = v
+    try:
+        yield
+    finally:
+        os.environ.clear()
+        os.environ.update(saved)
+
+
+def load_bots():
+    """Importa i due moduli (bot2 sotto l'overlay BOT2_*) e prepara i DB.
+
+    bot.py va importato per primo: i moduli condivisi leggono le ENV
+    all'import e devono vedere quelle comuni, non quelle di bot2.
+    """
+    bot = importlib.import_module("bot")
+    with env_overlay(BOT2_PREFIX):
+        bot2 = importlib.import_module("bot2")
+    for mod in (bot, bot2):
+        if not mod.BOT_TOKEN:
+            raise SystemExit(f"{mod.__name__}: token mancante (BOT_TOKEN / {BOT2_PREFIX}BOT_TOKEN)")
+        mod.init_db()
+        mod.load_known_users()
+        mod.METRICS_PORT = 0   # /metrics lo serve l'host, una volta sola
+    return bot, bot2
+
+
+def build_apps(bot, bot2):
+    """Due Application: bot2 usa il pool HTTP e la JobQueue di bot."""
+    app = bot.build_app()
+    app2 = bot2.build_app(request=bot2.scheduled_request("bpfam1", pool=app.bot.request),
+                          job_queue=app.job_queue)
+    return app, app2
+
+
+def wire_audience(bot, bot2, app, app2) -> AudienceIndex:
+    """Indice del pubblico comune: bot.py è la sorgente preferita per l'invio."""
+    aud = AudienceIndex()
+    aud.add_source("bpfarm", bot.DB, "delivery = 'ok'")
+    aud.add_source("bpfam1", bot2.DB, "delivery = 'ok'", on_drop=bot2.mark_unreachable)
+    aud.init()
+    app.bot_data.update(audience=aud, peers={"bpfarm": app.bot, "bpfam1": app2.bot})
+    if AUDIENCE_SYNC_SEC:
+        app.job_queue.run_repeating(audience_sync_job, AUDIENCE_SYNC_SEC, first=5, data=aud, name="audience_sync")
+    return aud
+
+
+async def serve_polling(apps, stop: aio.Event = None):
+    """Long polling di più Application nello stesso loop (ordine di run_polling)."""
+    stop = stop or aio.Event()
+    loop = aio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try: loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError): pass
+
+    inited, started = [], []
+    try:
+        for app in apps:
+            await app.initialize()
+            inited.append(app)
+            if app.post_init:
+                await app.post_init(app)
+            # start_polling rimuove l'eventuale webhook e scarta gli update pendenti
+            await app.updater.start_polling(drop_pending_updates=True, allowed_updates=Update.ALL_TYPES)
+            await app.start()
+            started.append(app)
+            log.info(f"[HOST] @{app.bot.username} in polling")
+        await stop.wait()
+    finally:
+        for app in reversed(started):
+            if app.updater.running:
+                await app.updater.stop()
+            await app.stop()
+            if app.post_stop:
+                await app.post_stop(app)
+        for app in reversed(inited):
+            await app.shutdown()
+            if app.post_shutdown:
+                await app.post_shutdown(app)
+
+
+async def run(stop: aio.Event = None):
+    bot, bot2 = load_bots()
+    app, app2 = build_apps(bot, bot2)
+    wire_audience(bot, bot2, app, app2)
+    log.info(f"🚀 Host: BPFARM v{bot.VERSION} + BPFAM1 v{bot2.VERSION}")
+    metrics_srv = WebhookServer(port=METRICS_PORT, metrics=True) if METRICS_PORT else None
+    if metrics_srv:
+        await metrics_srv.start()
+    try:
+        if webhook_enabled():
+            await serve([(app, WEBHOOK_PATH, webhook_secret(bot.BOT_TOKEN)),
+                         (app2, BOT2_WEBHOOK_PATH, webhook_secret(bot2.BOT_TOKEN, f"{BOT2_PREFIX}WEBHOOK_SECRET"))],
+                        stop=stop)
+        else:
+            await serve_polling([app, app2], stop)
+    finally:
+        if metrics_srv:
+            await metrics_srv.stop()
+
+
+def main():
+    aio.run(run())
+
+
+if __name__ == "__main__":
+    main()
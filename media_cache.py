@@ -0,0 +1,79 @@
+# media_cache.py
+# Cache dei file_id Telegram per le immagini configurate via URL: la prima
+# spedizione riuscita fornisce il file_id, le successive lo riusano senza
+# che Telegram riscarichi l'immagine dall'host esterno.
+import logging
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Optional
+
+from telegram.error import BadRequest
+
+from db import Database
+
+log = logging.getLogger("media-cache")
+
+# messaggi Bot API per un file_id non più utilizzabile
+_FILE_ID_ERRORS = ("wrong file identifier", "file_id", "file reference")
+
+
+def _bad_file_id(e: BadRequest) -> bool:
+    msg = str(e).lower()
+    return any(s in msg for s in _FILE_ID_ERRORS)
+
+
+class MediaCache:
+    """file_id per chiave (es. "PHOTO_URL"), persistiti nella tabella media_cache.
+
+    La voce vale solo per l'URL con cui è stata ottenuta: se la variabile
+    d'ambiente cambia, il vecchio file_id viene ignorato e sostituito.
+    """
+
+    def __init__(self, db: Database):
+        self.db = db
+        self._mem = {}
+
+    def init(self):
+        self.db.execute("""CREATE TABLE IF NOT EXISTS media_cache (
+            key TEXT PRIMARY KEY,
+            url TEXT NOT NULL,
+            file_id TEXT NOT NULL,
+            updated TEXT
+        )""")
+        self._mem = {r["key"]: (r["url"], r["file_id"]) for r in self.db.all("SELECT key, url, file_id FROM media_cache")}
+
+    def get(self, key: str, url: str) -> Optional[str]:
+        hit = self._mem.get(key)
+        return hit[1] if hit and hit[0] == url else None
+
+    def put(self, key: str, url: str, file_id: str):
+        self._mem[key] = (url, file_id)
+        self.db.execute(
+            "INSERT OR REPLACE INTO media_cache (key, url, file_id, updated) VALUES (?, ?, ?, ?)",
+            (key, url, file_id, datetime.now(timezone.utc).isoformat()))
+
+    def drop(self, key: str):
+        self._mem.pop(key, None)
+        self.db.execute("DELETE FROM media_cache WHERE key=?", (key,))
+
+    async def send_photo(self, key: str, url: str, send: Callable[[str], Awaitable]):
+        """Chiama `send(photo)` con il file_id in cache o, in mancanza, con l'URL.
+
+        Se Telegram rifiuta il file_id (BadRequest su file_id non valido) la voce
+        viene scartata e si riprova con l'URL; alla prima riuscita via URL si
+        memorizza il file_id. Gli altri BadRequest (es. messaggio da modificare
+        sparito, "not modified") risalgono al chiamante con la cache intatta.
+        """
+        file_id = self.get(key, url)
+        if file_id:
+            try:
+                return await send(file_id)
+            except BadRequest as e:
+                if not _bad_file_id(e):
+                    raise
+                log.warning(f"[MEDIA] file_id di {key} rifiutato ({e}), rinvio da URL")
+                self.drop(key)
+        msg = await send(url)
+        photos = getattr(msg, "photo", None)
+        if photos:
+            self.put(key, url, photos[-1].file_id)
+        return msg
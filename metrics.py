@@ -0,0 +1,256 @@
+# metrics.py
+# Strumentazione leggera in-process: contatori, gauge e istogrammi a bucket
+# fissi, esposti in formato testo Prometheus su /metrics e riassunti da /stats.
+import os
+import time
+import logging
+import threading
+from bisect import bisect_left
+from collections import defaultdict
+from functools import wraps
+
+from aiohttp import web
+from telegram.ext import ApplicationHandlerStop
+from telegram.request import HTTPXRequest
+
+log = logging.getLogger("metrics")
+
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))   # server /metrics dedicato, mai sulla porta del webhook (0 = spento)
+STARTED = time.time()
+
+BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+REGISTRY = []
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, doc: str, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()   # osservazioni anche dai worker thread (DB)
+        REGISTRY.append(self)
+
+    def _fmt(self, values, extra=()):
+        pairs = list(zip(self.labels, values)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{str(v)}"' for k, v in pairs) + "}"
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, doc, labels=()):
+        super().__init__(name, doc, labels)
+        self.values = defaultdict(float)
+
+    def inc(self, *labels, n: float = 1):
+        with self._lock:
+            self.values[labels] += n
+
+    def get(self, *labels) -> float:
+        return self.values.get(labels, 0.0)
+
+    def snapshot(self) -> dict:
+        """Copia sotto lock: i worker thread possono aggiungere serie durante l'iterazione."""
+        with self._lock:
+            return dict(self.values)
+
+    def render(self):
+        for k, v in sorted(self.snapshot().items()):
+            yield f"{self.name}{self._fmt(k)} {v:g}"
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, *labels):
+        with self._lock:
+            self.values[labels] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, doc, labels=(), buckets=BUCKETS):
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(buckets)
+        self.series = {}   # labels → [conteggi per bucket (+Inf in coda), somma, totale]
+
+    def observe(self, value: float, *labels):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            s = self.series.get(labels)
+            if s is None:
+                s = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            s[0][i] += 1
+            s[1] += value
+            s[2] += 1
+
+    def time(self, *labels):
+        return _Timer(self, labels)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {k: [list(c), t, n] for k, (c, t, n) in self.series.items()}
+
+    def count(self, *labels) -> int:
+        s = self.series.get(labels)
+        return s[2] if s else 0
+
+    def quantile(self, q: float, *labels) -> float:
+        """Stima per interpolazione lineare dentro il bucket (come histogram_quantile)."""
+        s = self.series.get(labels)
+        if not s or not s[2]:
+            return 0.0
+        rank, seen = q * s[2], 0
+        for i, c in enumerate(s[0]):
+            if seen + c >= rank and c:
+                lo = self.buckets[i - 1] if i else 0.0
+                hi = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lo + (hi - lo) * (rank - seen) / c
+            seen += c
+        return self.buckets[-1]
+
+    def render(self):
+        for k, (counts, total, n) in sorted(self.snapshot().items()):
+            acc = 0
+            for b, c in zip(self.buckets + ("+Inf",), counts):
+                acc += c
+                yield f"{self.name}_bucket{self._fmt(k, [('le', b)])} {acc}"
+            yield f"{self.name}_sum{self._fmt(k)} {total:.6f}"
+            yield f"{self.name}_count{self._fmt(k)} {n}"
+
+
+class _Timer:
+    __slots__ = ("h", "labels", "t0")
+
+    def __init__(self, h, labels):
+        self.h, self.labels = h, labels
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.h.observe(time.perf_counter() - self.t0, *self.labels)
+
+
+# ---------- metriche del bot ----------
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Durata degli handler", ("bot", "handler"))
+HANDLER_ERRORS  = Counter("bot_handler_errors_total", "Eccezioni negli handler", ("bot", "handler"))
+API_CALLS       = Counter("tg_api_calls_total", "Chiamate Bot API per metodo ed esito", ("method", "outcome"))
+API_SECONDS     = Histogram("tg_api_seconds", "Latenza Bot API", ("method",))
+DB_SECONDS      = Histogram("db_seconds", "Durata operazioni SQLite", ("db", "op"),
+                            buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 5))
+BCAST_MESSAGES  = Counter("bcast_messages_total", "Esiti invii broadcast", ("outcome",))
+BCAST_RATE      = Gauge("bcast_rate", "Rate corrente del token bucket broadcast (msg/s)")
+DELETIONS       = Counter("tg_deletions_total", "Cancellazioni per esito (queued/deleted/dropped/failed)", ("outcome",))
+SCHED_DEPTH     = Gauge("tg_sched_queue_depth", "Chiamate in attesa del bucket globale", ("bot", "lane"))
+SCHED_WAIT      = Histogram("tg_sched_wait_seconds", "Attesa nello scheduler prima dell'invio", ("bot", "lane"))
+UPDATES_WAITING = Gauge("bot_updates_waiting", "Update in attesa di uno slot del processor", ("bot", "lane"))
+
+
+def render() -> str:
+    out = []
+    for m in REGISTRY:
+        out.append(f"# HELP {m.name} {m.doc}")
+        out.append(f"# TYPE {m.name} {m.kind}")
+        out.extend(m.render())
+    out.append(f"process_uptime_seconds {time.time() - STARTED:.0f}")
+    return "\n".join(out) + "\n"
+
+
+async def metrics_handler(request):
+    return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+
+# ---------- handler ----------
+def _timed(callback, bot: str, name: str):
+    @wraps(callback)
+    async def wrapper(update, context):
+        t0 = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except ApplicationHandlerStop:
+            raise
+        except Exception:
+            HANDLER_ERRORS.inc(bot, name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - t0, bot, name)
+    return wrapper
+
+
+def instrument(app, bot: str):
+    """Avvolge le callback di tutti gli handler registrati con il cronometro."""
+    for handlers in app.handlers.values():
+        for h in handlers:
+            h.callback = _timed(h.callback, bot, h.callback.__name__)
+
+
+# ---------- Bot API ----------
+class MeteredRequest(HTTPXRequest):
+    """HTTPXRequest che conta le chiamate per metodo ed esito (ok / nome eccezione)."""
+
+    async def post(self, url, *args, **kwargs):
+        method = url.rsplit("/", 1)[-1]
+        outcome = "ok"
+        t0 = time.perf_counter()
+        try:
+            return await super().post(url, *args, **kwargs)
+        except Exception as e:
+            outcome = type(e).__name__
+            raise
+        finally:
+            API_SECONDS.observe(time.perf_counter() - t0, method)
+            API_CALLS.inc(method, outcome)
+
+
+# ---------- /stats ----------
+def _ms(s: float) -> str:
+    return f"{s * 1000:.0f}ms" if s >= 0.001 else f"{s * 1e6:.0f}µs"
+
+
+def summary(bot: str = None, top: int = 8) -> str:
+    up = int(time.time() - STARTED)
+    lines = [f"📈 STATS (uptime {up // 3600}h{up % 3600 // 60:02d}m)", "", "Handler (n · p50 · p95 · err):"]
+    rows = sorted((k for k in HANDLER_SECONDS.snapshot() if bot is None or k[0] == bot),
+                  key=HANDLER_SECONDS.count, reverse=True)
+    for k in rows[:top]:
+        lines.append(f"• {k[1]}: {HANDLER_SECONDS.count(*k)} · {_ms(HANDLER_SECONDS.quantile(.5, *k))}"
+                     f" · {_ms(HANDLER_SECONDS.quantile(.95, *k))} · {HANDLER_ERRORS.get(*k):g}")
+
+    per_method = defaultdict(dict)
+    for (method, outcome), n in API_CALLS.snapshot().items():
+        per_method[method][outcome] = n
+    lines += ["", "Bot API (chiamate · p95):"]
+    for method, outs in sorted(per_method.items(), key=lambda kv: -sum(kv[1].values()))[:top]:
+        errs = ", ".join(f"{o} {n:g}" for o, n in sorted(outs.items()) if o != "ok")
+        lines.append(f"• {method}: {sum(outs.values()):g} · {_ms(API_SECONDS.quantile(.95, method))}"
+                     + (f" ({errs})" if errs else ""))
+
+    lines += ["", "SQLite (n · p95):"]
+    for k in sorted(DB_SECONDS.snapshot(), key=DB_SECONDS.count, reverse=True)[:top]:
+        lines.append(f"• {k[0]} {k[1]}: {DB_SECONDS.count(*k)} · {_ms(DB_SECONDS.quantile(.95, *k))}")
+
+    sent = BCAST_MESSAGES.get("sent")
+    if sent or BCAST_MESSAGES.values:
+        lines += ["", f"Broadcast: inviati {sent:g}, bloccati {BCAST_MESSAGES.get('blocked'):g}, "
+                      f"errori {BCAST_MESSAGES.get('failed'):g}, rate {BCAST_RATE.get():.1f} msg/s"]
+    if DELETIONS.values:
+        calls = sum(n for (m, o), n in API_CALLS.snapshot().items() if m == "deleteMessages")
+        lines += ["", f"Cancellazioni: in coda {DELETIONS.get('queued'):g}, eliminate {DELETIONS.get('deleted'):g}, "
+                      f"scartate {DELETIONS.get('dropped'):g}, fallite {DELETIONS.get('failed'):g} ({calls:g} chiamate)"]
+    waiting = {k[1]: n for k, n in UPDATES_WAITING.snapshot().items() if bot is None or k[0] == bot}
+    if waiting:
+        lines += ["", "Update in attesa di slot: " + ", ".join(f"{l} {n:g}" for l, n in sorted(waiting.items()))]
+    lanes = [k for k in SCHED_WAIT.snapshot() if bot is None or k[0] == bot]
+    if lanes:
+        lines += ["", "Scheduler (coda · n · p50 · p95):"]
+        for k in sorted(lanes):
+            lines.append(f"• {k[1]}: {SCHED_DEPTH.get(*k):g} · {SCHED_WAIT.count(*k)} · "
+                         f"{_ms(SCHED_WAIT.quantile(.5, *k))} · {_ms(SCHED_WAIT.quantile(.95, *k))}")
+    return "\n".join(lines)
@@ -0,0 +1,145 @@
+# pages.py
+# Registro delle pagine del bot: ogni testo viene compilato una volta sola
+# (parti già divise in lunghezza UTF-16 come la conta Telegram, parse mode
+# scelto in anticipo) insieme alla sua tastiera; le pagine caricate da
+# file:// vengono ricompilate quando cambia l'mtime del file.
+import os
+import re
+import time
+import logging
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+log = logging.getLogger("bpfarm-bot")
+
+PARSE_MODES = ("Markdown", "HTML", None)   # ordine di ripiego, come il vecchio _send_long
+
+_MD_CODE = re.compile(r"```.*?```|`[^`\n]*`", re.S)
+_MD_LINK = re.compile(r"\[[^\]\n]*\]\([^)\s]*\)")
+_HTML_TAG = re.compile(r"</?(b|strong|i|em|u|ins|s|strike|del|a|code|pre|tg-spoiler|span|blockquote)\b[^>]*>", re.I)
+
+
+def utf16_len(text: str) -> int:
+    """Lunghezza come la misura Telegram (unità UTF-16: emoji fuori BMP valgono 2)."""
+    return len(text.encode("utf-16-le")) // 2
+
+
+def _hard_split(text: str, limit: int):
+    """Paragrafo oltre il limite: prima per righe, poi taglio netto per carattere."""
+    if utf16_len(text) <= limit:
+        yield text
+        return
+    cur, n = [], 0
+    for line in text.split("\n"):
+        ln = utf16_len(line) + 1
+        if ln > limit:
+            if cur:
+                yield "\n".join(cur); cur, n = [], 0
+            chunk, cn = [], 0
+            for ch in line:
+                w = 2 if ord(ch) > 0xFFFF else 1
+                if cn + w > limit:
+                    yield "".join(chunk); chunk, cn = [], 0
+                chunk.append(ch); cn += w
+            if chunk:
+                yield "".join(chunk)
+            continue
+        if cur and n + ln > limit:
+            yield "\n".join(cur); cur, n = [], 0
+        cur.append(line); n += ln
+    if cur:
+        yield "\n".join(cur)
+
+
+def split_text(text: str, limit: int) -> Tuple[str, ...]:
+    """Divide per paragrafi ("\\n\\n") in parti di al massimo `limit` unità UTF-16."""
+    if utf16_len(text) <= limit:
+        return (text,)
+    parts, cur, n = [], [], 0
+    for para in text.split("\n\n"):
+        for piece in _hard_split(para, limit):
+            pn = utf16_len(piece) + 2
+            if cur and n + pn > limit:
+                parts.append("\n\n".join(cur)); cur, n = [], 0
+            cur.append(piece); n += pn
+    if cur:
+        parts.append("\n\n".join(cur))
+    return tuple(parts)
+
+
+def guess_parse_mode(text: str) -> Optional[str]:
+    """Markdown (legacy) se i marcatori sono bilanciati, HTML se ci sono tag, altrimenti testo semplice."""
+    if _HTML_TAG.search(text):
+        return "HTML"
+    rest = _MD_LINK.sub("", _MD_CODE.sub("", text))
+    if "`" in rest or rest.count("*") % 2 or rest.count("_") % 2:
+        return None
+    return "Markdown"
+
+
+@dataclass(frozen=True)
+class Page:
+    key: str
+    parts: Tuple[str, ...]
+    mode: Optional[str]
+    kb: object = None
+    photo: Optional[Tuple[str, str]] = None   # (chiave MediaCache, URL)
+
+
+def compile_page(key: str, text: str, kb=None, photo=None, limit: int = 3800) -> Page:
+    text = text or "\u2063"
+    return Page(key, split_text(text, limit), guess_parse_mode(text), kb, photo)
+
+
+class PageRegistry:
+    """Tabella chiave → Page (la chiave coincide con il callback_data del bottone)."""
+
+    def __init__(self, limit: int = 3800, check_every: float = 5.0):
+        self.limit = limit
+        self.check_every = check_every
+        self._pages = {}
+        self._files = {}   # key → [path, mtime, ultimo controllo]
+
+    def add(self, key: str, text: str, kb=None, photo=None, path: Optional[str] = None):
+        self._pages[key] = compile_page(key, text, kb, photo, self.limit)
+        if path:
+            try: mtime = os.stat(path).st_mtime
+            except OSError: mtime = None
+            self._files[key] = [path, mtime, time.monotonic()]
+
+    def __contains__(self, key) -> bool:
+        return key in self._pages
+
+    def get(self, key: str) -> Optional[Page]:
+        if key in self._files:
+            self._maybe_reload(key)
+        return self._pages.get(key)
+
+    def demote(self, key: str, failed: Optional[str]) -> Optional[str]:
+        """Il parse mode `failed` è stato rifiutato da Telegram: passa al successivo e lo ricorda."""
+        nxt = PARSE_MODES[PARSE_MODES.index(failed) + 1] if failed else None
+        page = self._pages.get(key)
+        if page is not None and page.mode == failed:
+            self._pages[key] = Page(page.key, page.parts, nxt, page.kb, page.photo)
+            log.warning(f"[PAGES] {key}: parse mode {failed} rifiutato, uso {nxt}")
+        return nxt
+
+    def _maybe_reload(self, key: str):
+        entry = self._files[key]
+        now = time.monotonic()
+        if now - entry[2] < self.check_every:
+            return
+        entry[2] = now
+        try:
+            mtime = os.stat(entry[0]).st_mtime
+            if mtime == entry[1]:
+                return
+            with open(entry[0], "r", encoding="utf-8") as f:
+                text = f.read()
+        except OSError as e:
+            log.warning(f"[PAGES] reload {key} fallito: {e}")
+            return
+        old = self._pages[key]
+        self._pages[key] = compile_page(key, text, old.kb, old.photo, self.limit)
+        entry[1] = mtime
+        log.info(f"[PAGES] {key} ricaricata da {entry[0]}")
@@ -0,0 +1,245 @@
+# scheduler.py
+# Scheduler delle chiamate in uscita, a livello di request: ogni chiamata con
+# chat_id passa da un limite per chat e da un token bucket globale servito a
+# corsie di priorità. Le risposte interattive scavalcano broadcast, backup e
+# manutenzione; la corsia si sceglie con un contextvar (`bulk()`).
+import os
+import time
+import logging
+import asyncio as aio
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import httpx
+from telegram.error import NetworkError, RetryAfter
+
+from metrics import MeteredRequest, SCHED_DEPTH, SCHED_WAIT
+
+log = logging.getLogger("scheduler")
+
+SCHED_RATE       = float(os.environ.get("SCHED_RATE", "30"))          # chiamate/s globali per bot
+SCHED_CHAT_RATE  = float(os.environ.get("SCHED_CHAT_RATE", "1"))      # messaggi/s per chat privata
+SCHED_GROUP_RATE = float(os.environ.get("SCHED_GROUP_RATE", "0.33"))  # messaggi/s per gruppo (~20/min)
+SCHED_CHAT_BURST = float(os.environ.get("SCHED_CHAT_BURST", "3"))     # messaggi consecutivi ammessi per chat
+SCHED_MAX_CHATS  = int(os.environ.get("SCHED_MAX_CHATS", "50000"))    # bucket per chat tenuti in memoria
+
+INTERACTIVE, BULK = 0, 1
+LANES = ("interactive", "bulk")
+PRIORITY: ContextVar[int] = ContextVar("tg_priority", default=INTERACTIVE)
+
+# metodi che creano un messaggio nuovo: soggetti anche al limite per chat
+_NEW_MESSAGE = ("send", "copy", "forward")
+
+
+@contextmanager
+def bulk():
+    """Le chiamate dentro il blocco (e nei task creati da qui) vanno in corsia bulk."""
+    token = PRIORITY.set(BULK)
+    try:
+        yield
+    finally:
+        PRIORITY.reset(token)
+
+
+class OutboundScheduler:
+    """Token bucket globale con code per corsia + bucket per chat in un LRU limitato.
+
+    Il limite per chat si prenota (i token possono andare sotto zero): ogni
+    chiamata aspetta il proprio turno senza lock e senza bloccare le altre chat.
+    Il bucket globale serve sempre prima la corsia interattiva.
+    """
+
+    def __init__(self, name: str = "bot", rate: float = SCHED_RATE, chat_rate: float = SCHED_CHAT_RATE,
+                 group_rate: float = SCHED_GROUP_RATE, chat_burst: float = SCHED_CHAT_BURST,
+                 max_chats: int = SCHED_MAX_CHATS):
+        self.name = name
+        self.rate = rate
+        self.burst = max(1.0, rate)
+        self.chat_rate, self.group_rate, self.chat_burst = chat_rate, group_rate, chat_burst
+        self.max_chats = max_chats
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.paused_until = 0.0
+        self._lanes = [deque() for _ in LANES]
+        self._chats = OrderedDict()   # chat_id → [tokens, ultimo aggiornamento]
+        self._wake = None
+        self._task = None
+
+    # ---------- per chat ----------
+    async def _chat_slot(self, chat_id):
+        rate = self.chat_rate if isinstance(chat_id, int) and chat_id > 0 else self.group_rate
+        now = time.monotonic()
+        b = self._chats.get(chat_id)
+        if b is None:
+            b = self._chats[chat_id] = [self.chat_burst, now]
+            if len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+            b[0] = min(self.chat_burst, b[0] + (now - b[1]) * rate)
+            b[1] = now
+        b[0] -= 1
+        if b[0] < 0:
+            await aio.sleep(-b[0] / rate)
+
+    # ---------- globale ----------
+    def _refill(self, now):
+        if now > self.last:
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+
+    def _depth(self, lane):
+        SCHED_DEPTH.set(len(self._lanes[lane]), self.name, LANES[lane])
+
+    async def acquire(self, chat_id, new_message: bool):
+        lane = PRIORITY.get()
+        t0 = time.monotonic()
+        if new_message:
+            await self._chat_slot(chat_id)
+        now = time.monotonic()
+        self._refill(now)
+        if now >= self.paused_until and self.tokens >= 1 and not any(self._lanes):
+            self.tokens -= 1
+        else:
+            fut = aio.get_running_loop().create_future()
+            self._lanes[lane].append(fut)
+            self._depth(lane)
+            self._ensure_dispatcher()
+            self._wake.set()
+            try:
+                await fut
+            except aio.CancelledError:
+                if not fut.done() or fut.cancelled():
+                    try: self._lanes[lane].remove(fut)
+                    except ValueError: pass
+                    self._depth(lane)
+                else:
+                    self.tokens += 1   # token già assegnato: lo restituisce
+                raise
+        SCHED_WAIT.observe(time.monotonic() - t0, self.name, LANES[lane])
+
+    def _ensure_dispatcher(self):
+        if self._task is None or self._task.done():
+            self._wake = aio.Event()
+            self._task = aio.get_running_loop().create_task(self._dispatch())
+
+    async def _dispatch(self):
+        while True:
+            lane = next((i for i, q in enumerate(self._lanes) if q), None)
+            if lane is None:
+                self._wake.clear()
+                await self._wake.wait()
+                continue
+            now = time.monotonic()
+            if now < self.paused_until:
+                await aio.sleep(self.paused_until - now)
+                continue
+            self._refill(now)
+            if self.tokens < 1:
+                await aio.sleep((1 - self.tokens) / self.rate)
+                continue
+            fut = self._lanes[lane].popleft()
+            self._depth(lane)
+            if not fut.done():
+                self.tokens -= 1
+                fut.set_result(None)
+
+    def penalize(self, retry_after: float):
+        """RetryAfter dal limite globale: ferma tutte le corsie per `retry_after` secondi."""
+        self.paused_until = max(self.paused_until, time.monotonic() + float(retry_after))
+        self.tokens = 0.0
+        self.last = self.paused_until
+        log.warning(f"[SCHED] {self.name}: RetryAfter {retry_after}s: invii sospesi")
+
+    def penalize_chat(self, chat_id, retry_after: float):
+        """RetryAfter su un nuovo messaggio: ferma solo la chat, le altre proseguono.
+
+        Il bucket della chat scende di `retry_after` secondi di token: i
+        prossimi invii verso quella chat prenotano il turno dopo la pausa.
+        """
+        rate = self.chat_rate if isinstance(chat_id, int) and chat_id > 0 else self.group_rate
+        now = time.monotonic()
+        b = self._chats.get(chat_id)
+        if b is None:
+            b = self._chats[chat_id] = [0.0, now]
+            if len(self._chats) > self.max_chats:
+                self._chats.popitem(last=False)
+        else:
+            self._chats.move_to_end(chat_id)
+            b[0] = min(self.chat_burst, b[0] + (now - b[1]) * rate)
+            b[1] = now
+        b[0] = min(b[0], 0.0) - float(retry_after) * rate
+        log.info(f"[SCHED] {self.name}: RetryAfter {retry_after}s sulla chat {chat_id}")
+
+    async def stop(self):
+        """Ferma il dispatcher; chi è ancora in coda riceve NetworkError."""
+        if self._task is not None:
+            self._task.cancel()
+            try: await self._task
+            except BaseException: pass
+            self._task = None
+        for lane, q in enumerate(self._lanes):
+            while q:
+                fut = q.popleft()
+                if not fut.done():
+                    fut.set_exception(NetworkError("scheduler fermato"))
+            self._depth(lane)
+
+    def stats(self) -> dict:
+        return {LANES[i]: len(q) for i, q in enumerate(self._lanes)}
+
+
+class ScheduledRequest(MeteredRequest):
+    """MeteredRequest che fa passare dallo scheduler ogni chiamata con chat_id.
+
+    Con `client` usa quel client httpx invece di crearne uno: niente client
+    di troppo da chiudere. `client` (proprietà) è quello in uso.
+    """
+
+    def __init__(self, *args, scheduler: OutboundScheduler = None, client: httpx.AsyncClient = None, **kwargs):
+        self._shared_client = client   # prima di super(): HTTPXRequest costruisce qui il client
+        super().__init__(*args, **kwargs)
+        self.scheduler = scheduler or OutboundScheduler()
+
+    def _build_client(self) -> httpx.AsyncClient:
+        if self._shared_client is not None and not self._shared_client.is_closed:
+            return self._shared_client
+        return super()._build_client()
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        return self._client
+
+    async def post(self, url, request_data=None, *args, **kwargs):
+        params = request_data.parameters if request_data is not None else {}
+        chat_id = params.get("chat_id")
+        new_message = chat_id is not None and url.rsplit("/", 1)[-1].startswith(_NEW_MESSAGE)
+        if chat_id is not None:
+            await self.scheduler.acquire(chat_id, new_message)
+        try:
+            return await super().post(url, request_data, *args, **kwargs)
+        except RetryAfter as e:
+            if new_message:
+                self.scheduler.penalize_chat(chat_id, e.retry_after)
+            else:
+                self.scheduler.penalize(e.retry_after)
+            raise
+
+    async def shutdown(self):
+        await self.scheduler.stop()
+        await super().shutdown()
+
+
+def scheduled_request(name: str = "bot", scheduler: OutboundScheduler = None,
+                      pool: ScheduledRequest = None, **kw) -> ScheduledRequest:
+    """Una request per bot; passare lo stesso `scheduler` per condividere i limiti.
+
+    Con `pool` usa il client httpx (e quindi il pool di connessioni) di
+    un'altra request: più bot nello stesso processo (host.py) aprono le
+    connessioni verso la Bot API una volta sola. Il primo shutdown chiude il
+    client, i successivi lo trovano già chiuso.
+    """
+    kw.setdefault("connection_pool_size", 256)   # come il default di ApplicationBuilder
+    return ScheduledRequest(scheduler=scheduler or OutboundScheduler(name),
+                            client=pool.client if pool is not None else None, **kw)
@@ -0,0 +1,138 @@
+# webhook.py
+# Modalità webhook opzionale (WEBHOOK_URL impostato): un server aiohttp locale
+# riceve gli update spinti da Telegram, verifica il secret token e li mette
+# nella update_queue dell'Application, al posto del long polling.
+import os
+import hmac
+import signal
+import hashlib
+import logging
+import asyncio as aio
+from typing import List, Optional, Tuple
+
+from aiohttp import web
+from telegram import Update
+from telegram.ext import Application
+
+from metrics import metrics_handler
+
+log = logging.getLogger("webhook")
+
+WEBHOOK_URL      = os.environ.get("WEBHOOK_URL", "").rstrip("/")     # URL pubblico; vuoto = polling
+WEBHOOK_LISTEN   = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT     = int(os.environ.get("PORT", "8080"))               # Render imposta PORT
+WEBHOOK_PATH     = os.environ.get("WEBHOOK_PATH", "/telegram")
+WEBHOOK_MAX_CONN = int(os.environ.get("WEBHOOK_MAX_CONN", "40"))     # connessioni parallele da Telegram
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def webhook_enabled() -> bool:
+    return bool(WEBHOOK_URL)
+
+
+def webhook_secret(token: str, env: str = "WEBHOOK_SECRET") -> str:
+    """Secret da ENV o, in mancanza, derivato dal token (stabile tra i riavvii)."""
+    return os.environ.get(env) or hashlib.sha256(f"webhook:{token}".encode()).hexdigest()[:48]
+
+
+class WebhookServer:
+    """Server HTTP condiviso: una route POST per bot e `GET /` per l'health check.
+
+    Con `metrics=True` espone anche `GET /metrics` (formato Prometheus), senza
+    autenticazione: solo sul server dedicato di METRICS_PORT, mai sulla porta
+    pubblica del webhook. Altre route si aggiungono a `self.web.router` prima
+    di `start()`.
+    """
+
+    def __init__(self, listen: str = WEBHOOK_LISTEN, port: int = WEBHOOK_PORT, metrics: bool = False):
+        self.listen = listen
+        self.port = port
+        self.web = web.Application()
+        self.web.router.add_get("/", self._health)
+        if metrics:
+            self.web.router.add_get("/metrics", metrics_handler)
+        self.received = 0
+        self.rejected = 0
+        self._runner = None
+
+    async def _health(self, request):
+        return web.Response(text="ok")
+
+    def add_bot(self, app: Application, path: str, secret: str):
+        async def handle(request: web.Request):
+            if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), secret):
+                self.rejected += 1
+                return web.Response(status=403)
+            try:
+                update = Update.de_json(await request.json(), app.bot)
+            except Exception as e:
+                log.warning(f"[WEBHOOK] update non valido su {path}: {e}")
+                return web.Response(status=400)
+            self.received += 1
+            await app.update_queue.put(update)
+            return web.Response()
+        self.web.router.add_post(path, handle)
+
+    async def start(self):
+        self._runner = web.AppRunner(self.web, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.listen, self.port).start()
+        log.info(f"[WEBHOOK] in ascolto su {self.listen}:{self.port}")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+async def serve(bots: List[Tuple[Application, str, str]], server: Optional[WebhookServer] = None,
+                base_url: str = WEBHOOK_URL, allowed_updates=Update.ALL_TYPES,
+                drop_pending_updates: bool = True, stop: Optional[aio.Event] = None):
+    """Ciclo di vita completo di una o più Application (app, path, secret) in webhook.
+
+    Stesso ordine di run_polling: initialize → post_init → start … stop →
+    post_stop → shutdown → post_shutdown. Il webhook resta registrato allo
+    spegnimento e Telegram accoda gli update nel frattempo; con
+    `drop_pending_updates=True` (come in polling) il set_webhook al riavvio li
+    scarta, con False vengono consegnati.
+    """
+    server = server or WebhookServer()
+    stop = stop or aio.Event()
+    loop = aio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try: loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError): pass
+
+    inited, started = [], []
+    try:
+        for app, path, secret in bots:
+            server.add_bot(app, path, secret)
+            await app.initialize()
+            inited.append(app)
+            if app.post_init:
+                await app.post_init(app)
+            await app.bot.set_webhook(
+                url=base_url + path, secret_token=secret, allowed_updates=allowed_updates,
+                drop_pending_updates=drop_pending_updates, max_connections=WEBHOOK_MAX_CONN)
+            await app.start()
+            started.append(app)
+            log.info(f"[WEBHOOK] @{app.bot.username} → {base_url}{path}")
+        await server.start()
+        await stop.wait()
+    finally:
+        await server.stop()
+        for app in reversed(started):
+            await app.stop()
+            if app.post_stop:
+                await app.post_stop(app)
+        for app in reversed(inited):
+            await app.shutdown()
+            if app.post_shutdown:
+                await app.post_shutdown(app)
+
+
+def run_webhook(app: Application, path: str = WEBHOOK_PATH, secret: Optional[str] = None, **kw):
+    """Equivalente bloccante di `app.run_polling` per un singolo bot."""
+    secret = secret or webhook_secret(app.bot.token)
+    aio.get_event_loop().run_until_complete(serve([(app, path, secret)], **kw))